@@ -0,0 +1,4 @@
+#!/bin/bash
+cd /home/gtulloch/obsy
+source .venv/bin/activate
+celery -A obsy worker -l info
@@ -0,0 +1,87 @@
+############################################################################################################
+## C A L I B R A T E   W O R K E R                                                                        ##
+############################################################################################################
+# Per-frame light calibration. Masters are read once per process and kept in a small LRU, so a worker that
+# is handed a run of lights sharing the same masters only reads each light. All arithmetic is float32 and
+# done in place. Nothing in this module touches the database so it can run in a process pool.
+#
+from functools import lru_cache
+from astropy.io import fits
+import numpy as np
+import os
+
+import logging
+logging=logging.getLogger(__name__)
+
+#################################################################################################################
+## loadMaster - this function reads a master frame as a read-only float32 array. The cache is keyed on the     ##
+##              file's modification time and size as well as its name, so a master rebuilt in place is reread  ##
+#################################################################################################################
+def loadMaster(fileName):
+    stat=os.stat(fileName)
+    return readMaster(fileName,stat.st_mtime_ns,stat.st_size)
+
+@lru_cache(maxsize=8)
+def readMaster(fileName,mtime,size):
+    data=np.asarray(fits.getdata(fileName),dtype=np.float32)
+    data.setflags(write=False)
+    return data
+
+#################################################################################################################
+## loadFlatField - this function returns the master flat normalised to a median of 1, with dead pixels set to ##
+##                 1 so they don't blow up the division                                                        ##
+#################################################################################################################
+def loadFlatField(flatFileName):
+    stat=os.stat(flatFileName)
+    return readFlatField(flatFileName,stat.st_mtime_ns,stat.st_size)
+
+@lru_cache(maxsize=4)
+def readFlatField(flatFileName,mtime,size):
+    flat=np.array(readMaster(flatFileName,mtime,size),dtype=np.float32)
+    median=float(np.median(flat))
+    if median>0:
+        flat/=median
+    flat[flat<=0]=1.0
+    flat.setflags(write=False)
+    return flat
+
+#################################################################################################################
+## calibrateFrame - this function calibrates one light frame and writes the result. Returns a dict with the    ##
+##                  output file name and the bytes read and written, or None if the frame failed              ##
+#################################################################################################################
+def calibrateFrame(lightFileName,outputFileName,biasFileName=None,darkFileName=None,flatFileName=None):
+    try:
+        with fits.open(lightFileName,memmap=False) as hdul:
+            header=hdul[0].header.copy()
+            light=np.array(hdul[0].data,dtype=np.float32)
+
+        steps=""
+        # A master dark already contains the bias, so bias is only subtracted on its own without a dark
+        if darkFileName:
+            light-=loadMaster(darkFileName)
+            steps+="D"
+        elif biasFileName:
+            light-=loadMaster(biasFileName)
+            steps+="B"
+        if flatFileName:
+            light/=loadFlatField(flatFileName)
+            steps+="F"
+
+        for keyword in ['BZERO','BSCALE']:
+            header.remove(keyword,ignore_missing=True)
+        header['IMAGETYP']=('CalibratedLight','Calibrated light frame')
+        header['CALSTAT']=(steps,'Calibration applied by Obsy (B=bias, D=dark, F=flat)')
+        for keyword,fileName in [('MBIAS',biasFileName),('MDARK',darkFileName),('MFLAT',flatFileName)]:
+            if fileName:
+                header[keyword]=(os.path.basename(fileName),'Master frame used')
+
+        # Write beside the final name and rename so a partial file is never left under the final name
+        os.makedirs(os.path.dirname(outputFileName),exist_ok=True)
+        tempFileName=outputFileName+'.tmp'
+        fits.PrimaryHDU(light,header=header).writeto(tempFileName,overwrite=True,output_verify='silentfix')
+        os.replace(tempFileName,outputFileName)
+        return {'lightFileName':lightFileName,'outputFileName':outputFileName,
+                'bytesRead':os.path.getsize(lightFileName),'bytesWritten':os.path.getsize(outputFileName)}
+    except Exception as e:
+        logging.error("Failed to calibrate "+str(lightFileName)+": "+str(e))
+        return None
@@ -0,0 +1,227 @@
+############################################################################################################
+## F I L E   T R A N S F E R                                                                              ##
+############################################################################################################
+# Moves ingested files from the source folder into the repository. Within a filesystem a file is hard
+# linked under its new name and the old name removed, which never overwrites an existing file and never
+# copies data; where hard links aren't supported it is renamed. Across filesystems it is streamed into a
+# hidden temporary file next to the destination with copy_file_range, or sendfile where that isn't
+# available, flushed to disk and then moved into place the same way, so a partial copy is never seen under
+# the final name. The file and its folders are fsynced before the move is reported done, so the database
+# record written afterwards never points at a file that could be lost. A name already taken gets _dup,
+# _dup2 and so on. Folders made are remembered so each is created and synced once.
+#
+import errno
+import os
+import shutil
+import uuid
+
+import logging
+logging=logging.getLogger(__name__)
+
+COPY_CHUNK=64*1024*1024     # Bytes per copy_file_range or sendfile call
+MAX_DUPLICATES=1000
+# Errors that mean a faster copy isn't possible here, rather than that the copy failed
+COPY_FALLBACK_ERRNOS={errno.EXDEV,errno.ENOSYS,errno.EINVAL,errno.EOPNOTSUPP,errno.EBADF,errno.ETXTBSY,
+                      getattr(errno,'ENOTSUP',errno.EOPNOTSUPP)}
+# Errors from os.link on filesystems without hard links
+LINK_FALLBACK_ERRNOS={errno.EPERM,errno.EOPNOTSUPP,errno.EMLINK,errno.EACCES,getattr(errno,'ENOTSUP',errno.EOPNOTSUPP)}
+
+#################################################################################################################
+## duplicateNames - this function yields a destination path followed by its _dup, _dup2, ... alternatives      ##
+#################################################################################################################
+def duplicateNames(destination):
+    yield destination
+    base,extension=os.path.splitext(destination)
+    yield base+"_dup"+extension
+    for i in range(2,MAX_DUPLICATES):
+        yield base+"_dup"+str(i)+extension
+
+#################################################################################################################
+## syncFolder - this function flushes a folder's entries to disk, where the platform allows it                 ##
+#################################################################################################################
+def syncFolder(folder):
+    try:
+        fd=os.open(folder,os.O_RDONLY|getattr(os,'O_DIRECTORY',0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+#################################################################################################################
+## syncFile - this function flushes a file's data to disk                                                      ##
+#################################################################################################################
+def syncFile(path):
+    fd=os.open(path,os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+#################################################################################################################
+## copyFileRange - this function copies a file descriptor to another from offset up to size in the kernel      ##
+##                 with copy_file_range. Returns the offset reached                                            ##
+#################################################################################################################
+def copyFileRange(source,target,offset,size):
+    while offset < size:
+        copied=os.copy_file_range(source,target,min(COPY_CHUNK,size-offset),offset,offset)
+        if copied == 0:
+            break
+        offset+=copied
+    return offset
+
+#################################################################################################################
+## sendFile - this function does the same as copyFileRange with sendfile, where copy_file_range isn't          ##
+##            available                                                                                        ##
+#################################################################################################################
+def sendFile(source,target,offset,size):
+    os.lseek(target,offset,os.SEEK_SET)
+    while offset < size:
+        copied=os.sendfile(target,source,offset,min(COPY_CHUNK,size-offset))
+        if copied == 0:
+            break
+        offset+=copied
+    return offset
+
+#################################################################################################################
+## streamCopy - this function copies one open file to another with copyFileRange, then sendFile, then plain    ##
+##              reads and writes, picking up where a method that isn't supported left off                      ##
+#################################################################################################################
+def streamCopy(source,target):
+    size=os.fstat(source).st_size
+    copied=0
+    for method in (copyFileRange if hasattr(os,'copy_file_range') else None,
+                   sendFile if hasattr(os,'sendfile') else None):
+        if method is None:
+            continue
+        try:
+            copied=method(source,target,copied,size)
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+            continue
+        if copied >= size:
+            return copied
+
+    # Plain reads and writes for whatever is left
+    os.lseek(source,copied,os.SEEK_SET)
+    os.lseek(target,copied,os.SEEK_SET)
+    while True:
+        chunk=os.read(source,COPY_CHUNK)
+        if not chunk:
+            return copied
+        view=memoryview(chunk)
+        while view:
+            written=os.write(target,view)
+            view=view[written:]
+            copied+=written
+
+class FileTransfer(object):
+    def __init__(self,durable=True):
+        self.durable=durable
+        self.folders=set()
+        self.stats={'renamed':0,'copied':0,'bytesCopied':0,'duplicates':0}
+
+    #############################################################################################################
+    ## ensureFolder - create a folder, and its parents, the first time it is needed                            ##
+    #############################################################################################################
+    def ensureFolder(self,folder):
+        if folder in self.folders:
+            return
+        if not os.path.isdir(folder):
+            os.makedirs(folder,exist_ok=True)
+            if self.durable:
+                syncFolder(os.path.dirname(folder.rstrip(os.sep)))
+        self.folders.add(folder)
+
+    #############################################################################################################
+    ## place - give a file on the destination's filesystem the destination name, or the first free duplicate   ##
+    ##         name, without overwriting anything. Returns the name used and whether the original name remains ##
+    #############################################################################################################
+    def place(self,path,destination):
+        try:
+            for candidate in duplicateNames(destination):
+                try:
+                    os.link(path,candidate)
+                    return candidate,True
+                except FileExistsError:
+                    continue
+        except OSError as e:
+            if e.errno not in LINK_FALLBACK_ERRNOS:
+                raise
+            # No hard links here, check for a free name and rename into it
+            for candidate in duplicateNames(destination):
+                if not os.path.lexists(candidate):
+                    os.rename(path,candidate)
+                    return candidate,False
+        raise FileExistsError(errno.EEXIST,"No free name for "+destination)
+
+    #############################################################################################################
+    ## copyAcross - stream a file into a temporary file beside the destination, flush it and move it into      ##
+    ##              place. Returns the name used                                                               ##
+    #############################################################################################################
+    def copyAcross(self,source,destination):
+        folder=os.path.dirname(destination)
+        tempPath=os.path.join(folder,"."+os.path.basename(destination)+"."+uuid.uuid4().hex+".part")
+        try:
+            sourceFd=os.open(source,os.O_RDONLY)
+            try:
+                targetFd=os.open(tempPath,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0o644)
+                try:
+                    copied=streamCopy(sourceFd,targetFd)
+                    if self.durable:
+                        os.fsync(targetFd)
+                finally:
+                    os.close(targetFd)
+            finally:
+                os.close(sourceFd)
+            shutil.copystat(source,tempPath)
+            final,linked=self.place(tempPath,destination)
+            if linked:
+                os.unlink(tempPath)
+        except BaseException:
+            if os.path.lexists(tempPath):
+                os.unlink(tempPath)
+            raise
+        self.stats['copied']+=1
+        self.stats['bytesCopied']+=copied
+        return final
+
+    #############################################################################################################
+    ## move - move a file to a destination path, durably. Returns the path it ends up at, which differs from   ##
+    ##        the destination when that name is already taken                                                  ##
+    #############################################################################################################
+    def move(self,source,destination):
+        folder=os.path.dirname(destination)
+        try:
+            self.ensureFolder(folder)
+            try:
+                final,linked=self.place(source,destination)
+            except FileNotFoundError:
+                # The folder was removed since it was made, make it again
+                if not os.path.exists(source):
+                    raise
+                self.folders.discard(folder)
+                self.ensureFolder(folder)
+                final,linked=self.place(source,destination)
+            if linked:
+                os.unlink(source)
+            self.stats['renamed']+=1
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            final=self.copyAcross(source,destination)
+            os.unlink(source)
+
+        if final != destination:
+            self.stats['duplicates']+=1
+            logging.warning("File already exists in repo - "+destination+", stored as "+final)
+        if self.durable:
+            syncFile(final)
+            syncFolder(folder)
+            syncFolder(os.path.dirname(source))
+        logging.info("Moved file "+source+" to "+final)
+        return final
@@ -0,0 +1,183 @@
+############################################################################################################
+## F I T S   H E A D E R                                                                                  ##
+############################################################################################################
+# A minimal reader for the primary header of a FITS file. Only the 2880 byte header blocks are read, no
+# HDUList is built and the pixel data is never touched. Cards can be changed in place: a card that already
+# exists is overwritten in its 80 byte slot and new cards go into the blank padding after END. If there
+# is no room left in the header blocks the edit falls back to astropy, which rewrites the file.
+#
+from astropy.io import fits
+import math
+
+import logging
+logging=logging.getLogger(__name__)
+
+BLOCK_SIZE=2880
+CARD_SIZE=80
+CARDS_PER_BLOCK=BLOCK_SIZE//CARD_SIZE
+
+#################################################################################################################
+## parseCardValue - this function converts the value field of a card image into a python value                 ##
+#################################################################################################################
+def parseCardValue(valueField):
+    text=valueField.strip()
+    if text.startswith("'"):
+        # String value, a doubled quote is an escaped quote
+        value=""
+        i=1
+        while i < len(text):
+            if text[i]=="'":
+                if i+1 < len(text) and text[i+1]=="'":
+                    value+="'"
+                    i+=2
+                    continue
+                break
+            value+=text[i]
+            i+=1
+        return value.rstrip()
+
+    text=text.split('/',1)[0].strip()
+    if text=="":
+        return None
+    if text=="T":
+        return True
+    if text=="F":
+        return False
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text.replace('D','E'))
+    except ValueError:
+        return text
+
+#################################################################################################################
+## cardNumber - this function returns a card value as an int or float, or None if it is missing or not a      ##
+##              number. Some capture programs write numbers as strings so those are converted too              ##
+#################################################################################################################
+def cardNumber(value,cast=float):
+    if isinstance(value,bool):
+        return None
+    try:
+        number=float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(number) or math.isinf(number):
+        return None
+    return int(round(number)) if cast is int else number
+
+#################################################################################################################
+## FitsHeader - the cards of a primary header, with the position of each card in the file                      ##
+#################################################################################################################
+class FitsHeader(object):
+    def __init__(self,fileName,images,endIndex):
+        self.fileName=fileName
+        self.images=images
+        self.endIndex=endIndex
+        self.values={}
+        self.positions={}
+        self.edits={}
+        for index,image in enumerate(images[:endIndex]):
+            if image[8:10]!="= ":
+                continue
+            keyword=image[:8].rstrip()
+            # Like astropy, the first occurrence of a keyword wins
+            if keyword not in self.values:
+                self.values[keyword]=parseCardValue(image[10:])
+                self.positions[keyword]=index
+
+    def __contains__(self,keyword):
+        return keyword in self.values
+
+    def __getitem__(self,keyword):
+        return self.values[keyword]
+
+    def get(self,keyword,default=None):
+        return self.values.get(keyword,default)
+
+    def headerBytes(self):
+        return "".join(self.images).encode('ascii')
+
+    #############################################################################################################
+    ## set - change or add a card. Nothing is recorded if the card already holds the value                     ##
+    #############################################################################################################
+    def set(self,keyword,value,comment=None):
+        if keyword in self.values and self.values[keyword]==value:
+            return False
+        self.values[keyword]=value
+        self.edits[keyword]=(value,comment)
+        return True
+
+    #############################################################################################################
+    ## flush - write changed cards back to the file                                                           ##
+    #############################################################################################################
+    def flush(self):
+        if not self.edits:
+            return False
+
+        images=[]
+        for keyword,(value,comment) in self.edits.items():
+            image=fits.Card(keyword,value,comment).image
+            if len(image)!=CARD_SIZE:
+                # Long strings need CONTINUE cards
+                return self._flushWithAstropy()
+            images.append((keyword,image))
+
+        newCards=[image for keyword,image in images if keyword not in self.positions]
+        if self.endIndex+len(newCards) >= len(self.images):
+            logging.info("No room left in header for new cards, rewriting "+self.fileName)
+            return self._flushWithAstropy()
+
+        with open(self.fileName,'r+b') as f:
+            for keyword,image in images:
+                if keyword in self.positions:
+                    index=self.positions[keyword]
+                else:
+                    # New cards take the place of END, which moves down one slot
+                    index=self.endIndex
+                    self.positions[keyword]=index
+                    self.endIndex+=1
+                    self.images[self.endIndex]="END".ljust(CARD_SIZE)
+                    f.seek(self.endIndex*CARD_SIZE)
+                    f.write(self.images[self.endIndex].encode('ascii'))
+                self.images[index]=image
+                f.seek(index*CARD_SIZE)
+                f.write(image.encode('ascii'))
+        self.edits={}
+        return True
+
+    def _flushWithAstropy(self):
+        with fits.open(self.fileName,mode='update') as hdul:
+            hdr=hdul[0].header
+            for keyword,(value,comment) in self.edits.items():
+                hdr[keyword]=(value,comment)
+        self.edits={}
+        # Positions have moved, pick them up again
+        reread=readHeader(self.fileName)
+        self.images=reread.images
+        self.endIndex=reread.endIndex
+        self.positions=reread.positions
+        return True
+
+#################################################################################################################
+## readHeader - this function reads the primary header blocks of a FITS file                                   ##
+#################################################################################################################
+def readHeader(fileName):
+    images=[]
+    with open(fileName,'rb') as f:
+        while True:
+            block=f.read(BLOCK_SIZE)
+            if len(block)<BLOCK_SIZE:
+                raise ValueError("Truncated FITS header in "+fileName)
+            try:
+                text=block.decode('ascii')
+            except UnicodeDecodeError:
+                raise ValueError("Header is not ASCII in "+fileName)
+            if not images and not text.startswith("SIMPLE  ="):
+                raise ValueError("Not a FITS file "+fileName)
+            for i in range(CARDS_PER_BLOCK):
+                images.append(text[i*CARD_SIZE:(i+1)*CARD_SIZE])
+            for i in range(len(images)-CARDS_PER_BLOCK,len(images)):
+                if images[i].rstrip()=="END":
+                    return FitsHeader(fileName,images,i)
@@ -0,0 +1,186 @@
+############################################################################################################
+## I N G E S T   W O R K E R                                                                              ##
+############################################################################################################
+# Per-file work for the repository ingest: header parsing, WCS fixes, repository naming and thumbnails.
+# Headers are read with observations.fitsHeader, which only reads the header blocks. Content hashes are
+# only worked out by PostProcess for files that might be copies, see contentHash.
+# Nothing in this module touches the database so the functions can run in a process pool; the results
+# are funnelled back to PostProcess in the parent process, which is the only writer to the database.
+#
+from datetime import datetime
+import numpy as np
+import uuid
+import os
+import hashlib
+from math import cos,sin
+from astropy.io import fits
+from observations.fitsHeader import readHeader
+from observations.thumbnails import writeThumbnail
+
+import logging
+logging=logging.getLogger(__name__)
+
+# Header cards copied back to the parent process for the database record
+HEADER_CARDS=["DATE-OBS","IMAGETYP","OBJECT","EXPTIME","XBINNING","YBINNING","CCD-TEMP",
+              "TELESCOP","INSTRUME","FILTER","GAIN","OFFSET"]
+HASH_CHUNK=1024*1024
+
+#################################################################################################################
+## contentHash - this function returns the BLAKE2b hash of a file's bytes, read a chunk at a time, or None if  ##
+##               the file can't be read                                                                        ##
+#################################################################################################################
+def contentHash(fileName):
+    digest=hashlib.blake2b(digest_size=32)
+    buffer=bytearray(HASH_CHUNK)
+    view=memoryview(buffer)
+    try:
+        with open(fileName,'rb',buffering=0) as f:
+            while True:
+                read=f.readinto(buffer)
+                if not read:
+                    break
+                digest.update(view[:read])
+    except OSError as e:
+        logging.warning("Unable to hash file "+str(fileName)+": "+str(e))
+        return None
+    return digest.hexdigest()
+
+#################################################################################################################
+## scanFitsFile - this function parses and corrects the header of a single fits file and works out where it    ##
+##                belongs in the repository. Returns a dict describing the file, or None if it is not ingested ##
+#################################################################################################################
+def scanFitsFile(root,file,repoFolder,moveFiles=True,thumbnailFolder=None):
+    # Never let one bad file take down the whole pool
+    try:
+        return _scanFitsFile(root,file,repoFolder,moveFiles,thumbnailFolder)
+    except Exception as e:
+        logging.error("Failed to scan file "+str(os.path.join(root, file))+": "+str(e))
+        return None
+
+def _scanFitsFile(root,file,repoFolder,moveFiles,thumbnailFolder):
+    fileName=os.path.join(root,file)
+    file_name, file_extension = os.path.splitext(fileName)
+
+    # Ignore everything not a *fit* file
+    if "fit" not in file_extension:
+        logging.info("Ignoring file "+fileName+" with extension -"+file_extension+"-")
+        return None
+
+    try:
+        hdr = readHeader(fileName)
+    except (ValueError, OSError) as e:
+        logging.warning("Invalid FITS file. File not processed is "+str(fileName))
+        return None
+
+    if "IMAGETYP" not in hdr:
+        logging.warning("File not added to repo - no IMAGETYP card - "+str(fileName))
+        return None
+
+    # Create an os-friendly date
+    try:
+        if "DATE-OBS" not in hdr:
+            logging.warning("No DATE-OBS card in header. File not processed is "+str(fileName))
+            return None
+        datestr=hdr["DATE-OBS"].replace("T", " ")
+        datestr=datestr[0:datestr.find('.')]
+        dateobj=datetime.strptime(datestr, '%Y-%m-%d %H:%M:%S')
+        fitsDate=dateobj.strftime("%Y%m%d%H%M%S")
+    except ValueError as e:
+        logging.warning("Invalid date format in header. File not processed is "+str(fileName))
+        return None
+
+    ############## L I G H T S ################################################################
+    if (hdr["IMAGETYP"]=="Light"):
+        # Adjust the WCS for the image
+        if "CD1_1" not in hdr:
+            if "CDELT1" in hdr:
+                fitsCDELT1=float(hdr["CDELT1"])
+                fitsCDELT2=float(hdr["CDELT2"])
+                fitsCROTA2=float(hdr["CROTA2"])
+                fitsCD1_1 =  fitsCDELT1 * cos(fitsCROTA2)
+                fitsCD1_2 = -fitsCDELT2 * sin(fitsCROTA2)
+                fitsCD2_1 =  fitsCDELT1 * sin (fitsCROTA2)
+                fitsCD2_2 = fitsCDELT2 * cos(fitsCROTA2)
+                hdr.set('CD1_1', fitsCD1_1, 'Adjusted via Obsy')
+                hdr.set('CD1_2', fitsCD1_2, 'Adjusted via Obsy')
+                hdr.set('CD2_1', fitsCD2_1, 'Adjusted via Obsy')
+                hdr.set('CD2_2', fitsCD2_2, 'Adjusted via Obsy')
+            else:
+                logging.warning("No WCS information in header, file not updated is "+str(fileName))
+
+        # Standardize the object name and create a new file name
+        if ("OBJECT" in hdr):
+            # Standardize object name, remove spaces and underscores
+            objectName=str(hdr["OBJECT"]).replace(' ', '').replace('_', '')
+            hdr.set('OBJECT', objectName, 'Adjusted via Obsy')
+
+            if ("FILTER" in hdr):
+                newName="{0}-{1}-{2}-{3}-{4}-{5}s-{6}x{7}-t{8}.fits".format(hdr["OBJECT"].replace(" ", "_"),hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
+                            hdr["INSTRUME"].replace(" ", "_"),hdr["FILTER"],fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
+            else:
+                newName="{0}-{1}-{2}-{3}-{4}-{5}s-{6}x{7}-t{8}.fits".format(hdr["OBJECT"].replace(" ", "_"),hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
+                            hdr["INSTRUME"].replace(" ", "_"),"OSC",fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
+        else:
+            logging.warning("Invalid object name in header. File not processed is "+str(fileName))
+            return None
+    ############## F L A T S #############################################################################
+    elif hdr["IMAGETYP"]=="Flat":
+        if ("FILTER" in hdr):
+            newName="{0}-{1}-{2}-{3}-{4}-{5}s-{6}x{7}-t{8}.fits".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
+                            hdr["INSTRUME"].replace(" ", "_"),hdr["FILTER"],fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
+        else:
+            newName="{0}-{1}-{2}-{3}-{4}-{5}s-{6}x{7}-t{8}.fits".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
+                            hdr["INSTRUME"].replace(" ", "_"),"OSC",fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
+
+    ############## D A R K S / B I A S E S ################################################################
+    elif hdr["IMAGETYP"]=="Dark" or hdr["IMAGETYP"]=="Bias":
+        newName="{0}-{1}-{1}-{2}-{3}s-{4}x{5}-t{6}.fits".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
+                            hdr["INSTRUME"].replace(" ", "_"),fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
+    else:
+        logging.warning("File not processed as IMAGETYP -"+hdr["IMAGETYP"]+"- not recognized: "+str(fileName))
+        return None
+
+    # Only cards that actually changed are written, in place where the header has room
+    hdr.flush()
+    stat=os.stat(fileName)
+    headerHash=hashlib.blake2b(hdr.headerBytes(),digest_size=16).hexdigest()
+
+    ######################################################################################################
+    # Work out the folder structure
+    fitsDate=dateobj.strftime("%Y%m%d")
+    if (hdr["IMAGETYP"]=="Light"):
+        newPath=repoFolder+"Light/{0}/{1}/{2}/{3}/".format(hdr["OBJECT"].replace(" ", ""),hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
+                            hdr["INSTRUME"].replace(" ", "_"),fitsDate)
+    elif hdr["IMAGETYP"]=="Dark":
+        newPath=repoFolder+"Calibrate/{0}/{1}/{2}/{3}/{4}/".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
+                            hdr["INSTRUME"].replace(" ", "_"),hdr["EXPTIME"],fitsDate)
+    elif hdr["IMAGETYP"]=="Flat":
+        if ("FILTER" in hdr):
+            newPath=repoFolder+"Calibrate/{0}/{1}/{2}/{3}/{4}/".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
+                            hdr["INSTRUME"].replace(" ", "_"),hdr["FILTER"],fitsDate)
+        else:
+            newPath=repoFolder+"Calibrate/{0}/{1}/{2}/{3}/{4}/".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
+                            hdr["INSTRUME"].replace(" ", "_"),"OSC",fitsDate)
+    else:
+        newPath=repoFolder+"Calibrate/{0}/{1}/{2}/{3}/".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
+                            hdr["INSTRUME"].replace(" ", "_"),fitsDate)
+
+    # The id is assigned here so the record can be linked before it is written
+    fitsFileId=uuid.uuid4()
+    thumbnailPath=None
+    if thumbnailFolder:
+        thumbnailPath=writeThumbnail(fileName,thumbnailFolder,headerBytes=hdr.headerBytes())
+
+    return {
+        'fitsFileId':   fitsFileId,
+        'sourceFile':   fileName,
+        'newPath':      newPath,
+        'newName':      newName,
+        'fitsFileName': newPath+newName.replace(" ", "_"),
+        'header':       {card: hdr[card] for card in HEADER_CARDS if card in hdr},
+        'headerHash':   headerHash,
+        'contentHash':  None,           # Filled in by PostProcess for files that might be copies
+        'size':         stat.st_size,
+        'mtime':        stat.st_mtime_ns,
+        'thumbnail':    thumbnailPath,
+    }
@@ -8,23 +8,27 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = 'Calibrate all uncalibrated files in the repo'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes used to calibrate light frames (default 1)')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of calibrated frames written to the database per transaction (default 100)')
+
     def handle(self, *args, **kwargs):
         # Instantiate the PostProcess class
         postProcess = PostProcess()
 
-        # Keep track of number of calibrated images
-        calibratedImages = []
-
-        # Find all uncalibrated files
-        uncalibrated = fitsFile.objects.filter(fitsFileCalibrated=False)
+        # Find all uncalibrated light frames that belong to a sequence
+        uncalibrated = fitsFile.objects.filter(fitsFileType="Light",fitsFileCalibrated=False,
+                                               fitsFileSequence__isnull=False).order_by('fitsFileDate')
+        total = uncalibrated.count()
 
-        # Loop through each light frame and calibrate it
-        for light_frame in uncalibrated:
-            result=postProcess.calibrateFitsImage(light_frame)
-            if not result:
-                logger.error('Failed to calibrate file: ' + str(light_frame.fitsFileId))
-            else:
-                calibratedImages.append(light_frame.fitsFileId)
+        # Calibrate the light frames in batches sharing the same masters
+        results=postProcess.calibrateFitsImages(uncalibrated,workers=kwargs['workers'],batchSize=kwargs['batch_size'])
+        if results['failed']:
+            logger.error('Failed to calibrate ' + str(results['failed']) + ' files, see log for details')
 
-        self.stdout.write(self.style.SUCCESS('Successfully calibrated' + str(len(calibratedImages)) + 'files out of ' + str(len(uncalibrated)) + 'files'))
-        logger.info('Successfully calibrated' + str(len(calibratedImages)) + 'files out of ' + str(len(uncalibrated)) + 'files')
\ No newline at end of file
+        seconds=max(results['seconds'],1e-6)
+        throughput='%.1f frames/s, %.1f MB/s' % (results['frames']/seconds,results['bytes']/seconds/1024/1024)
+        self.stdout.write(self.style.SUCCESS('Successfully calibrated ' + str(len(results['calibrated'])) + ' files out of ' + str(total) + ' files (' + throughput + ')'))
+        logger.info('Successfully calibrated ' + str(len(results['calibrated'])) + ' files out of ' + str(total) + ' files (' + throughput + ')')
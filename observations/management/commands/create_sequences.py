@@ -1,39 +1,60 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from observations.models import fitsFile, fitsSequence
-from observations.postProcess import PostProcess
+from observations.sequencing import rebuildSequences
+from datetime import date, timedelta
 import logging
 
 logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
-    help = 'Clear existing sequence database and resync sequences with existing files'
+    help = 'Clear existing sequences and regroup files into sequences, for the whole archive or a date range or instrument'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--gap-hours', type=float, default=12,
+                            help='Start a new sequence when frames are more than this many hours apart (default 12)')
+        parser.add_argument('--date-from', type=date.fromisoformat,
+                            help='Only rebuild sequences of frames taken on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--date-to', type=date.fromisoformat,
+                            help='Only rebuild sequences of frames taken on or before this date (YYYY-MM-DD)')
+        parser.add_argument('--instrument',
+                            help='Only rebuild sequences of frames taken with this imager (INSTRUME)')
+        parser.add_argument('--telescope',
+                            help='Only rebuild sequences of frames taken with this telescope (TELESCOP)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report the sequences that would be created without changing anything')
 
     def handle(self, *args, **kwargs):
-        # Delete all Fits Sequence records
-        fitsSequence.objects.all().delete()
+        if kwargs['date_from'] and kwargs['date_to'] and kwargs['date_from'] > kwargs['date_to']:
+            raise CommandError('--date-from is after --date-to')
 
-        # Remove existing sequence numbers from fitsFile records
-        for fitsFileRecord in fitsFile.objects.all():
-            fitsFileRecord.fitsFileSequence = None
-            fitsFileRecord.save()
+        # Select the frames to regroup, None rebuilds the whole archive
+        frames = None
+        if kwargs['date_from'] or kwargs['date_to'] or kwargs['instrument'] or kwargs['telescope']:
+            frames = fitsFile.objects.all()
+            if kwargs['date_from']:
+                frames = frames.filter(fitsFileDate__date__gte=kwargs['date_from'])
+            if kwargs['date_to']:
+                frames = frames.filter(fitsFileDate__date__lte=kwargs['date_to'])
+            if kwargs['instrument']:
+                frames = frames.filter(fitsFileInstrument=kwargs['instrument'])
+            if kwargs['telescope']:
+                frames = frames.filter(fitsFileTelescop=kwargs['telescope'])
 
-        # Register all FITS files in the repo
-        postProcess=PostProcess()
-        logger.info('Creating light sequences')
-        lightSeqCreated=postProcess.createLightSequences()
-        logger.info('Creating calibration sequences')
-        calSeqCreated=  postProcess.createCalibrationSequences()
-        
-        # Fix the fitsObject field for all FitsSequence records
-        #logger.info('Fixing fitsObject field for all FitsSequence records')
-        #for sequence in fitsSequence.objects.all():
-        #    new_name = sequence.fitsSequenceObjectName.replace(' ', '').replace('_', '')
-        #    sequence.fitsSequenceObjectName = new_name
-        #    sequence.save()
-        #    logger.info(f'Updated fitsSequenceObjectName for sequence ID {sequence.fitsSequenceId} to {new_name}')
+        plan = rebuildSequences(frames, gap=timedelta(hours=kwargs['gap_hours']), dryRun=kwargs['dry_run'])
 
         # Print a summary of all tasks performed
-        logger.info('Light sequences discovered: '+str(len(lightSeqCreated)))
-        logger.info('Calibration sequences discovered: '+str(len(calSeqCreated)))
-        
-        self.stdout.write(self.style.SUCCESS('Successfully create sequences. See log for details.'))
\ No newline at end of file
+        if kwargs['dry_run']:
+            for planned in plan:
+                name = planned['fields'].get('fitsFileObject') or planned['type']
+                self.stdout.write(f"{planned['type']:6} {str(name):20} {str(planned['fields'].get('fitsFileTelescop')):20} "
+                                  f"{str(planned['fields'].get('fitsFileInstrument')):20} {planned['start']:%Y-%m-%d %H:%M} "
+                                  f"to {planned['end']:%Y-%m-%d %H:%M} {len(planned['frames']):6} frames")
+        lightSequences = [planned for planned in plan if planned['type'] == 'Light']
+        frameCount = sum(len(planned['frames']) for planned in plan)
+        logger.info('Light sequences discovered: '+str(len(lightSequences)))
+        logger.info('Calibration sequences discovered: '+str(len(plan)-len(lightSequences)))
+        summary = f"{len(lightSequences)} light and {len(plan)-len(lightSequences)} calibration sequences for {frameCount} frames"
+        if kwargs['dry_run']:
+            self.stdout.write(self.style.SUCCESS('Dry run, would create ' + summary + '. Nothing was changed.'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Successfully created ' + summary + '. See log for details.'))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from observations.postProcess import PostProcess
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Hash registered FITS files that have no content hash yet and remove exact copies from the repo'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes used to hash files (default 1)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of files hashed and written to the database per batch (default 500)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='List the copies that would be removed without changing anything')
+
+    def handle(self, *args, **kwargs):
+        results = PostProcess().dedupeRepository(workers=kwargs['workers'], batchSize=kwargs['batch_size'], dryRun=kwargs['dry_run'])
+
+        # Print a summary of all tasks performed
+        if kwargs['dry_run']:
+            for fileName in results['removed']:
+                self.stdout.write(fileName)
+        logger.info('Files hashed: '+str(results['hashed']))
+        logger.info('Copies found: '+str(results['duplicates']))
+        summary = f"{results['duplicates']} copies using {results['bytes']/1024**2:.1f} MB, {results['hashed']} files hashed"
+        if results['missing']:
+            summary += f", {results['missing']} registered files missing"
+        if kwargs['dry_run']:
+            self.stdout.write(self.style.SUCCESS('Dry run, found ' + summary + '. Nothing was changed.'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Removed ' + summary + '. See log for details.'))
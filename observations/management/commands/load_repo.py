@@ -8,9 +8,18 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = 'Load all new FITS files into the repo and save database records'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes used to parse headers and create thumbnails (default 1)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of files written to the database per transaction (default 500)')
+        parser.add_argument('--remove-duplicates', action='store_true',
+                            help='Delete files that are exact copies of registered files instead of moving them to the Duplicates folder')
+
     def handle(self, *args, **kwargs):
         postProcess=    PostProcess()
-        registered=     postProcess.registerFitsImages()
+        postProcess.removeDuplicates=kwargs['remove_duplicates']
+        registered=     postProcess.registerFitsImages(workers=kwargs['workers'],batchSize=kwargs['batch_size'])
         lightSeqCreated=postProcess.createLightSequences()
         calSeqCreated=  postProcess.createCalibrationSequences()
         #calibrated=     postProcess.calibrateAllFitsImages()
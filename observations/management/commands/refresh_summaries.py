@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from observations.models import fitsSequence
+from observations.summaries import refreshSequenceStats, refreshObjectSummaries
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Rebuild the sequence statistics and per-object summaries, for every object or just the ones named'
+
+    def add_arguments(self, parser):
+        parser.add_argument('objects', nargs='*',
+                            help='Object names to refresh (default every object)')
+
+    def handle(self, *args, **kwargs):
+        sequenceIds = None
+        if kwargs['objects']:
+            sequenceIds = fitsSequence.objects.filter(fitsSequenceObjectName__in=kwargs['objects']).values_list('fitsSequenceId', flat=True)
+        sequences = refreshSequenceStats(sequenceIds)
+        written = refreshObjectSummaries(kwargs['objects'] or None)
+        logger.info('Sequence statistics refreshed: '+str(sequences)+', object summaries refreshed: '+str(written))
+        self.stdout.write(self.style.SUCCESS(f'Successfully refreshed {sequences} sequences and {written} object summaries.'))
@@ -6,20 +6,36 @@ import logging
 logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
-    help = 'Clear existing Repo database and resync with existing files'
+    help = 'Clear existing Repo database and resync with existing files, or with --incremental only sync files that changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes used to parse headers and create thumbnails (default 1)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of files written to the database per transaction (default 500)')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Keep existing records and only insert, update or delete records for files that changed')
 
     def handle(self, *args, **kwargs):
-        # Delete all FitsFile records
-        logger.info('Deleting all existing FitsFile and FitsSequence records')
-        fitsFile.objects.all().delete()
-        fitsSequence.objects.all().delete()
+        if not kwargs['incremental']:
+            # Delete all FitsFile records
+            logger.info('Deleting all existing FitsFile and FitsSequence records')
+            fitsFile.objects.all().delete()
+            fitsSequence.objects.all().delete()
 
         # Register all FITS files in the repo
         postProcess=PostProcess()
-        #logger.info('Registering all FITS files in the repo')
-        registered=postProcess.registerFitsImages(moveFiles=False)
+        results=postProcess.syncRepository(workers=kwargs['workers'],batchSize=kwargs['batch_size'],
+                                           full=not kwargs['incremental'])
 
         # Print a summary of all tasks performed
-        logger.info('Files registered: '+str(len(registered)))
-        
-        self.stdout.write(self.style.SUCCESS('Successfully synchronized FITS files in the repo and saved database records. See log for details.'))
\ No newline at end of file
+        logger.info('Files registered: '+str(len(results['inserted'])))
+        logger.info('Files updated: '+str(results['updated']))
+        logger.info('Files deleted: '+str(results['deleted']))
+        logger.info('Files unchanged: '+str(results['unchanged']))
+        print('Files registered: '+str(len(results['inserted'])))
+        print('Files updated: '+str(results['updated']))
+        print('Files deleted: '+str(results['deleted']))
+        print('Files unchanged: '+str(results['unchanged']))
+
+        self.stdout.write(self.style.SUCCESS('Successfully synchronized FITS files in the repo and saved database records. See log for details.'))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from observations.postProcess import PostProcess
+from observations.watcher import openWatcher, IngestDaemon, POLL_INTERVAL, SETTLE_SECONDS, QUEUE_SIZE, BATCH_SIZE
+import logging
+import os
+import signal
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Watch the source folder and load new FITS files into the repo as soon as they are written'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll', action='store_true',
+                            help='Poll the folder instead of using inotify, network mounts are always polled')
+        parser.add_argument('--interval', type=float, default=POLL_INTERVAL,
+                            help=f'Seconds between scans when polling (default {POLL_INTERVAL:g})')
+        parser.add_argument('--settle', type=float, default=SETTLE_SECONDS,
+                            help=f'Seconds a file must go unchanged before it is loaded (default {SETTLE_SECONDS:g})')
+        parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                            help=f'Most files waiting to be loaded before the watcher waits (default {QUEUE_SIZE})')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help=f'Most files loaded per batch (default {BATCH_SIZE})')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes used to parse headers and create thumbnails (default 1)')
+        parser.add_argument('--remove-duplicates', action='store_true',
+                            help='Delete files that are exact copies of registered files instead of moving them to the Duplicates folder')
+
+    def handle(self, *args, **kwargs):
+        postProcess = PostProcess()
+        postProcess.removeDuplicates = kwargs['remove_duplicates']
+        if not postProcess.sourceFolder or not os.path.isdir(postProcess.sourceFolder):
+            raise CommandError('Source folder '+str(postProcess.sourceFolder)+' does not exist, check ppsourcepath in the configuration')
+
+        watcher = openWatcher(postProcess.sourceFolder, poll=kwargs['poll'], interval=kwargs['interval'])
+        daemon = IngestDaemon(postProcess, watcher, settle=kwargs['settle'], queueSize=kwargs['queue_size'],
+                              batchSize=kwargs['batch_size'], workers=kwargs['workers'])
+
+        # Stop cleanly on Ctrl-C or when the service is stopped
+        for signalNumber in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signalNumber, lambda *args: daemon.stop())
+
+        self.stdout.write(f'Watching {postProcess.sourceFolder} with {watcher.name}, Ctrl-C to stop')
+        totals = daemon.run()
+        logger.info(f"Watcher stopped after registering {totals['registered']} of {totals['files']} files")
+        self.stdout.write(self.style.SUCCESS(f"Registered {totals['registered']} of {totals['files']} files in {totals['batches']} batches"))
@@ -0,0 +1,107 @@
+############################################################################################################
+## M A S T E R   C A C H E                                                                                ##
+############################################################################################################
+# Keeps master calibration frames resident while a batch of lights is calibrated. Masters are keyed on the
+# properties that make a master reusable - telescope, instrument, filter (flats), binning, exposure (darks),
+# a CCD-TEMP bucket (bias and darks), gain/offset and a window of local observing nights - so every light in
+# the same window shares one master. Each key maps to a fixed file name in the Masters folder, so masters
+# built by an earlier run are reused from disk, and the arrays themselves are held in a small in-process LRU.
+#
+from collections import OrderedDict
+from django.utils import timezone
+from datetime import datetime,time,timedelta
+import hashlib
+import os
+
+import logging
+logging=logging.getLogger(__name__)
+
+# Fields of the light frame each master type depends on
+KEY_FIELDS={
+    'Bias': ['fitsFileTelescop','fitsFileInstrument','fitsFileXBinning','fitsFileYBinning','fitsFileGain','fitsFileOffset'],
+    'Dark': ['fitsFileTelescop','fitsFileInstrument','fitsFileXBinning','fitsFileYBinning','fitsFileGain','fitsFileOffset','fitsFileExpTime'],
+    'Flat': ['fitsFileTelescop','fitsFileInstrument','fitsFileFilter','fitsFileXBinning','fitsFileYBinning','fitsFileGain','fitsFileOffset'],
+}
+TEMPERATURE_TYPES=['Bias','Dark']
+
+class MasterFrameCache(object):
+    def __init__(self,masterFolder,windowDays=1,temperatureBucket=2.0,maxEntries=6,maxBytes=2*1024*1024*1024):
+        self.masterFolder=masterFolder
+        self.windowDays=windowDays
+        self.temperatureBucket=temperatureBucket
+        self.maxEntries=maxEntries
+        self.maxBytes=maxBytes
+        self.entries=OrderedDict()
+        self.bytes=0
+        self.hits=0
+        self.misses=0
+
+    #############################################################################################################
+    ## window - the first night and the end of the window of nights a frame date falls in. A night runs from  ##
+    ##          noon to noon so a whole session lands in one window                                           ##
+    #############################################################################################################
+    def window(self,frameDate):
+        localDate=timezone.localtime(frameDate) if timezone.is_aware(frameDate) else frameDate
+        night=(localDate-timedelta(hours=12)).date()
+        start=night-timedelta(days=night.toordinal()%self.windowDays)
+        end=datetime.combine(start+timedelta(days=self.windowDays),time(12),tzinfo=localDate.tzinfo)
+        return start,end
+
+    #############################################################################################################
+    ## temperature - the CCD-TEMP of a frame rounded to the bucket size                                       ##
+    #############################################################################################################
+    def temperature(self,ccdTemp):
+        try:
+            return round(round(float(ccdTemp)/self.temperatureBucket)*self.temperatureBucket,1)
+        except (TypeError, ValueError):
+            return None
+
+    #############################################################################################################
+    ## temperatureRange - the CCD-TEMP range of the bucket a frame falls in, or None if it has no CCD-TEMP    ##
+    #############################################################################################################
+    def temperatureRange(self,ccdTemp):
+        bucket=self.temperature(ccdTemp)
+        if bucket is None:
+            return None
+        return bucket-self.temperatureBucket/2,bucket+self.temperatureBucket/2
+
+    #############################################################################################################
+    ## key - the cache key of the master of a type that applies to a light frame                              ##
+    #############################################################################################################
+    def key(self,frameType,lightFrame):
+        values=[frameType]+[str(getattr(lightFrame,field)) for field in KEY_FIELDS[frameType]]
+        if frameType in TEMPERATURE_TYPES:
+            values.append(str(self.temperature(lightFrame.fitsFileCCDTemp)))
+        values.append(self.window(lightFrame.fitsFileDate)[0].isoformat())
+        return tuple(values)
+
+    def path(self,key):
+        digest=hashlib.sha1("|".join(key).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.masterFolder,f'master_{key[0].lower()}_{digest}.fits')
+
+    #############################################################################################################
+    ## get / put - the in-process LRU of loaded masters, entries are (fitsFileId, data)                       ##
+    #############################################################################################################
+    def get(self,key):
+        entry=self.entries.get(key)
+        if entry is None:
+            self.misses+=1
+            return None
+        self.hits+=1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self,key,fitsFileId,data):
+        if key in self.entries:
+            self.bytes-=self.entries.pop(key)[1].nbytes
+        self.entries[key]=(fitsFileId,data)
+        self.bytes+=data.nbytes
+        while len(self.entries)>1 and (len(self.entries)>self.maxEntries or self.bytes>self.maxBytes):
+            evictedKey,(evictedId,evictedData)=self.entries.popitem(last=False)
+            self.bytes-=evictedData.nbytes
+            logging.info("Evicted master "+str(evictedId)+" from cache")
+        return self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes=0
@@ -0,0 +1,138 @@
+############################################################################################################
+## M A S T E R   C O M B I N E                                                                            ##
+############################################################################################################
+# Combines a stack of calibration frames into a master frame. The frames are memory mapped and combined a
+# band of rows at a time, so the memory used is set by the budget and not by the number or size of frames.
+# Supported methods are median, mean and sigma clipped mean. Work is done in float32 unless the inputs are
+# float64, so a stack of 16 bit frames never turns into a float64 cube.
+#
+from astropy.io import fits
+import numpy as np
+
+import logging
+logging=logging.getLogger(__name__)
+
+COMBINE_METHODS=['median','mean','sigmaclip']
+DEFAULT_MEMORY_BUDGET=512*1024*1024
+
+# Working copies made while reducing a tile, on top of the tile itself
+TILE_OVERHEAD=3
+
+#################################################################################################################
+## openFrame - this function memory maps the primary data of a frame without applying BSCALE/BZERO, so slicing ##
+##             a band of rows only reads those rows from disk                                                   ##
+#################################################################################################################
+def openFrame(fileName):
+    hdul=fits.open(fileName,memmap=True,do_not_scale_image_data=True)
+    hdr=hdul[0].header
+    return hdul,hdul[0].data,float(hdr.get('BSCALE',1.0)),float(hdr.get('BZERO',0.0))
+
+#################################################################################################################
+## frameScale - this function returns the factor that normalises a frame, less any offset, to a median of 1,   ##
+##              estimated from a sparse sample of pixels                                                       ##
+#################################################################################################################
+def frameScale(data,bscale,bzero,offset=None,step=16):
+    sample=data[::step,::step].astype(np.float32)*bscale+bzero
+    if offset is not None:
+        sample-=offset[::step,::step]
+    median=float(np.median(sample))
+    if median==0:
+        return 1.0
+    return 1.0/median
+
+#################################################################################################################
+## reduceTile - this function reduces a (frames, rows, columns) cube along the frame axis                      ##
+#################################################################################################################
+def reduceTile(cube,method,sigma,iterations):
+    if method=='median':
+        return np.median(cube,axis=0)
+    if method=='mean':
+        return cube.mean(axis=0,dtype=cube.dtype)
+
+    # Sigma clipped mean, clipped pixels become NaN so they drop out of the statistics
+    for _ in range(iterations):
+        center=np.nanmedian(cube,axis=0)
+        spread=np.nanstd(cube,axis=0)
+        clipped=np.abs(cube-center)>sigma*spread
+        if not clipped.any():
+            break
+        cube[clipped]=np.nan
+    return np.nanmean(cube,axis=0)
+
+#################################################################################################################
+## combineFrames - this function combines the primary images of a list of FITS files. An offset frame such as  ##
+##                 a master bias is subtracted from each frame before it is normalised. Returns the combined   ##
+##                 array and the number of frames used, or (None, 0) if no frames could be read                ##
+#################################################################################################################
+def combineFrames(fileNames,method='median',memoryBudget=DEFAULT_MEMORY_BUDGET,sigma=3.0,iterations=5,normalise=False,offset=None):
+    if method not in COMBINE_METHODS:
+        raise ValueError("Unknown combine method "+str(method)+", expected one of "+", ".join(COMBINE_METHODS))
+
+    frames=[]
+    shape=None
+    try:
+        for fileName in fileNames:
+            try:
+                hdul,data,bscale,bzero=openFrame(fileName)
+            except Exception as e:
+                logging.info(f"Failed to read frame {fileName}: {e}")
+                continue
+            if data is None or data.ndim!=2:
+                logging.info(f"Frame {fileName} has no 2D image, skipped")
+                hdul.close()
+                continue
+            if shape is None:
+                shape=data.shape
+            elif data.shape!=shape:
+                logging.warning(f"Frame {fileName} is {data.shape}, expected {shape}, skipped")
+                hdul.close()
+                continue
+            frames.append((hdul,data,bscale,bzero))
+
+        if not frames:
+            return None,0
+
+        # Keep float64 only if that is what we were given
+        workType=np.float64 if any(data.dtype==np.float64 for hdul,data,bscale,bzero in frames) else np.float32
+        if offset is not None and offset.shape!=shape:
+            logging.warning(f"Offset frame is {offset.shape}, expected {shape}, not subtracted")
+            offset=None
+        scales=[frameScale(data,bscale,bzero,offset) if normalise else 1.0 for hdul,data,bscale,bzero in frames]
+
+        height,width=shape
+        rowBytes=len(frames)*width*np.dtype(workType).itemsize*(1+TILE_OVERHEAD)
+        rowsPerTile=int(max(1,min(height,memoryBudget//rowBytes)))
+        logging.info(f"Combining {len(frames)} frames of {width}x{height} by {method} in bands of {rowsPerTile} rows")
+
+        combined=np.empty(shape,dtype=workType)
+        cube=np.empty((len(frames),rowsPerTile,width),dtype=workType)
+        for y0 in range(0,height,rowsPerTile):
+            y1=min(height,y0+rowsPerTile)
+            tile=cube[:,:y1-y0,:]
+            for i,(hdul,data,bscale,bzero) in enumerate(frames):
+                tile[i]=data[y0:y1]
+                if bscale!=1.0:
+                    tile[i]*=bscale
+                if bzero!=0.0:
+                    tile[i]+=bzero
+                if offset is not None:
+                    tile[i]-=offset[y0:y1]
+                if scales[i]!=1.0:
+                    tile[i]*=scales[i]
+            combined[y0:y1]=reduceTile(tile,method,sigma,iterations)
+        return combined,len(frames)
+    finally:
+        for hdul,data,bscale,bzero in frames:
+            hdul.close()
+
+#################################################################################################################
+## writeMaster - this function writes a combined master frame with a record of how it was made                 ##
+#################################################################################################################
+def writeMaster(data,fileName,imageType,frameCount,method,cards=None):
+    hdu=fits.PrimaryHDU(data)
+    hdu.header['IMAGETYP']=(imageType,'Master calibration frame')
+    hdu.header['NCOMBINE']=(frameCount,'Number of frames combined')
+    hdu.header['COMBMETH']=(method,'Combine method used by Obsy')
+    for keyword,value in (cards or {}).items():
+        hdu.header[keyword]=value
+    hdu.writeto(fileName,overwrite=True)
@@ -0,0 +1,36 @@
+# Generated by Django 6.1.2 on 2026-10-18 11:41
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observations', '0011_scheduledetail_schedulemasterid_and_more'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='schedulemaster',
+            name='telescopeId',
+        ),
+        migrations.AlterField(
+            model_name='fitsfile',
+            name='fitsFileDate',
+            field=models.DateTimeField(default=datetime.datetime(2026, 10, 18, 6, 41, 3, 521042, tzinfo=datetime.timezone.utc)),
+        ),
+        migrations.AlterField(
+            model_name='fitsfile',
+            name='fitsFileName',
+            field=models.CharField(blank=True, db_index=True, default='None', max_length=255, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='fitsfile',
+            index=models.Index(fields=['fitsFileSequence', 'fitsFileName', 'fitsFileId'], name='fitsfile_sequence_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fitsfile',
+            index=models.Index(fields=['fitsFileObject', 'fitsFileName', 'fitsFileId'], name='fitsfile_object_name_idx'),
+        ),
+    ]
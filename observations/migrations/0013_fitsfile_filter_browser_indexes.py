@@ -0,0 +1,36 @@
+# Generated by Django 6.1.2 on 2026-10-18 11:42
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observations', '0012_fitsfile_navigation_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fitsfile',
+            name='fitsFileFilter',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='fitsfile',
+            name='fitsFileDate',
+            field=models.DateTimeField(default=datetime.datetime(2026, 10, 18, 6, 42, 29, 184401, tzinfo=datetime.timezone.utc)),
+        ),
+        migrations.AddIndex(
+            model_name='fitsfile',
+            index=models.Index(fields=['fitsFileType', '-fitsFileDate', '-fitsFileId'], name='fitsfile_type_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fitsfile',
+            index=models.Index(fields=['fitsFileType', 'fitsFileObject', '-fitsFileDate', '-fitsFileId'], name='fitsfile_type_object_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fitsfile',
+            index=models.Index(fields=['fitsFileType', 'fitsFileFilter', '-fitsFileDate', '-fitsFileId'], name='fitsfile_type_filter_date_idx'),
+        ),
+    ]
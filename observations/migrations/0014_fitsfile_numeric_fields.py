@@ -0,0 +1,93 @@
+# Exposure, binning, CCD temperature, gain and offset were stored as text, with "None" for missing values.
+# The numbers are added as new columns, filled from the text in bulk, then take over the original names.
+import math
+from django.db import migrations, models
+
+NUMERIC_FIELDS = {
+    'fitsFileExpTime': float,
+    'fitsFileXBinning': int,
+    'fitsFileYBinning': int,
+    'fitsFileCCDTemp': float,
+    'fitsFileGain': float,
+    'fitsFileOffset': int,
+}
+BATCH_SIZE = 2000
+
+
+def parseNumber(value, cast):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(number):
+        return None
+    return int(round(number)) if cast is int else number
+
+
+def copyFields(apps, sourceSuffix, targetSuffix, convert):
+    fitsFile = apps.get_model('observations', 'fitsFile')
+    sourceFields = [field + sourceSuffix for field in NUMERIC_FIELDS]
+    targetFields = [field + targetSuffix for field in NUMERIC_FIELDS]
+
+    # Walk the table in primary key order so rows are never read while they are being written
+    lastPk = None
+    while True:
+        rows = fitsFile.objects.order_by('pk')
+        if lastPk is not None:
+            rows = rows.filter(pk__gt=lastPk)
+        rows = list(rows.values_list('pk', *sourceFields)[:BATCH_SIZE])
+        if not rows:
+            break
+        records = []
+        for row in rows:
+            record = fitsFile(pk=row[0])
+            for target, value, cast in zip(targetFields, row[1:], NUMERIC_FIELDS.values()):
+                setattr(record, target, convert(value, cast))
+            records.append(record)
+        fitsFile.objects.bulk_update(records, targetFields)
+        lastPk = rows[-1][0]
+
+
+def backfillNumbers(apps, schema_editor):
+    copyFields(apps, '', 'Number', parseNumber)
+
+
+def restoreText(apps, schema_editor):
+    copyFields(apps, 'Number', '', lambda value, cast: "None" if value is None else str(value))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observations', '0013_fitsfile_filter_browser_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(model_name='fitsfile', name='fitsFileExpTimeNumber', field=models.FloatField(null=True, blank=True)),
+        migrations.AddField(model_name='fitsfile', name='fitsFileXBinningNumber', field=models.IntegerField(null=True, blank=True)),
+        migrations.AddField(model_name='fitsfile', name='fitsFileYBinningNumber', field=models.IntegerField(null=True, blank=True)),
+        migrations.AddField(model_name='fitsfile', name='fitsFileCCDTempNumber', field=models.FloatField(null=True, blank=True)),
+        migrations.AddField(model_name='fitsfile', name='fitsFileGainNumber', field=models.FloatField(null=True, blank=True)),
+        migrations.AddField(model_name='fitsfile', name='fitsFileOffsetNumber', field=models.IntegerField(null=True, blank=True)),
+        migrations.RunPython(backfillNumbers, restoreText),
+        migrations.RemoveField(model_name='fitsfile', name='fitsFileExpTime'),
+        migrations.RemoveField(model_name='fitsfile', name='fitsFileXBinning'),
+        migrations.RemoveField(model_name='fitsfile', name='fitsFileYBinning'),
+        migrations.RemoveField(model_name='fitsfile', name='fitsFileCCDTemp'),
+        migrations.RemoveField(model_name='fitsfile', name='fitsFileGain'),
+        migrations.RemoveField(model_name='fitsfile', name='fitsFileOffset'),
+        migrations.RenameField(model_name='fitsfile', old_name='fitsFileExpTimeNumber', new_name='fitsFileExpTime'),
+        migrations.RenameField(model_name='fitsfile', old_name='fitsFileXBinningNumber', new_name='fitsFileXBinning'),
+        migrations.RenameField(model_name='fitsfile', old_name='fitsFileYBinningNumber', new_name='fitsFileYBinning'),
+        migrations.RenameField(model_name='fitsfile', old_name='fitsFileCCDTempNumber', new_name='fitsFileCCDTemp'),
+        migrations.RenameField(model_name='fitsfile', old_name='fitsFileGainNumber', new_name='fitsFileGain'),
+        migrations.RenameField(model_name='fitsfile', old_name='fitsFileOffsetNumber', new_name='fitsFileOffset'),
+        migrations.AddIndex(
+            model_name='fitsfile',
+            index=models.Index(fields=['fitsFileType', 'fitsFileTelescop', 'fitsFileInstrument', 'fitsFileDate'], name='fitsfile_type_scope_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fitsfile',
+            index=models.Index(fields=['fitsFileSequence', 'fitsFileType'], name='fitsfile_sequence_type_idx'),
+        ),
+    ]
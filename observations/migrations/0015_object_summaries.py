@@ -0,0 +1,81 @@
+# Per-object summaries of light sequences for the sequence list, filled here from the existing sequences
+# and frames. Afterwards the sequencing code keeps them up to date.
+import datetime
+from django.db import migrations, models
+from django.db.models import Count, Sum, Max
+
+CALIBRATION_NAMES = ['Bias', 'Dark', 'Flat']
+BATCH_SIZE = 500
+
+
+def buildSummaries(apps, schema_editor):
+    fitsFile = apps.get_model('observations', 'fitsFile')
+    fitsSequence = apps.get_model('observations', 'fitsSequence')
+    fitsObjectSummary = apps.get_model('observations', 'fitsObjectSummary')
+
+    summaries = {}
+    sequenceObject = {}
+    sequences = fitsSequence.objects.exclude(fitsSequenceObjectName__in=CALIBRATION_NAMES).exclude(fitsSequenceObjectName__isnull=True)
+    for sequenceId, name, date, telescope, imager in sequences.values_list(
+            'fitsSequenceId', 'fitsSequenceObjectName', 'fitsSequenceDate', 'fitsSequenceTelescope', 'fitsSequenceImager'):
+        summary = summaries.setdefault(name, fitsObjectSummary(fitsObjectName=name, fitsObjectTelescopes=[], fitsObjectImagers=[]))
+        sequenceObject[sequenceId] = summary
+        summary.fitsObjectSequenceCount += 1
+        if date and (summary.fitsObjectFirstDate is None or date < summary.fitsObjectFirstDate):
+            summary.fitsObjectFirstDate = date
+        if date and (summary.fitsObjectLastDate is None or date > summary.fitsObjectLastDate):
+            summary.fitsObjectLastDate = date
+        if telescope and telescope not in summary.fitsObjectTelescopes:
+            summary.fitsObjectTelescopes.append(telescope)
+        if imager and imager not in summary.fitsObjectImagers:
+            summary.fitsObjectImagers.append(imager)
+
+    sequenceIds = list(sequenceObject)
+    for i in range(0, len(sequenceIds), BATCH_SIZE):
+        rows = (fitsFile.objects.filter(fitsFileSequence__in=sequenceIds[i:i+BATCH_SIZE], fitsFileType="Light")
+                                .values('fitsFileSequence')
+                                .annotate(frames=Count('fitsFileId'), exposure=Sum('fitsFileExpTime'), last=Max('fitsFileDate')))
+        for row in rows:
+            summary = sequenceObject[row['fitsFileSequence']]
+            summary.fitsObjectFrameCount += row['frames']
+            summary.fitsObjectIntegration += row['exposure'] or 0
+            if row['last'] and (summary.fitsObjectLastDate is None or row['last'] > summary.fitsObjectLastDate):
+                summary.fitsObjectLastDate = row['last']
+
+    for summary in summaries.values():
+        summary.fitsObjectTelescopes.sort()
+        summary.fitsObjectImagers.sort()
+    fitsObjectSummary.objects.bulk_create(summaries.values(), batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observations', '0014_fitsfile_numeric_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='fitsObjectSummary',
+            fields=[
+                ('fitsObjectName', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('fitsObjectSequenceCount', models.IntegerField(default=0)),
+                ('fitsObjectFirstDate', models.DateTimeField(blank=True, null=True)),
+                ('fitsObjectLastDate', models.DateTimeField(blank=True, null=True)),
+                ('fitsObjectTelescopes', models.JSONField(default=list)),
+                ('fitsObjectImagers', models.JSONField(default=list)),
+                ('fitsObjectFrameCount', models.IntegerField(default=0)),
+                ('fitsObjectIntegration', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='fitsfile',
+            name='fitsFileDate',
+            field=models.DateTimeField(default=datetime.datetime(2026, 10, 18, 7, 2, 16, 918113, tzinfo=datetime.timezone.utc)),
+        ),
+        migrations.AddIndex(
+            model_name='fitssequence',
+            index=models.Index(fields=['fitsSequenceObjectName', 'fitsSequenceDate'], name='fitssequence_object_date_idx'),
+        ),
+        migrations.RunPython(buildSummaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,100 @@
+# Statistics of each sequence's frames for the sequence detail page, filled here from the existing frames.
+# Afterwards the sequencing and calibration code keeps them up to date.
+import datetime
+from django.db import migrations, models
+from django.db.models import Count, Sum, Min, Max, Q
+
+STATS_TYPES = ['Light', 'Bias', 'Dark', 'Flat']
+BATCH_SIZE = 500
+
+
+def fillStats(apps, schema_editor):
+    fitsFile = apps.get_model('observations', 'fitsFile')
+    fitsSequence = apps.get_model('observations', 'fitsSequence')
+
+    sequenceIds = list(fitsSequence.objects.values_list('fitsSequenceId', flat=True))
+    for i in range(0, len(sequenceIds), BATCH_SIZE):
+        batch = sequenceIds[i:i+BATCH_SIZE]
+        sequences = {sequence.fitsSequenceId: sequence for sequence in fitsSequence.objects.filter(fitsSequenceId__in=batch)}
+        rows = (fitsFile.objects.filter(fitsFileSequence__in=batch, fitsFileType__in=STATS_TYPES)
+                                .values('fitsFileSequence', 'fitsFileFilter')
+                                .annotate(frames=Count('fitsFileId'), exposure=Sum('fitsFileExpTime'),
+                                          tempMin=Min('fitsFileCCDTemp'), tempMax=Max('fitsFileCCDTemp'),
+                                          start=Min('fitsFileDate'), end=Max('fitsFileDate'),
+                                          calibrated=Count('fitsFileId', filter=Q(fitsFileCalibrated=True))))
+        for row in rows:
+            sequence = sequences.get(row['fitsFileSequence'])
+            if sequence is None:
+                continue
+            exposure = row['exposure'] or 0
+            sequence.fitsSequenceFrameCount += row['frames']
+            sequence.fitsSequenceIntegration += exposure
+            sequence.fitsSequenceCalibratedCount += row['calibrated']
+            sequence.fitsSequenceFilters[row['fitsFileFilter'] or 'None'] = {'frames': row['frames'], 'integration': exposure}
+            if row['tempMin'] is not None and (sequence.fitsSequenceTempMin is None or row['tempMin'] < sequence.fitsSequenceTempMin):
+                sequence.fitsSequenceTempMin = row['tempMin']
+            if row['tempMax'] is not None and (sequence.fitsSequenceTempMax is None or row['tempMax'] > sequence.fitsSequenceTempMax):
+                sequence.fitsSequenceTempMax = row['tempMax']
+            if row['start'] and (sequence.fitsSequenceStart is None or row['start'] < sequence.fitsSequenceStart):
+                sequence.fitsSequenceStart = row['start']
+            if row['end'] and (sequence.fitsSequenceEnd is None or row['end'] > sequence.fitsSequenceEnd):
+                sequence.fitsSequenceEnd = row['end']
+        fitsSequence.objects.bulk_update(sequences.values(), ['fitsSequenceFrameCount', 'fitsSequenceIntegration', 'fitsSequenceFilters',
+                                                              'fitsSequenceTempMin', 'fitsSequenceTempMax', 'fitsSequenceStart',
+                                                              'fitsSequenceEnd', 'fitsSequenceCalibratedCount'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observations', '0015_object_summaries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fitssequence',
+            name='fitsSequenceCalibratedCount',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='fitssequence',
+            name='fitsSequenceEnd',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='fitssequence',
+            name='fitsSequenceFilters',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='fitssequence',
+            name='fitsSequenceFrameCount',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='fitssequence',
+            name='fitsSequenceIntegration',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='fitssequence',
+            name='fitsSequenceStart',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='fitssequence',
+            name='fitsSequenceTempMax',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='fitssequence',
+            name='fitsSequenceTempMin',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='fitsfile',
+            name='fitsFileDate',
+            field=models.DateTimeField(default=datetime.datetime(2026, 10, 18, 7, 4, 54, 922772, tzinfo=datetime.timezone.utc)),
+        ),
+        migrations.RunPython(fillStats, migrations.RunPython.noop),
+    ]
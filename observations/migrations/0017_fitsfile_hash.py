@@ -0,0 +1,26 @@
+# Content hash of each file, so ingest can skip exact copies. Files registered before this are hashed by
+# the dedupe_repo command, which also removes the copies it finds.
+# Generated by Django 6.1.2 on 2026-10-18 12:12
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observations', '0016_fitssequence_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fitsfile',
+            name='fitsFileHash',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='fitsfile',
+            name='fitsFileDate',
+            field=models.DateTimeField(default=datetime.datetime(2026, 10, 18, 7, 12, 58, 64943, tzinfo=datetime.timezone.utc)),
+        ),
+    ]
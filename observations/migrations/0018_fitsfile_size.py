@@ -0,0 +1,47 @@
+# Size of each file, which with its observation date picks out the files that might be copies so only those
+# are hashed. Filled here from the files on disk, files that are missing are left without a size.
+import datetime
+import os
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+def fillSizes(apps, schema_editor):
+    fitsFile = apps.get_model('observations', 'fitsFile')
+
+    updates = []
+    for fitsFileId, fileName in fitsFile.objects.values_list('fitsFileId', 'fitsFileName').iterator(chunk_size=5000):
+        try:
+            updates.append(fitsFile(fitsFileId=fitsFileId, fitsFileSize=os.stat(fileName).st_size))
+        except (OSError, TypeError, ValueError):
+            continue
+        if len(updates) >= BATCH_SIZE:
+            fitsFile.objects.bulk_update(updates, ['fitsFileSize'])
+            updates = []
+    fitsFile.objects.bulk_update(updates, ['fitsFileSize'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observations', '0017_fitsfile_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fitsfile',
+            name='fitsFileSize',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='fitsfile',
+            name='fitsFileDate',
+            field=models.DateTimeField(default=datetime.datetime(2026, 10, 18, 7, 27, 40, 162027, tzinfo=datetime.timezone.utc)),
+        ),
+        migrations.AddIndex(
+            model_name='fitsfile',
+            index=models.Index(fields=['fitsFileDate', 'fitsFileSize'], name='fitsfile_date_size_idx'),
+        ),
+        migrations.RunPython(fillSizes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Flats are matched to lights on filter as well as telescope and instrument, so they get an index of their own.
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('observations', '0018_fitsfile_size'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='fitsfile',
+            name='fitsFileDate',
+            field=models.DateTimeField(default=datetime.datetime(2026, 10, 18, 7, 37, 17, 993203, tzinfo=datetime.timezone.utc)),
+        ),
+        migrations.AddIndex(
+            model_name='fitsfile',
+            index=models.Index(fields=['fitsFileType', 'fitsFileTelescop', 'fitsFileInstrument', 'fitsFileFilter', 'fitsFileDate'], name='fitsfile_type_flat_date_idx'),
+        ),
+    ]
@@ -197,21 +197,41 @@ class fitsFile(models.Model):
                                 primary_key=True,
                                 default=uuid.uuid4,
                                 editable=False)
-    fitsFileName        = models.CharField(max_length=255, default="None",null=True, blank=True) 
+    fitsFileName        = models.CharField(max_length=255, default="None",null=True, blank=True, db_index=True)
     fitsFileDate        = models.DateTimeField(default=datetime.now().replace(tzinfo=pytz.UTC))
     fitsFileCalibrated  = models.BooleanField(default=False)
     fitsFileType        = models.CharField(max_length=255, default="None",null=True, blank=True)
     fitsFileStacked     = models.BooleanField(default=False)
     fitsFileObject      = models.CharField(max_length=255, default="None",null=True, blank=True)
-    fitsFileExpTime     = models.CharField(max_length=255, default="None",null=True, blank=True)
-    fitsFileXBinning    = models.CharField(max_length=255, default="None",null=True, blank=True)
-    fitsFileYBinning    = models.CharField(max_length=255, default="None",null=True, blank=True)
-    fitsFileCCDTemp     = models.CharField(max_length=255, default="None",null=True, blank=True)
+    fitsFileExpTime     = models.FloatField(null=True, blank=True)
+    fitsFileXBinning    = models.IntegerField(null=True, blank=True)
+    fitsFileYBinning    = models.IntegerField(null=True, blank=True)
+    fitsFileCCDTemp     = models.FloatField(null=True, blank=True)
     fitsFileTelescop    = models.CharField(max_length=255, default="None",null=True, blank=True)
     fitsFileInstrument  = models.CharField(max_length=255, default="None",null=True, blank=True)
-    fitsFileGain        = models.CharField(max_length=255, default="None",null=True, blank=True)
-    fitsFileOffset      = models.CharField(max_length=255, default="None",null=True, blank=True)
+    fitsFileFilter      = models.CharField(max_length=255, null=True, blank=True)
+    fitsFileGain        = models.FloatField(null=True, blank=True)
+    fitsFileOffset      = models.IntegerField(null=True, blank=True)
     fitsFileSequence    = models.UUIDField(max_length=255, null=True, blank=True)
+    fitsFileHash        = models.CharField(max_length=64, null=True, blank=True, unique=True)   # BLAKE2b of the file's bytes
+    fitsFileSize        = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Keyset navigation within a sequence or an object
+            models.Index(fields=['fitsFileSequence', 'fitsFileName', 'fitsFileId'], name='fitsfile_sequence_name_idx'),
+            models.Index(fields=['fitsFileObject', 'fitsFileName', 'fitsFileId'], name='fitsfile_object_name_idx'),
+            # FITS file browser, newest first within a type and optionally an object or filter
+            models.Index(fields=['fitsFileType', '-fitsFileDate', '-fitsFileId'], name='fitsfile_type_date_idx'),
+            models.Index(fields=['fitsFileType', 'fitsFileObject', '-fitsFileDate', '-fitsFileId'], name='fitsfile_type_object_date_idx'),
+            models.Index(fields=['fitsFileType', 'fitsFileFilter', '-fitsFileDate', '-fitsFileId'], name='fitsfile_type_filter_date_idx'),
+            # Calibration frame matching, flats also on filter, and the frames of a sequence
+            models.Index(fields=['fitsFileType', 'fitsFileTelescop', 'fitsFileInstrument', 'fitsFileDate'], name='fitsfile_type_scope_date_idx'),
+            models.Index(fields=['fitsFileType', 'fitsFileTelescop', 'fitsFileInstrument', 'fitsFileFilter', 'fitsFileDate'], name='fitsfile_type_flat_date_idx'),
+            models.Index(fields=['fitsFileSequence', 'fitsFileType'], name='fitsfile_sequence_type_idx'),
+            # Possible copies, which share their observation date and size
+            models.Index(fields=['fitsFileDate', 'fitsFileSize'], name='fitsfile_date_size_idx'),
+        ]
 
     def __str__(self):
         return f"{self.fitsFileName}"
@@ -225,7 +245,8 @@ class fitsFile(models.Model):
         return self.fitsFileObject
     
 ##################################################################################################
-## fitsSequence - this model records a sequence of files and the calibration master files used  ##
+## fitsSequence - this model records a sequence of files and the calibration master files used, ##
+##                with statistics of its frames kept up to date by summaries.py                 ##
 ##################################################################################################
 class fitsSequence(models.Model):
     fitsSequenceId        = models.UUIDField(
@@ -239,7 +260,52 @@ class fitsSequence(models.Model):
     fitsMasterBias       = models.CharField(max_length=255, null=True, blank=True)
     fitsMasterDark       = models.CharField(max_length=255, null=True, blank=True)
     fitsMasterFlat       = models.UUIDField(max_length=255, null=True, blank=True)
+    fitsSequenceFrameCount      = models.IntegerField(default=0)
+    fitsSequenceIntegration     = models.FloatField(default=0)      # Seconds
+    fitsSequenceFilters         = models.JSONField(default=dict)    # Filter name to frames and integration
+    fitsSequenceTempMin         = models.FloatField(null=True, blank=True)
+    fitsSequenceTempMax         = models.FloatField(null=True, blank=True)
+    fitsSequenceStart           = models.DateTimeField(null=True, blank=True)
+    fitsSequenceEnd             = models.DateTimeField(null=True, blank=True)
+    fitsSequenceCalibratedCount = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # The sequences of the objects on a page of the sequence list
+            models.Index(fields=['fitsSequenceObjectName', 'fitsSequenceDate'], name='fitssequence_object_date_idx'),
+        ]
 
     def __str__(self):
         return f"{self.fitsSequenceId}"
+
+    @property
+    def integrationHours(self):
+        return self.fitsSequenceIntegration / 3600
+
+    @property
+    def calibratedPercent(self):
+        if not self.fitsSequenceFrameCount:
+            return 0
+        return round(100 * self.fitsSequenceCalibratedCount / self.fitsSequenceFrameCount)
     
+
+#################################################################################################################
+## fitsObjectSummary - the light sequences of an object rolled up for the sequence list, kept up to date as    ##
+##                     sequences are created and frames assigned (see summaries.py)                            ##
+#################################################################################################################
+class fitsObjectSummary(models.Model):
+    fitsObjectName          = models.CharField(max_length=255, primary_key=True)
+    fitsObjectSequenceCount = models.IntegerField(default=0)
+    fitsObjectFirstDate     = models.DateTimeField(null=True, blank=True)
+    fitsObjectLastDate      = models.DateTimeField(null=True, blank=True)
+    fitsObjectTelescopes    = models.JSONField(default=list)
+    fitsObjectImagers       = models.JSONField(default=list)
+    fitsObjectFrameCount    = models.IntegerField(default=0)
+    fitsObjectIntegration   = models.FloatField(default=0)      # Seconds of light frames
+
+    def __str__(self):
+        return f"{self.fitsObjectName}"
+
+    @property
+    def integrationHours(self):
+        return self.fitsObjectIntegration / 3600
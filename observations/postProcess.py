@@ -8,20 +8,34 @@
 from obsy import config
 from observations.models import fitsFile,fitsSequence
 from django.utils import timezone
-from django.db import IntegrityError
+from django.db import IntegrityError, DatabaseError, transaction, connections
+from django.core.exceptions import ValidationError
+from django.db.models import Count
 from django.http import HttpResponse
 
 from datetime import datetime,timedelta
 import numpy as np
-import matplotlib.pyplot as plt
 import uuid
 import os
-from math import cos,sin 
 from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from collections import Counter
 import shutil
 import pytz
+import time
 
 from obsy.config import Config
+from observations.ingestWorker import scanFitsFile, contentHash
+from observations.fitsHeader import cardNumber
+from observations.thumbnails import writeThumbnail, pruneThumbnails, THUMBNAIL_SIZE, DEFAULT_FORMAT
+from observations.repoManifest import RepoManifest, MANIFEST_NAME, walkRepository
+from observations.masterCombine import combineFrames, writeMaster, DEFAULT_MEMORY_BUDGET
+from observations.masterCache import MasterFrameCache, KEY_FIELDS, TEMPERATURE_TYPES
+from observations.calibrateWorker import calibrateFrame
+from observations.sequencing import planSequences, applySequencePlan, LIGHT_TYPES, CALIBRATION_TYPES, DEFAULT_GAP
+from observations.fileTransfer import FileTransfer
+from observations.summaries import refreshSequenceStats, refreshObjectSummaries, sequenceObjectNames
 
 import logging
 logging=logging.getLogger(__name__)
@@ -36,26 +50,41 @@ class PostProcess(object):
         self.config = Config()
         self.sourceFolder=self.config.get('ppsourcepath')
         self.repoFolder=self.config.get('pprepopath')
+        self.thumbnailFolder=(self.repoFolder or "")+'Thumbnails/'
+        self.previewFolder=(self.repoFolder or "")+'Previews/'
+        self.combineMemoryBudget=DEFAULT_MEMORY_BUDGET
+        self.masterCache=MasterFrameCache((self.repoFolder or "")+"Masters/")
+        self.fileTransfer=FileTransfer()
+        self.duplicateFolder=(self.repoFolder or "")+'Duplicates/'
+        self.removeDuplicates=False
         logging.info("Post Processing object initialized")
 
+    #################################################################################################################
+    ## buildFitsFile - this function builds an unsaved fitsFile record from the header cards of a file             ##
+    #################################################################################################################
+    def buildFitsFile(self,fileName,hdr,fitsFileId=None,fitsFileHash=None,fitsFileSize=None):
+        newfile=fitsFile(fitsFileName=fileName,fitsFileHash=fitsFileHash,fitsFileSize=fitsFileSize,
+                    fitsFileDate=hdr["DATE-OBS"],fitsFileType=hdr["IMAGETYP"],
+                    fitsFileExpTime=cardNumber(hdr.get("EXPTIME")),fitsFileXBinning=cardNumber(hdr.get("XBINNING"),int),
+                    fitsFileYBinning=cardNumber(hdr.get("YBINNING"),int),fitsFileCCDTemp=cardNumber(hdr.get("CCD-TEMP")),
+                    fitsFileTelescop=hdr["TELESCOP"],fitsFileInstrument=hdr["INSTRUME"],
+                    fitsFileGain=cardNumber(hdr.get("GAIN")),fitsFileOffset=cardNumber(hdr.get("OFFSET"),int),
+                    fitsFileSequence=None)
+        if "OBJECT" in hdr:
+            newfile.fitsFileObject=hdr["OBJECT"]
+        if "FILTER" in hdr:
+            newfile.fitsFileFilter=hdr["FILTER"]
+        if fitsFileId:
+            newfile.fitsFileId=fitsFileId
+        return newfile
+
     #################################################################################################################
     ## submitFileToDB - this function submits a fits file to the database                                          ##
     #################################################################################################################
-    def submitFileToDB(self,fileName,hdr):
+    def submitFileToDB(self,fileName,hdr,fitsFileId=None,fitsFileHash=None,fitsFileSize=None):
         if "DATE-OBS" in hdr:
             # Create new fitsFile record
-            if "OBJECT" in hdr:
-                newfile=fitsFile(fitsFileName=fileName,fitsFileDate=hdr["DATE-OBS"],fitsFileType=hdr["IMAGETYP"],
-                            fitsFileObject=hdr["OBJECT"],fitsFileExpTime=hdr["EXPTIME"],fitsFileXBinning=hdr["XBINNING"],
-                            fitsFileYBinning=hdr["YBINNING"],fitsFileCCDTemp=hdr["CCD-TEMP"],fitsFileTelescop=hdr["TELESCOP"],
-                            fitsFileInstrument=hdr["INSTRUME"],
-                            fitsFileSequence=None)
-            else:
-                newfile=fitsFile(fitsFileName=fileName,fitsFileDate=hdr["DATE-OBS"],fitsFileType=hdr["IMAGETYP"],
-                            fitsFileExpTime=hdr["EXPTIME"],fitsFileXBinning=hdr["XBINNING"],
-                            fitsFileYBinning=hdr["YBINNING"],fitsFileCCDTemp=hdr["CCD-TEMP"],fitsFileTelescop=hdr["TELESCOP"],
-                            fitsFileInstrument=hdr["INSTRUME"],
-                            fitsFileSequence=None)
+            newfile=self.buildFitsFile(fileName,hdr,fitsFileId,fitsFileHash,fitsFileSize)
             newfile.save()
             return newfile.fitsFileId
         else:
@@ -69,138 +98,204 @@ class PostProcess(object):
     #################################################################################################################
     # Note: Movefiles means we are moving from a source folder to the repo, otherwise we are syncing the repo database
     def registerFitsImage(self,root,file,moveFiles):
-        newFitsFileId=None
-        file_name, file_extension = os.path.splitext(os.path.join(root,file))
+        scanned=scanFitsFile(root,file,self.repoFolder,moveFiles)
+        if scanned is None:
+            return None
+        return self.submitScannedFile(scanned,moveFiles)
 
-        # Ignore everything not a *fit* file
-        if "fit" not in file_extension:
-            logging.info("Ignoring file "+os.path.join(root, file)+" with extension -"+file_extension+"-")
-            return False
+    #################################################################################################################
+    ## submitScannedFile - this function registers a file scanned by ingestWorker.scanFitsFile in the database,    ##
+    ##                     moving it into the repository first so the record is only written once the file is     ##
+    ##                     durably in place                                                                        ##
+    #################################################################################################################
+    def submitScannedFile(self,scanned,moveFiles):
+        copyOf=self.copyOf(scanned,self.hashPossibleCopies([scanned]))
+        if copyOf:
+            logging.warning("File is a copy of "+copyOf+", skipping "+scanned['sourceFile'])
+            if moveFiles:
+                self.setAsideCopy(scanned)
+            return None
+        fileName=scanned['fitsFileName']
+        if moveFiles:
+            fileName=self.transferScannedFile(scanned)
+            if fileName is None:
+                return None
 
         try:
-            hdul = fits.open(os.path.join(root, file), mode='update')
-        except ValueError as e:
-            logging.warning("Invalid FITS file. File not processed is "+str(os.path.join(root, file)))
-            return False
-
-        hdr = hdul[0].header
-        if "IMAGETYP" in hdr:
-            # Create an os-friendly date
+            newFitsFileId=self.submitFileToDB(fileName,scanned['header'],scanned['fitsFileId'],scanned['contentHash'],scanned['size'])
+        except (IntegrityError, DatabaseError, ValueError) as e:
+            logging.error("File not added to repo "+scanned['sourceFile']+": "+str(e))
+            newFitsFileId=None
+        if newFitsFileId is None and moveFiles:
+            self.returnScannedFile(scanned,fileName)
+        return newFitsFileId
+
+    #################################################################################################################
+    ## hashPossibleCopies - this function works out the content hash of scanned files that might be copies, those  ##
+    ##                      sharing their observation date and size with a registered file or another file in the  ##
+    ##                      list, and stores it for those registered files that don't have one yet. Other files   ##
+    ##                      are never read in full. Returns the registered files' names by content hash            ##
+    #################################################################################################################
+    def hashPossibleCopies(self,batch):
+        dateField=fitsFile._meta.get_field('fitsFileDate')
+        keys=[]
+        for scanned in batch:
             try:
-                if "DATE-OBS" not in hdr:
-                    logging.warning("No DATE-OBS card in header. File not processed is "+str(os.path.join(root, file)))
-                    return False
-                datestr=hdr["DATE-OBS"].replace("T", " ")
-                datestr=datestr[0:datestr.find('.')]
-                dateobj=datetime.strptime(datestr, '%Y-%m-%d %H:%M:%S')
-                fitsDate=dateobj.strftime("%Y%m%d%H%M%S")
-            except ValueError as e:
-                logging.warning("Invalid date format in header. File not processed is "+str(os.path.join(root, file)))
-                return False
-
-            ############## L I G H T S ################################################################
-            if (hdr["IMAGETYP"]=="Light"):
-                # Adjust the WCS for the image
-                if "CD1_1" not in hdr:
-                    if "CDELT1" in hdr:
-                        fitsCDELT1=float(hdr["CDELT1"])
-                        fitsCDELT2=float(hdr["CDELT2"])
-                        fitsCROTA2=float(hdr["CROTA2"])
-                        fitsCD1_1 =  fitsCDELT1 * cos(fitsCROTA2)
-                        fitsCD1_2 = -fitsCDELT2 * sin(fitsCROTA2)
-                        fitsCD2_1 =  fitsCDELT1 * sin (fitsCROTA2)
-                        fitsCD2_2 = fitsCDELT2 * cos(fitsCROTA2)
-                        hdr.append(('CD1_1', str(fitsCD1_1), 'Adjusted via Obsy'), end=True)
-                        hdr.append(('CD1_2', str(fitsCD1_2), 'Adjusted via Obsy'), end=True)
-                        hdr.append(('CD2_1', str(fitsCD2_1), 'Adjusted via Obsy'), end=True)
-                        hdr.append(('CD2_2', str(fitsCD2_2), 'Adjusted via Obsy'), end=True)
-                        hdul.flush()  # changes are written back to original.fits
-                    else:
-                        logging.warning("No WCS information in header, file not updated is "+str(os.path.join(root, file)))
-
-                # Standardize the object name and create a new file name
-                if ("OBJECT" in hdr):
-                    # Standardize object name, remove spaces and underscores
-                    objectName=hdr["OBJECT"].replace(' ', '').replace('_', '')
-                    hdr.append(('OBJECT', objectName, 'Adjusted via MCP'), end=True)
-                    hdul.flush()  # changes are written back to original.fits
-                    
-                    if ("FILTER" in hdr):
-                        newName="{0}-{1}-{2}-{3}-{4}-{5}s-{6}x{7}-t{8}.fits".format(hdr["OBJECT"].replace(" ", "_"),hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
-                                    hdr["INSTRUME"].replace(" ", "_"),hdr["FILTER"],fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
-                    else:
-                        newName=newName="{0}-{1}-{2}-{3}-{4}-{5}s-{6}x{7}-t{8}.fits".format(hdr["OBJECT"].replace(" ", "_"),hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
-                                    hdr["INSTRUME"].replace(" ", "_"),"OSC",fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
-                else:
-                    logging.warning("Invalid object name in header. File not processed is "+str(os.path.join(root, file)))
-                    return False
-            ############## F L A T S #############################################################################            
-            elif hdr["IMAGETYP"]=="Flat":
-                if ("FILTER" in hdr):
-                    newName="{0}-{1}-{2}-{3}-{4}-{5}s-{6}x{7}-t{8}.fits".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
-                                    hdr["INSTRUME"].replace(" ", "_"),hdr["FILTER"],fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
-                else:
-                    newName=newName="{0}-{1}-{2}-{3}-{4}-{5}s-{6}x{7}-t{8}.fits".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
-                                    hdr["INSTRUME"].replace(" ", "_"),"OSC",fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
-            
-            ############## D A R K S / B I A S E S ################################################################   
-            elif hdr["IMAGETYP"]=="Dark" or hdr["IMAGETYP"]=="Bias":
-                newName="{0}-{1}-{1}-{2}-{3}s-{4}x{5}-t{6}.fits".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
-                                    hdr["INSTRUME"].replace(" ", "_"),fitsDate,hdr["EXPTIME"],hdr["XBINNING"],hdr["YBINNING"],hdr["CCD-TEMP"])
-            else:
-                logging.warning("File not processed as IMAGETYP -"+hdr["IMAGETYP"]+"- not recognized: "+str(os.path.join(root, file)))
-            hdul.close()
-            newPath=""
-
-            ######################################################################################################
-            # Create the folder structure (if needed)
-            fitsDate=dateobj.strftime("%Y%m%d")
-            if (hdr["IMAGETYP"]=="Light"):
-                newPath=self.repoFolder+"Light/{0}/{1}/{2}/{3}/".format(hdr["OBJECT"].replace(" ", ""),hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
-                                    hdr["INSTRUME"].replace(" ", "_"),fitsDate)
-            elif hdr["IMAGETYP"]=="Dark ":
-                newPath=self.repoFolder+"Calibrate/{0}/{1}/{2}/{3}/{4}/".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
-                                    hdr["INSTRUME"].replace(" ", "_"),hdr["EXPTIME"],fitsDate)
-            elif hdr["IMAGETYP"]=="Flat":
-                if ("FILTER" in hdr):
-                    newPath=self.repoFolder+"Calibrate/{0}/{1}/{2}/{3}/{4}/".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
-                                    hdr["INSTRUME"].replace(" ", "_"),hdr["FILTER"],fitsDate)
-                else:
-                    newPath=self.repoFolder+"Calibrate/{0}/{1}/{2}/{3}/{4}/".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
-                                    hdr["INSTRUME"].replace(" ", "_"),"OSC",fitsDate)
-            elif hdr["IMAGETYP"]=="Bias":
-                newPath=self.repoFolder+"Calibrate/{0}/{1}/{2}/{3}/".format(hdr["IMAGETYP"],hdr["TELESCOP"].replace(" ", "_").replace("\\", "_"),
-                                    hdr["INSTRUME"].replace(" ", "_"),fitsDate)
-            else:
-                logging.warning("File not processed as IMAGETYP not recognized: "+str(os.path.join(root, file)))
-                return None
+                keys.append((dateField.get_prep_value(scanned['header']['DATE-OBS']),scanned['size']))
+            except (KeyError, ValidationError):
+                keys.append(None)
+        keyCounts=Counter(key for key in keys if key)
+
+        # Registered files with the same date and size, the date narrows the query and the size is matched here
+        registered={}
+        dates=list({date for date,size in keyCounts})
+        for i in range(0,len(dates),500):
+            rows=fitsFile.objects.filter(fitsFileDate__in=dates[i:i+500]).values_list('fitsFileDate','fitsFileSize','fitsFileId',
+                                                                                      'fitsFileName','fitsFileHash')
+            for row in rows:
+                if row[:2] in keyCounts:
+                    registered.setdefault(row[:2],[]).append(row[2:])
+
+        seenHashes={}
+        updates=[]
+        for rows in registered.values():
+            for fitsFileId,fileName,fileHash in rows:
+                if fileHash is None:
+                    fileHash=contentHash(fileName)
+                    if fileHash is None or fileHash in seenHashes:
+                        # Missing, or a copy itself which is left to dedupe_repo
+                        continue
+                    updates.append(fitsFile(fitsFileId=fitsFileId,fitsFileHash=fileHash))
+                seenHashes.setdefault(fileHash,fileName)
+        if updates:
+            try:
+                with transaction.atomic():
+                    fitsFile.objects.bulk_update(updates,['fitsFileHash'])
+            except IntegrityError as e:
+                logging.warning("Content hashes of registered files not stored: "+str(e))
 
-            if not os.path.isdir(newPath) and moveFiles:
-                os.makedirs (newPath)
+        for scanned,key in zip(batch,keys):
+            if key and (key in registered or keyCounts[key] > 1):
+                scanned['contentHash']=contentHash(scanned['sourceFile'])
+        return seenHashes
 
-            # If we can add the file to the database move it to the repo
-            newFitsFileId=self.submitFileToDB(newPath+newName.replace(" ", "_"),hdr)
-            if (newFitsFileId != None) and moveFiles:
-                if not os.path.exists(newPath+newName):
-                    logging.info("Moving file "+os.path.join(root, file)+" to "+newPath+newName)
-                else:
-                    logging.warning("File already exists in repo - "+newPath+newName)
-                    newName=newName.replace(".fits","_dup.fits")
-                    logging.info("Renaming file to "+newName)              
+    #################################################################################################################
+    ## copyOf - this function returns the name of the registered file a scanned file is a copy of, or None. A      ##
+    ##          registered file isn't a copy of itself                                                             ##
+    #################################################################################################################
+    def copyOf(self,scanned,seenHashes):
+        registeredName=seenHashes.get(scanned['contentHash']) if scanned['contentHash'] else None
+        if registeredName and os.path.normpath(registeredName)!=os.path.normpath(scanned['sourceFile']):
+            return registeredName
+        return None
+
+    #################################################################################################################
+    ## setAsideCopy - this function takes a file found to be a copy of a registered file out of the source folder  ##
+    ##                so it isn't scanned again, moving it under the Duplicates folder of the repository or with   ##
+    ##                removeDuplicates deleting it                                                                 ##
+    #################################################################################################################
+    def setAsideCopy(self,scanned):
+        sourceFile=scanned['sourceFile']
+        try:
+            if self.removeDuplicates:
+                os.remove(sourceFile)
+                logging.info("Removed copy "+sourceFile)
             else:
-                logging.warning("Warning: File not moved to repo is "+str(os.path.join(root, file)))
-        else:
-            logging.warning("File not added to repo - no IMAGETYP card - "+str(os.path.join(root, file)))
+                relative=os.path.relpath(sourceFile,self.sourceFolder) if self.sourceFolder else os.path.basename(sourceFile)
+                if relative.startswith(os.pardir):
+                    relative=os.path.basename(sourceFile)
+                self.fileTransfer.move(sourceFile,os.path.join(self.duplicateFolder,relative))
+        except OSError as e:
+            logging.error("Unable to set aside copy "+sourceFile+": "+str(e))
 
-        return newFitsFileId
+    #################################################################################################################
+    ## transferScannedFile - this function moves a scanned file to its place in the repository. Returns the name   ##
+    ##                       it was stored under, or None if it couldn't be moved                                  ##
+    #################################################################################################################
+    def transferScannedFile(self,scanned):
+        try:
+            return self.fileTransfer.move(scanned['sourceFile'],scanned['fitsFileName'])
+        except OSError as e:
+            logging.error("File not moved to repo "+scanned['sourceFile']+": "+str(e))
+            return None
+
+    #################################################################################################################
+    ## returnScannedFile - this function moves a file whose record couldn't be written back to the source folder  ##
+    ##                     so it is picked up again by the next ingest                                             ##
+    #################################################################################################################
+    def returnScannedFile(self,scanned,fileName):
+        try:
+            self.fileTransfer.move(fileName,scanned['sourceFile'])
+        except OSError as e:
+            logging.error("Unable to return "+fileName+" to "+scanned['sourceFile']+": "+str(e))
+
+    #################################################################################################################
+    ## submitScannedBatch - this function moves a batch of scanned files into the repository and then writes them  ##
+    ## to the database with one bulk insert, so no record points at a file that isn't there. Files already         ##
+    ## registered under the same name, and exact copies of registered files found by their content hash, are       ##
+    ## skipped so they cannot fail the batch. Copies being moved in are set aside. If the bulk insert still fails, ##
+    ## each record is retried on its own so one bad record doesn't lose the rest of the batch, and files whose     ##
+    ## records fail are moved back to the source folder. If kept is given, files skipped because their own        ##
+    ## record is already registered, with the same content, are added to it as source file -> record name.        ##
+    #################################################################################################################
+    def submitScannedBatch(self,batch,moveFiles,kept=None):
+        # Duplicate detection, against the database and within the batch
+        seenHashes=self.hashPossibleCopies(batch)
+        batchNames=[scanned['fitsFileName'] for scanned in batch]
+        seenNames=dict(fitsFile.objects.filter(fitsFileName__in=batchNames).values_list('fitsFileName','fitsFileHash'))
+        records=[]
+        accepted=[]
+        for scanned in batch:
+            if scanned['fitsFileName'] in seenNames and kept is not None:
+                registeredHash=seenNames[scanned['fitsFileName']]
+                # Records from before content hashes belong to the file only if it is at the record's path
+                if (registeredHash==scanned['contentHash'] if registeredHash else
+                    os.path.normpath(scanned['sourceFile'])==os.path.normpath(scanned['fitsFileName'])):
+                    kept[scanned['sourceFile']]=scanned['fitsFileName']
+                    continue
+            copyOf=self.copyOf(scanned,seenHashes)
+            if copyOf:
+                logging.warning("File is a copy of "+copyOf+", skipping "+scanned['sourceFile'])
+                if moveFiles:
+                    self.setAsideCopy(scanned)
+                continue
+            if scanned['fitsFileName'] in seenNames:
+                logging.warning("File already registered, skipping "+scanned['sourceFile']+" as "+scanned['fitsFileName'])
+                continue
+            seenNames[scanned['fitsFileName']]=scanned['contentHash']
+            if scanned['contentHash']:
+                seenHashes[scanned['contentHash']]=scanned['fitsFileName']
+            fileName=scanned['fitsFileName']
+            if moveFiles:
+                fileName=self.transferScannedFile(scanned)
+                if fileName is None:
+                    continue
+            records.append(self.buildFitsFile(fileName,scanned['header'],scanned['fitsFileId'],scanned['contentHash'],scanned['size']))
+            accepted.append(scanned)
+
+        try:
+            with transaction.atomic():
+                fitsFile.objects.bulk_create(records)
+            created=records
+        except (IntegrityError, DatabaseError, ValueError) as e:
+            logging.error("Bulk insert of "+str(len(records))+" files failed, retrying one at a time: "+str(e))
+            created=[]
+            for scanned,record in zip(accepted,records):
+                try:
+                    with transaction.atomic():
+                        record.save(force_insert=True)
+                    created.append(record)
+                except (IntegrityError, DatabaseError, ValueError) as e:
+                    logging.error("File not added to repo "+scanned['sourceFile']+": "+str(e))
+                    if moveFiles:
+                        self.returnScannedFile(scanned,record.fitsFileName)
+        return [record.fitsFileId for record in created]
 
     #################################################################################################################
     ## registerFitsImages - this function scans the images folder and registers all fits files in the database     ##
+    ## workers > 1 parses headers and makes thumbnails in a process pool, the database is only written from here   ##
     #################################################################################################################
-    def registerFitsImages(self,moveFiles=True):
-        registeredFiles=[]
-        newFitsFileId=None
-        
+    def registerFitsImages(self,moveFiles=True,workers=1,batchSize=500):
         # Scan the pictures folder
         if moveFiles:
             logging.info("Processing images in "+self.sourceFolder)
@@ -209,423 +304,535 @@ class PostProcess(object):
             logging.info("Syncronizing images in "+os.path.abspath(self.repoFolder))
             workFolder=self.repoFolder
 
-        for root, dirs, files in os.walk(os.path.abspath(workFolder)):
-            for file in files:
-                logging.info("Processing file "+os.path.join(root, file))
-                if (newFitsFileId := self.registerFitsImage(root,file,moveFiles)) != None:
-                    # Add the file to the list of registered files
-                    registeredFiles.append(newFitsFileId)
-                    self.createThumbnail(newFitsFileId)
+        roots=[]
+        files=[]
+        for root,file,stat in walkRepository(workFolder):
+            roots.append(root)
+            files.append(file)
+        logging.info("Found "+str(len(files))+" files to process with "+str(workers)+" worker(s)")
+
+        registeredFiles=self.submitScanResults(self.scanFiles(roots,files,moveFiles,workers),moveFiles,batchSize)
+        pruneThumbnails(self.thumbnailFolder)
+        return registeredFiles
+
+    #################################################################################################################
+    ## registerFitsFiles - this function registers a list of files, given by their full paths, in the database     ##
+    ##                     the same way registerFitsImages does for a whole folder. Used by the watch_repo daemon  ##
+    #################################################################################################################
+    def registerFitsFiles(self,fileNames,moveFiles=True,workers=1,batchSize=500):
+        roots=[os.path.dirname(fileName) for fileName in fileNames]
+        files=[os.path.basename(fileName) for fileName in fileNames]
+        logging.info("Registering "+str(len(files))+" files with "+str(workers)+" worker(s)")
+        return self.submitScanResults(self.scanFiles(roots,files,moveFiles,workers),moveFiles,batchSize)
+
+    #################################################################################################################
+    ## scanFiles - this function runs ingestWorker.scanFitsFile over a list of files, in a process pool if         ##
+    ##             workers > 1, and yields the results in the order of the files                                   ##
+    #################################################################################################################
+    def scanFiles(self,roots,files,moveFiles,workers=1):
+        scan=partial(scanFitsFile,repoFolder=self.repoFolder,moveFiles=moveFiles,thumbnailFolder=self.thumbnailFolder)
+        if workers > 1:
+            # Forked workers must not share the parent's database connection
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                yield from executor.map(scan,roots,files,chunksize=max(1,min(32,len(files)//(workers*4))))
+        else:
+            yield from map(scan,roots,files)
+
+    #################################################################################################################
+    ## syncRepository - this function brings the database in line with the files in the repository. Files whose   ##
+    ##                  size and modification time match the manifest are skipped without being opened, changed   ##
+    ##                  files are re-registered and records for files no longer on disk are deleted. The manifest ##
+    ##                  only maps a path to a record that was inserted for it or already was its own, and a       ##
+    ##                  record is only deleted once no path maps to it. With full=True the manifest is ignored    ##
+    ##                  and every file is scanned.                                                                 ##
+    #################################################################################################################
+    def syncRepository(self,workers=1,batchSize=500,full=False):
+        results={'inserted':[],'updated':0,'deleted':0,'unchanged':0}
+        manifest=RepoManifest(os.path.join(self.repoFolder,MANIFEST_NAME))
+        if full:
+            manifest.clear()
+        else:
+            manifest.load()
+
+        logging.info("Syncronizing images in "+os.path.abspath(self.repoFolder))
+        roots=[]
+        files=[]
+        stats={}
+        onDisk=set()
+        for root,file,stat in walkRepository(self.repoFolder):
+            path=os.path.join(root,file)
+            onDisk.add(path)
+            if manifest.unchanged(path,stat.st_size,stat.st_mtime_ns):
+                results['unchanged']+=1
+                continue
+            roots.append(root)
+            files.append(file)
+            stats[path]=stat
+        logging.info(str(results['unchanged'])+" files unchanged, "+str(len(files))+" files to scan")
+
+        # Files that have gone from the repository
+        removedNames=[]
+        for path in manifest.paths()-onDisk:
+            entry=manifest.remove(path)
+            if entry['fitsFileName']:
+                removedNames.append(entry['fitsFileName'])
+        results['deleted']=self.deleteUnmappedFiles(removedNames,manifest)
+
+        batch=[]
+        replacedNames=[]
+        for root,file,scanned in zip(roots,files,self.scanFiles(roots,files,False,workers)):
+            path=os.path.join(root,file)
+            entry=manifest.get(path)
+            if scanned is None:
+                # Remember files we can't register so they aren't opened again until they change
+                manifest.record(path,stats[path].st_size,stats[path].st_mtime_ns,None,None)
+                if entry and entry['fitsFileName']:
+                    replacedNames.append(entry['fitsFileName'])
+                continue
+            if entry and entry['headerHash']==scanned['headerHash'] and entry['fitsFileName']==scanned['fitsFileName']:
+                # Only the file stats moved on, the database record is still correct
+                manifest.record(path,scanned['size'],scanned['mtime'],scanned['headerHash'],entry['fitsFileName'])
+                results['unchanged']+=1
+                continue
+            if entry and entry['fitsFileName']:
+                replacedNames.append(entry['fitsFileName'])
+                results['updated']+=1
+            # Mapped to a record once the batch shows whether one was inserted or kept for it
+            manifest.record(path,scanned['size'],scanned['mtime'],scanned['headerHash'],None)
+            batch.append(scanned)
+            if len(batch) >= batchSize:
+                results['inserted']+=self.submitSyncBatch(batch,replacedNames,manifest)
+                batch=[]
+                replacedNames=[]
+        results['inserted']+=self.submitSyncBatch(batch,replacedNames,manifest)
+
+        manifest.save()
+        pruneThumbnails(self.thumbnailFolder)
+        return results
+
+    #################################################################################################################
+    ## submitSyncBatch - this function deletes the records replaced by a batch of changed files, registers the     ##
+    ##                   batch and maps each file's manifest entry to the record inserted or kept for it. Returns  ##
+    ##                   the ids inserted                                                                          ##
+    #################################################################################################################
+    def submitSyncBatch(self,batch,replacedNames,manifest):
+        self.deleteUnmappedFiles(replacedNames,manifest)
+        if not batch:
+            return []
+        kept={}
+        inserted=self.submitScannedBatch(batch,False,kept)
+        insertedIds=set(inserted)
+        for scanned in batch:
+            if scanned['fitsFileId'] in insertedIds:
+                fileName=scanned['fitsFileName']
+            else:
+                fileName=kept.get(scanned['sourceFile'])
+            manifest.record(scanned['sourceFile'],scanned['size'],scanned['mtime'],scanned['headerHash'],fileName)
+        return inserted
+
+    #################################################################################################################
+    ## deleteUnmappedFiles - this function deletes the records for a list of file names that no manifest path      ##
+    ##                       maps to any more. Returns the number deleted                                          ##
+    #################################################################################################################
+    def deleteUnmappedFiles(self,fileNames,manifest):
+        if not fileNames:
+            return 0
+        mapped=manifest.fileNames()
+        return self.deleteRegisteredFiles([fileName for fileName in set(fileNames) if fileName not in mapped])
+
+    #################################################################################################################
+    ## deleteRegisteredFiles - this function deletes the fitsFile records for a list of file names and refreshes   ##
+    ##                         their sequences' statistics and objects' summaries. Thumbnails are left to          ##
+    ##                         pruneThumbnails as another file with the same content may share them                ##
+    #################################################################################################################
+    def deleteRegisteredFiles(self,fileNames):
+        return self.deleteRecords('fitsFileName',fileNames)
+
+    #################################################################################################################
+    ## deleteRecords - this function deletes the fitsFile records whose field is one of a list of values and        ##
+    ##                 refreshes their sequences' statistics and objects' summaries                                ##
+    #################################################################################################################
+    def deleteRecords(self,field,values):
+        deleted=0
+        sequenceIds=set()
+        for i in range(0,len(values),500):
+            frames=fitsFile.objects.filter(**{field+'__in':values[i:i+500]})
+            sequenceIds.update(frames.values_list('fitsFileSequence',flat=True))
+            deleted+=frames.delete()[0]
+        refreshSequenceStats(sequenceIds)
+        refreshObjectSummaries(sequenceObjectNames(sequenceIds))
+        return deleted
+
+    #################################################################################################################
+    ## dedupeRepository - this function hashes the registered files without a content hash that share their        ##
+    ##                    observation date and size with another, or whose size isn't known, and removes exact     ##
+    ##                    copies. For each hash the record that already has it is kept, otherwise the first        ##
+    ##                    file without _dup in its name. Copies are deleted from disk, unless they are the kept    ##
+    ##                    file under another record, and their records deleted. With dryRun nothing is changed.   ##
+    ##                    Hashing runs in a process pool if workers > 1                                            ##
+    #################################################################################################################
+    def dedupeRepository(self,workers=1,batchSize=500,dryRun=False):
+        results={'hashed':0,'missing':0,'duplicates':0,'bytes':0,'removed':[]}
+        # Only files sharing a date and size can be copies
+        shared={(row['fitsFileDate'],row['fitsFileSize']) for row in fitsFile.objects.values('fitsFileDate','fitsFileSize')
+                                                                              .annotate(files=Count('fitsFileId')).filter(files__gt=1)}
+        rows=[(fitsFileId,fileName) for fitsFileId,fileName,date,size in
+              fitsFile.objects.filter(fitsFileHash__isnull=True).values_list('fitsFileId','fitsFileName','fitsFileDate','fitsFileSize')
+              if size is None or (date,size) in shared]
+        rows.sort(key=lambda row: ("_dup" in (row[1] or ""),row[1] or "",str(row[0])))
+        logging.info("Hashing "+str(len(rows))+" registered files with "+str(workers)+" worker(s)")
+
+        # A dry run writes no hashes, so it remembers every hash seen instead of finding earlier batches in the database
+        runHashes={}
+        executor=None
+        if workers > 1:
+            connections.close_all()
+            executor=ProcessPoolExecutor(max_workers=workers)
+        try:
+            for i in range(0,len(rows),batchSize):
+                batch=rows[i:i+batchSize]
+                names=[fileName or "" for fitsFileId,fileName in batch]
+                hashes=list(executor.map(contentHash,names,chunksize=max(1,min(16,len(names)//(workers*4))))) if executor else list(map(contentHash,names))
+
+                keepers=dict(fitsFile.objects.filter(fitsFileHash__in=[h for h in hashes if h]).values_list('fitsFileHash','fitsFileName'))
+                keepers.update(runHashes)
+                updates=[]
+                duplicates=[]
+                for (fitsFileId,fileName),fileHash in zip(batch,hashes):
+                    if fileHash is None:
+                        results['missing']+=1
+                    elif fileHash in keepers:
+                        duplicates.append((fitsFileId,fileName,keepers[fileHash]))
+                    else:
+                        keepers[fileHash]=fileName
+                        updates.append(fitsFile(fitsFileId=fitsFileId,fitsFileHash=fileHash))
+                if dryRun:
+                    runHashes.update((update.fitsFileHash,keepers[update.fitsFileHash]) for update in updates)
                 else:
-                    logging.warning("File not added to repo - no IMAGETYP card - "+str(os.path.join(root, file)))
+                    fitsFile.objects.bulk_update(updates,['fitsFileHash'])
+                results['hashed']+=len(updates)
+                results['duplicates']+=len(duplicates)
+
+                removedIds=[]
+                for fitsFileId,fileName,keeperName in duplicates:
+                    sameFile=os.path.normpath(fileName)==os.path.normpath(keeperName)
+                    size=0 if sameFile else os.path.getsize(fileName)
+                    logging.info(("Would remove " if dryRun else "Removing ")+fileName+", a copy of "+keeperName)
+                    if not dryRun and not sameFile:
+                        try:
+                            os.remove(fileName)
+                        except OSError as e:
+                            logging.error("Unable to remove "+fileName+": "+str(e))
+                            continue
+                    results['bytes']+=size
+                    results['removed'].append(fileName)
+                    removedIds.append(fitsFileId)
+                if not dryRun:
+                    self.deleteRecords('fitsFileId',removedIds)
+        finally:
+            if executor:
+                executor.shutdown()
+        logging.info(f"Hashed {results['hashed']} files, found {results['duplicates']} copies using {results['bytes']} bytes, "
+                     f"{results['missing']} files missing")
+        return results
+
+    #################################################################################################################
+    ## submitScanResults - this function collects scan results into batches and submits them to the database      ##
+    #################################################################################################################
+    def submitScanResults(self,results,moveFiles,batchSize):
+        registeredFiles=[]
+        batch=[]
+        for scanned in results:
+            if scanned is None:
+                continue
+            batch.append(scanned)
+            if len(batch) >= batchSize:
+                registeredFiles+=self.submitScannedBatch(batch,moveFiles)
+                batch=[]
+        if batch:
+            registeredFiles+=self.submitScannedBatch(batch,moveFiles)
         return registeredFiles
 
     #################################################################################################################
-    ## createThumbnail - this function creates a thumbnail image for a fits file and saves it to the repository    ##
+    ## createThumbnail - this function returns the thumbnail of a fits file in the repository, making it if it     ##
+    ##                   doesn't exist yet. Returns the thumbnail path or None                                     ##
     #################################################################################################################
-    def createThumbnail(self,fitsFileId):
+    def createThumbnail(self,fitsFileId,size=THUMBNAIL_SIZE,fmt=DEFAULT_FORMAT):
         # Load the fits file
         fits_file = fitsFile.objects.filter(fitsFileId=fitsFileId).first()
         if not fits_file:
             logging.info(f"Failed to load fits file: {fitsFileId}")
-            return
-        
-        # Read the data from the fits file
-        try:
-            with fits.open(fits_file.fitsFileName) as hdul:
-                data = hdul[0].data
-        except Exception as e:
-            logging.info(f"Failed to read fits file: {e}")
-            return
-        
-        # Create a thumbnail image
-        thumbnail_data = data[::10, ::10]
-
-        # Stretch the image to 0-100
-        thumbnail_data = (thumbnail_data - np.min(thumbnail_data)) / (np.max(thumbnail_data) - np.min(thumbnail_data)) * 100
-        
-        # Save the thumbnail image as a JPG file
-        thumbnail_path = os.path.join(self.repoFolder+'Thumbnails/', f'thumbnail_{fits_file.fitsFileId}.jpg')
+            return None
 
-        try:
-            plt.imsave(thumbnail_path, thumbnail_data, cmap='gray')
-            logging.info(f"Thumbnail image saved to: {thumbnail_path}")
-        except Exception as e:
-            logging.info(f"Failed to save thumbnail image: {e}")
-        
-        return
+        return writeThumbnail(fits_file.fitsFileName,self.thumbnailFolder,size=size,fmt=fmt)
 
     #################################################################################################################
     ## createLightSequences - this function creates sequences for all files not currently assigned to one          ##
     #################################################################################################################
-    def createLightSequences(self):
-        sequencesCreated=[]
-        
-        # Query for all fits files that are not assigned to a sequence
-        unassigned_files = fitsFile.objects.filter(fitsFileSequence__isnull=True,fitsFileType="Light")
-        
-        # How many unassigned_files are there?
-        logging.info("createSequences found "+str(len(unassigned_files))+" unassigned files to sequence")
-
-        # Loop through each unassigned file and create a sequence each time the object changes
-        currentObject= ""
-      
-        for currentFitsFile in unassigned_files:
-            logging.info("Current Object is "+currentFitsFile.fitsFileObject)
-            logging.info("Processing "+str(currentFitsFile.fitsFileName))
-
-            # If the object name has changed, create a new sequence
-            if str(currentFitsFile.fitsFileObject) != currentObject:
-                # Create a new fitsSequence record
-                currentSequenceId = uuid.uuid4()
-                try:
-                    newFitsSequence=fitsSequence(fitsSequenceId=currentSequenceId,
-                                                 fitsSequenceObjectName=currentFitsFile.fitsFileObject,
-                                                 fitsSequenceTelescope=currentFitsFile.fitsFileTelescop,
-                                                 fitsSequenceImager=currentFitsFile.fitsFileInstrument,
-                                                 fitsSequenceDate=currentFitsFile.fitsFileDate.replace(tzinfo=pytz.UTC),
-                                                 fitsMasterBias=None,fitsMasterDark=None,fitsMasterFlat=None)
-                    newFitsSequence.save()
-                    sequencesCreated.append(currentSequenceId)
-                    logging.info("New sequence created for "+str(newFitsSequence.fitsSequenceId))
-                except IntegrityError as e:
-                    # Handle the integrity error
-                    logging.error("IntegrityError: "+str(e))
-                    continue     
-                currentObject = str(currentFitsFile.fitsFileObject)
-            # Assign the current sequence to the fits file
-            currentFitsFile.fitsFileSequence=currentSequenceId
-            currentFitsFile.save()
-            logging.info("Assigned "+str(currentFitsFile.fitsFileName)+" to sequence "+str(currentSequenceId))
-            sequencesCreated.append(currentSequenceId)
-            
-        return sequencesCreated
-        
-    #################################################################################################################
-    ## sameDay - this function returns True if two dates are within 12 hours of each other, False otherwise        ##
-    #################################################################################################################
-    def sameDay(self,Date1,Date2): # If Date1 is within 12 hours of Date2
-        current_date = datetime.strptime(Date1, '%Y-%m-%d')
-        target_date = datetime.strptime(Date2, '%Y-%m-%d')
-        time_difference = abs(current_date - target_date)
-        return time_difference <= timedelta(hours=12)
-    
+    def createLightSequences(self,gap=DEFAULT_GAP):
+        return self.createSequences(LIGHT_TYPES,gap=gap)
+
     #################################################################################################################
     ## createCalibrationSequences - this function creates sequences for all calibration files not currently        ##
     ##                              assigned to one                                                                ##
     #################################################################################################################
-    def createCalibrationSequences(self):
-        createdCalibrationSequences=[]
-        
-        # Query for all calibration files that are not assigned to a sequence
-        unassignedBiases = fitsFile.objects.filter(fitsFileSequence__isnull=True,fitsFileType="Bias")
-        unassignedDarks  = fitsFile.objects.filter(fitsFileSequence__isnull=True,fitsFileType="Dark")
-        unassignedFlats  = fitsFile.objects.filter(fitsFileSequence__isnull=True,fitsFileType="Flat")
-        
-        # How many unassigned_files are there?
-        logging.info("createCalibrationSequences found "+str(len(unassignedBiases))+" unassigned Bias calibration files to sequence")
-        logging.info("createCalibrationSequences found "+str(len(unassignedDarks))+" unassigned Dark calibration files to sequence")
-        logging.info("createCalibrationSequences found "+str(len(unassignedFlats))+" unassigned Flat calibration files to sequence")
-
-        # Bias calibration files
-        currDate="0001-01-01"
-        uuidStr=uuid.uuid4()
-                        
-        for biasFitsFile in unassignedBiases:
-            if not self.sameDay(biasFitsFile.fitsFileDate.strftime('%Y-%m-%d'),currDate):
-                currDate=biasFitsFile.fitsFileDate.strftime('%Y-%m-%d')
-                uuidStr=uuid.uuid4() # New sequence
-                newFitsSequence=fitsSequence(fitsSequenceId=uuidStr,
-                                             fitsSequenceDate=biasFitsFile.fitsFileDate.replace(tzinfo=pytz.UTC),
-                                             fitsSequenceObjectName='Flat',
-                                             fitsMasterBias=None,
-                                             fitsMasterDark=None,
-                                             fitsMasterFlat=None)
-                newFitsSequence.save()
-                logging.info("New date for bias "+currDate) 
-            biasFitsFile.fitsFileSequence=uuidStr
-            biasFitsFile.save()   
-            logging.info("Set sequence for bias "+biasFitsFile.fitsFileName+" to "+str(uuidStr))
-            createdCalibrationSequences.append(uuidStr)
-            
-        # Dark calibration files
-        currDate="0001-01-01"
-        uuidStr=uuid.uuid4()
-        for darkFitsFile in unassignedDarks:
-            if not self.sameDay(darkFitsFile.fitsFileDate.strftime('%Y-%m-%d'),currDate):
-                currDate=darkFitsFile.fitsFileDate.strftime('%Y-%m-%d')
-                uuidStr=uuid.uuid4() # New sequence
-                newFitsSequence=fitsSequence(fitsSequenceId=uuidStr,
-                                             fitsSequenceDate=darkFitsFile.fitsFileDate.replace(tzinfo=pytz.UTC),
-                                             fitsSequenceObjectName='Dark',
-                                             fitsMasterBias=None,
-                                             fitsMasterDark=None,
-                                             fitsMasterFlat=None)
-                newFitsSequence.save()
-                logging.info("New date "+currDate) 
-            darkFitsFile.fitsFileSequence=uuidStr
-            darkFitsFile.save()   
-            logging.info("Set sequence for dark "+darkFitsFile.fitsFileName+" to "+str(uuidStr))
-            createdCalibrationSequences.append(uuidStr)
-            
-        # Flat calibration files
-        currDate="0001-01-01"
-        uuidStr=uuid.uuid4()
-        for flatFitsFile in unassignedFlats:
-            if not self.sameDay(flatFitsFile.fitsFileDate.strftime('%Y-%m-%d'),currDate):
-                currDate=flatFitsFile.fitsFileDate.strftime('%Y-%m-%d')
-                uuidStr=uuid.uuid4() # New sequence
-                newFitsSequence=fitsSequence(fitsSequenceId=uuidStr,
-                                fitsSequenceDate=flatFitsFile.fitsFileDate.replace(tzinfo=pytz.UTC),
-                                fitsSequenceObjectName='Flat',
-                                fitsMasterBias=None,
-                                fitsMasterDark=None,
-                                fitsMasterFlat=None)
-                newFitsSequence.save()
-                logging.info("New date "+currDate) 
-            flatFitsFile.fitsFileSequence=uuidStr
-            flatFitsFile.save()   
-            logging.info("Set sequence for flat "+flatFitsFile.fitsFileName+" to "+str(uuidStr))
-            createdCalibrationSequences.append(uuidStr)
-            
-        return createdCalibrationSequences
-
-    #################################################################################################################
-    ## calibrateFitsFile - this function calibrates a light IMAGETYP using master bias, dark, and flat IMAGETYPs. If     ##
-    ##                     the master IMAGETYPs do not exist, they are created for the sequence.                      ##
-    #################################################################################################################
-    def calibrateFitsImage(self,targetFitsFile):
-        # Check for a fitsSequence record for the light IMAGETYP
-        currFitsSequenceNo = targetFitsFile.fitsFileSequence
+    def createCalibrationSequences(self,gap=DEFAULT_GAP):
+        return self.createSequences(CALIBRATION_TYPES,gap=gap)
 
-        if not currFitsSequenceNo:
-            logging.info(f"No fitsSequence record found for light IMAGETYP: {targetFitsFile.fitsFileId}, run the sync_repo command")
-            return
-        else:
-            # Load the fitsSequence record corresponding to the light IMAGETYP
-            currFitsSequence = fitsSequence.objects.filter(fitsSequenceId=currFitsSequenceNo).first()
-
-        # If the master bias, dark, and flat IMAGETYPs do not exist, create them
-        if not currFitsSequence.fitsMasterBias:
-            currFitsSequence.fitsMasterBias = self.createMasterBias(targetFitsFile)
-            if not currFitsSequence.fitsMasterBias:
-                logging.info(f"Failed to create master bias IMAGETYP for light IMAGETYP: {targetFitsFile.fitsFileId}")
-                return None
-        #if not currFitsSequence.fitsMasterDark:
-        #    currFitsSequence.fitsMasterDark = self.createMasterDark(targetFitsFile)
-        #    if not currFitsSequence.fitsMasterDark:
-        #        logging.info(f"Failed to create master dark IMAGETYP for light IMAGETYP: {targetFitsFile.fitsFileId}")
-        #        return None            
-        #if not currFitsSequence.fitsMasterFlat:
-        #    currFitsSequence.fitsMasterFlat = self.createMasterFlat(targetFitsFile)   
-    
-        # Save the fitsSequence record in the database
-        try:
-            currFitsSequence.save()
-            logging.info(f"fitsSequence record saved: {currFitsSequence.fitsSequenceId}")
-        except Exception as e:
-            logging.info(f"Failed to save fitsSequence record: {e}")
-            return
-        
-        return None
-        # Load the master bias, dark, and flat IMAGETYPs
-        master_bias = fitsFile.objects.filter(fitsFileName=currFitsSequence.fitsMasterBias).first()
-        #master_dark = fitsFile.objects.filter(fitsFileName=fitsSequence.fitsMasterDark).first()
-        #master_flat = fitsFile.objects.filter(fitsFileName=fitsSequence.fitsMasterFlat).first()
+    #################################################################################################################
+    ## createSequences - this function groups the unassigned frames of each type into sequences. A new sequence   ##
+    ##                   starts when the object (lights), telescope or imager changes or when more than gap has   ##
+    ##                   passed since the previous frame. Returns the ids of the sequences created                 ##
+    #################################################################################################################
+    def createSequences(self,frameTypes,gap=DEFAULT_GAP,frames=None):
+        sequencesCreated=[]
+        for frameType in frameTypes:
+            plan=planSequences(frameType,frames,gap)
+            logging.info("createSequences found "+str(sum(len(planned['frames']) for planned in plan))+" unassigned "+frameType+" files to sequence")
+            sequencesCreated+=applySequencePlan(plan)
+        return sequencesCreated
 
-        # Read the data from the light IMAGETYP
-        try:
-            with fits.open(targetFitsFile.fitsFileName) as hdul:
-                light_data = hdul[0].data
-        except Exception as e:
-            logging.info(f"Failed to read light IMAGETYP: {e}")
-            return
-        
-        # Calibrate the light IMAGETYP
-        calibrated_data = (light_data - master_bias) / (master_flat - master_dark)
-
-        # Save the calibrated light IMAGETYP
-        calibrated_path = os.path.join(self.repoFolder, f'calibrated_{targetFitsFile.fitsFileName}')
-        try:
-            hdu = fits.PrimaryHDU(calibrated_data)
-            hdu.writeto(calibrated_path, overwrite=True)
-            logging.info(f"Calibrated light IMAGETYP saved to: {calibrated_path}")
-        except Exception as e:
-            logging.info(f"Failed to save calibrated light IMAGETYP: {e}")
-
-        # Update the light IMAGETYP record in the database
-        newFitsFile=fitsFile(fitsFileName=calibrated_path,fitsFileCalibrated=True)
-
-        # Copy the rest of the fields from the original light IMAGETYP
-        newFitsFile.fitsFileDate=targetFitsFile.fitsFileDate
-        newFitsFile.fitsFileType="CalibratedLight"
-        newFitsFile.fitsFileStacked="False"
-        newFitsFile.fitsFileObject=targetFitsFile.fitsFileObject
-        newFitsFile.fitsFileExpTime=targetFitsFile.fitsFileExpTime
-        newFitsFile.fitsFileXBinning=targetFitsFile.fitsFileXBinning
-        newFitsFile.fitsFileYBinning=targetFitsFile.fitsFileYBinning
-        newFitsFile.fitsFileCCDTemp=targetFitsFile.fitsFileCCDTemp
-        newFitsFile.fitsFileTelescop=targetFitsFile.fitsFileTelescop
-        newFitsFile.fitsFileInstrument=targetFitsFile.fitsFileInstrument
-        newFitsFile.fitsFileSequence=targetFitsFile.fitsFileSequence
-        newFitsFile.save()
-        logging.info(f'Light IMAGETYP calibrated: {calibrated_path}')
-
-    #################################################################################################################
-    ## CreateMasterBias - this function creates a master bias IMAGETYP from a set of bias IMAGETYPs for a given sequence ##
-    #################################################################################################################
-    def createMasterBias(self, targetFitsFile):
-        # Query to get bias IMAGETYPs for the file - just need one to get the sequence number
-        logging.info(f"Creating master bias IMAGETYP for light IMAGETYP: {targetFitsFile.fitsFileId}")
-
-        bias_IMAGETYP = fitsFile.objects.filter(
-            fitsFileType="Bias", 
-            fitsFileTelescop=targetFitsFile.fitsFileTelescop,
-            fitsFileInstrument=targetFitsFile.fitsFileInstrument, 
-            fitsFileDate__lt=targetFitsFile.fitsFileDate
-        ).order_by('fitsFileDate').first()
-
-        # If we have the sequence number, get all the bias IMAGETYPs
-        if bias_IMAGETYP:
-            logging.info(f"Found bias IMAGETYPs for target image")
-            bias_IMAGETYPs = fitsFile.objects.filter(fitsFileType="Bias", fitsFileSequence=bias_IMAGETYP.fitsFileSequence).order_by('fitsFileDate')
-        else:
-            logging.info('No bias IMAGETYPs found for target image, returning')
+    #################################################################################################################
+    ## calibrateFitsFile - this function calibrates a light frame using master bias, dark, and flat frames. If the ##
+    ##                     masters do not exist, they are created for the sequence.                                ##
+    #################################################################################################################
+    def calibrateFitsImage(self,targetFitsFile):
+        # Check for a fitsSequence record for the light frame
+        if not targetFitsFile.fitsFileSequence:
+            logging.info(f"No fitsSequence record found for light frame: {targetFitsFile.fitsFileId}, run the sync_repo command")
             return None
 
-        # Read all bias IMAGETYPs
-        bias_data = []
-        
-        for bias_IMAGETYP in bias_IMAGETYPs:
-            try:
-                with fits.open(bias_IMAGETYP.fitsFileName) as hdul:
-                    logging.debug(f"Reading bias IMAGETYP {bias_IMAGETYP.fitsFileId}")
-                    bias_data.append(hdul[0].data)
-            except Exception as e:
-                logging.info(f"Failed to read bias IMAGETYP {bias_IMAGETYP.fitsFileId}: {e}")
-
-        if not bias_data:
-            logging.info('No valid bias IMAGETYPs found')
+        results=self.calibrateFitsImages([targetFitsFile])
+        if not results['calibrated']:
             return None
+        return results['calibrated'][0]
+
+    #################################################################################################################
+    ## calibratedFileName - this function returns where the calibrated copy of a light frame is written            ##
+    #################################################################################################################
+    def calibratedFileName(self,lightFileName):
+        lightFolder=self.repoFolder+"Light/"
+        if lightFileName.startswith(lightFolder):
+            return self.repoFolder+"Calibrated/"+lightFileName[len(lightFolder):]
+        return self.repoFolder+"Calibrated/"+os.path.basename(lightFileName)
+
+    #################################################################################################################
+    ## calibrateFitsImages - this function calibrates a set of light frames, by default every uncalibrated light   ##
+    ##                       in a sequence. Lights are grouped by the masters they need so each master is built    ##
+    ##                       or loaded once; the frames are calibrated in a process pool if workers > 1 and the    ##
+    ##                       CalibratedLight records are written in bulk, then the calibration coverage of their   ##
+    ##                       sequences is refreshed. Returns the ids created and throughput.                       ##
+    #################################################################################################################
+    def calibrateFitsImages(self,lights=None,workers=1,batchSize=100):
+        startTime=time.perf_counter()
+        results={'calibrated':[],'failed':0,'frames':0,'bytes':0,'seconds':0.0}
+        if lights is None:
+            lights=fitsFile.objects.filter(fitsFileType="Light",fitsFileCalibrated=False,
+                                           fitsFileSequence__isnull=False).order_by('fitsFileDate')
+
+        # Group the lights by the masters they need
+        groups={}
+        for light in lights:
+            keys=tuple(self.masterCache.key(frameType,light) for frameType in ["Bias","Dark","Flat"])
+            groups.setdefault(keys,[]).append(light)
+        logging.info(f"Calibrating lights in {len(groups)} groups of matching masters")
+
+        tasks=[]
+        for keys,groupLights in groups.items():
+            masters={}
+            for frameType in ["Bias","Dark","Flat"]:
+                masterId,data=self.getMaster(frameType,groupLights[0])
+                if masterId:
+                    masters[frameType]=(masterId,self.masterCache.path(self.masterCache.key(frameType,groupLights[0])))
+            if not masters:
+                logging.warning(f"No calibration masters available for {len(groupLights)} lights starting with {groupLights[0].fitsFileName}")
+                results['failed']+=len(groupLights)
+                continue
+
+            # Record the masters on the sequences of these lights
+            sequenceIds={light.fitsFileSequence for light in groupLights if light.fitsFileSequence}
+            updates={}
+            if "Bias" in masters:
+                updates['fitsMasterBias']=str(masters["Bias"][0])
+            if "Dark" in masters:
+                updates['fitsMasterDark']=str(masters["Dark"][0])
+            if "Flat" in masters:
+                updates['fitsMasterFlat']=masters["Flat"][0]
+            fitsSequence.objects.filter(fitsSequenceId__in=sequenceIds).update(**updates)
+
+            for light in groupLights:
+                tasks.append((light,[light.fitsFileName,self.calibratedFileName(light.fitsFileName)]+
+                                     [masters[frameType][1] if frameType in masters else None for frameType in ["Bias","Dark","Flat"]]))
+
+        # Calibrate, tasks stay in group order so each worker keeps hitting the masters it has loaded
+        taskLights=[light for light,args in tasks]
+        taskArgs=list(zip(*[args for light,args in tasks])) if tasks else [[]]*5
+        if workers > 1 and tasks:
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                outputs=executor.map(calibrateFrame,*taskArgs,chunksize=max(1,min(16,len(tasks)//(workers*4))))
+                self.submitCalibratedFrames(zip(taskLights,outputs),results,batchSize)
         else:
-            logging.info(f"Found {len(bias_data)} bias IMAGETYPs")
-        
-        # Calculate the master bias IMAGETYP (median of all bias IMAGETYPs)
-        master_bias_data = np.median(bias_data, axis=0)
-        
-        # Save the master bias IMAGETYP
-        master_bias_path = os.path.join(self.repoFolder+"Masters/", f'master_bias_{bias_IMAGETYP.fitsFileSequence}.fits')
+            self.submitCalibratedFrames(zip(taskLights,map(calibrateFrame,*taskArgs)),results,batchSize)
+        refreshSequenceStats({light.fitsFileSequence for light in taskLights})
 
-        try:
-            hdu = fits.PrimaryHDU(master_bias_data)
-            hdu.writeto(master_bias_path, overwrite=True)
-            logging.info(f"Master bias IMAGETYP saved to: {master_bias_path}")
-        except Exception as e:
-            logging.info(f"Failed to save master bias IMAGETYP: {e}")
-        
-        # Save the master bias filename in the database
-        newfile=fitsFile(fitsFileName=master_bias_path,fitsFileType="MasterBias",fitsFileSequence=bias_IMAGETYP.fitsFileSequence)
-        newfile.save()
-        logging.info(f'Master bias IMAGETYP created: {master_bias_path}')
+        results['seconds']=time.perf_counter()-startTime
+        return results
 
-        return newfile.fitsFileId
+    #################################################################################################################
+    ## submitCalibratedFrames - this function writes CalibratedLight records and marks their lights calibrated     ##
+    ##                          in batches, one transaction per batch                                              ##
+    #################################################################################################################
+    def submitCalibratedFrames(self,outputs,results,batchSize):
+        batch=[]
+        for light,output in outputs:
+            if output is None:
+                results['failed']+=1
+                continue
+            results['frames']+=1
+            results['bytes']+=output['bytesRead']+output['bytesWritten']
+            batch.append((light,output))
+            if len(batch) >= batchSize:
+                results['calibrated']+=self.submitCalibratedBatch(batch)
+                batch=[]
+        if batch:
+            results['calibrated']+=self.submitCalibratedBatch(batch)
+
+    def submitCalibratedBatch(self,batch):
+        records=[]
+        for light,output in batch:
+            # Copy the rest of the fields from the original light frame
+            records.append(fitsFile(fitsFileName=output['outputFileName'],fitsFileCalibrated=True,
+                                    fitsFileDate=light.fitsFileDate,fitsFileType="CalibratedLight",fitsFileStacked=False,
+                                    fitsFileObject=light.fitsFileObject,fitsFileExpTime=light.fitsFileExpTime,
+                                    fitsFileXBinning=light.fitsFileXBinning,fitsFileYBinning=light.fitsFileYBinning,
+                                    fitsFileCCDTemp=light.fitsFileCCDTemp,fitsFileTelescop=light.fitsFileTelescop,
+                                    fitsFileInstrument=light.fitsFileInstrument,fitsFileFilter=light.fitsFileFilter,fitsFileGain=light.fitsFileGain,
+                                    fitsFileOffset=light.fitsFileOffset,fitsFileSequence=light.fitsFileSequence))
+        with transaction.atomic():
+            # A light calibrated again replaces its earlier calibrated copy
+            fitsFile.objects.filter(fitsFileType="CalibratedLight",fitsFileName__in=[record.fitsFileName for record in records]).delete()
+            fitsFile.objects.bulk_create(records)
+            fitsFile.objects.filter(fitsFileId__in=[light.fitsFileId for light,output in batch]).update(fitsFileCalibrated=True)
+        logging.info(f"Registered {len(records)} calibrated light frames")
+        return [record.fitsFileId for record in records]
 
     #################################################################################################################
-    ## CreateMasterDark - this function creates a master dark IMAGETYP from a set of dark IMAGETYPs for a given sequence ##
+    ## findCalibrationFrames - this function finds the most recent sequence of calibration frames of a type taken  ##
+    ##                         before a date with matching properties and returns all frames of it                 ##
     #################################################################################################################
-    def createMasterDark(self,targetFitsFile):
-        
+    def findCalibrationFrames(self,frameType,targetFitsFile,before=None,**match):
+        latest = fitsFile.objects.filter(
+            fitsFileType=frameType,
+            fitsFileDate__lt=before or targetFitsFile.fitsFileDate,
+            fitsFileSequence__isnull=False,
+            **match
+        ).order_by('-fitsFileDate').first()
+
+        if not latest:
+            logging.info(f'No {frameType} frames found for target image {targetFitsFile.fitsFileId}')
+            return None,[]
+        logging.info(f"Found {frameType} frames for target image in sequence {latest.fitsFileSequence}")
+        frames = fitsFile.objects.filter(fitsFileType=frameType, fitsFileSequence=latest.fitsFileSequence, **match).order_by('fitsFileDate')
+        return latest.fitsFileSequence,list(frames)
 
-        # If we have the sequence number, get all the dark IMAGETYPs
-        targetSequenceNo=dark_IMAGETYP.fitsFileSequence
-        if dark_IMAGETYP:
-            dark_IMAGETYPs = fitsFile.objects.filter(fitsFileType="Dark",fitsFileSequence=dark_IMAGETYP.fitsFileSequence).order_by('fitsFileDate')
-        else:
-            logging.info('No dark IMAGETYPs found')
-        
-        # Read all dark IMAGETYPs
-        dark_data = []
-        for dark_IMAGETYP in dark_IMAGETYPs:
-            try:
-                with fits.open(dark_IMAGETYP['fits']) as hdul:
-                    logging.info(f"Reading dark IMAGETYP {dark_IMAGETYP[2]}")
-                    dark_data.append(hdul[0].data)
-            except Exception as e:
-                logging.info(f"Failed to read dark IMAGETYP {dark_IMAGETYP[2]}: {e}")
-
-        if not dark_data:
-            logging.info('No valid dark IMAGETYPs found')
-            return
-        
-        # Calculate the master dark IMAGETYP (median of all dark IMAGETYPs)
-        master_dark_data = np.median(dark_data, axis=0)
-        
-        # Save the master dark IMAGETYP
-        master_dark_path = os.path.join(self.repoFolder+"Masters/", f'master_dark_{targetSequenceNo}.fits')
+    #################################################################################################################
+    ## getMaster - this function returns (fitsFileId, data) of the master of a type for a light frame. Masters are ##
+    ##             served from the in-process cache, then from disk, and only built if neither has a current one   ##
+    #################################################################################################################
+    def getMaster(self,frameType,targetFitsFile,method='median'):
+        key=self.masterCache.key(frameType,targetFitsFile)
+        entry=self.masterCache.get(key)
+        if entry:
+            return entry
+
+        # Calibration frames are chosen from before the end of the key's window so the key fixes the frames
+        windowEnd=self.masterCache.window(targetFitsFile.fitsFileDate)[1]
+        match={field: getattr(targetFitsFile,field) for field in KEY_FIELDS[frameType]}
+        if frameType in TEMPERATURE_TYPES and self.masterCache.temperatureRange(targetFitsFile.fitsFileCCDTemp):
+            match['fitsFileCCDTemp__range']=self.masterCache.temperatureRange(targetFitsFile.fitsFileCCDTemp)
+        sequenceNo,frames=self.findCalibrationFrames(frameType,targetFitsFile,before=windowEnd,**match)
+        if not frames:
+            return None,None
+
+        masterPath=self.masterCache.path(key)
+        existing=fitsFile.objects.filter(fitsFileName=masterPath,fitsFileSequence=sequenceNo).first()
+        if existing and os.path.exists(masterPath):
+            logging.info(f"Reusing {frameType} master {masterPath}")
+            data=fits.getdata(masterPath).astype(np.float32,copy=False)
+            return self.masterCache.put(key,existing.fitsFileId,data)
+
+        # Flats have the bias pedestal taken off before they are normalised, or the master flat under-corrects
+        offset=None
+        if frameType=="Flat":
+            offset=self.getMaster("Bias",targetFitsFile,method=method)[1]
+            if offset is None:
+                logging.warning(f"No master bias for the flats of light frame {targetFitsFile.fitsFileId}, flats not bias subtracted")
+
+        # Any master on disk for this key was built from frames that have since been superseded
+        fitsFile.objects.filter(fitsFileName=masterPath).delete()
+        fitsFileId,data=self.createMaster(frameType,frames,sequenceNo,masterPath,method=method,normalise=(frameType=="Flat"),offset=offset)
+        if fitsFileId is None:
+            return None,None
+        return self.masterCache.put(key,fitsFileId,data)
+
+    #################################################################################################################
+    ## createMaster - this function combines a set of calibration frames into a master frame and registers it.     ##
+    ##                An offset frame, the master bias for flats, is subtracted from each frame first.             ##
+    ##                Returns (fitsFileId, data)                                                                   ##
+    #################################################################################################################
+    def createMaster(self,frameType,frames,sequenceNo,masterPath,method='median',normalise=False,offset=None):
+        masterType="Master"+frameType
+        logging.info(f"Combining {len(frames)} {frameType} frames by {method}")
+        master_data,frameCount = combineFrames([frame.fitsFileName for frame in frames],method=method,
+                                               memoryBudget=self.combineMemoryBudget,normalise=normalise,offset=offset)
+        if master_data is None:
+            logging.info(f'No valid {frameType} frames found')
+            return None,None
+        logging.info(f"Combined {frameCount} {frameType} frames")
+
+        # Save the master frame
+        os.makedirs(os.path.dirname(masterPath),exist_ok=True)
         try:
-            hdu = fits.PrimaryHDU(master_dark_data)
-            hdu.writeto(master_dark_path, overwrite=True)
-            logging.info(f"Master dark IMAGETYP saved to: {master_dark_path}")
+            writeMaster(master_data,masterPath,masterType,frameCount,method)
+            logging.info(f"{masterType} saved to: {masterPath}")
         except Exception as e:
-            logging.info(f"Failed to save master dark IMAGETYP: {e}")
-        
-        # Save the master dark filename in the database
-        newfile=fitsFile(fitsFileName=master_dark_path,fitsFileType="Masterdark",fitsFileSequence=targetSequenceNo)
+            logging.info(f"Failed to save {masterType}: {e}")
+            return None,None
+
+        # Save the master filename in the database
+        template=frames[0]
+        newfile=fitsFile(fitsFileName=masterPath,fitsFileType=masterType,fitsFileSequence=sequenceNo,
+                         fitsFileDate=template.fitsFileDate,fitsFileExpTime=template.fitsFileExpTime,
+                         fitsFileXBinning=template.fitsFileXBinning,fitsFileYBinning=template.fitsFileYBinning,
+                         fitsFileCCDTemp=template.fitsFileCCDTemp,fitsFileTelescop=template.fitsFileTelescop,
+                         fitsFileInstrument=template.fitsFileInstrument,fitsFileFilter=template.fitsFileFilter,fitsFileGain=template.fitsFileGain,
+                         fitsFileOffset=template.fitsFileOffset)
         newfile.save()
-        logging.info(f'Master dark IMAGETYP created: {master_dark_path}')
+        logging.info(f'{masterType} created: {masterPath}')
 
-        return newfile.fitsFileId
+        return newfile.fitsFileId,master_data.astype(np.float32,copy=False)
 
     #################################################################################################################
-    ## CreateMasterFlat - this function creates a master flat IMAGETYP from a set of flat IMAGETYPs for a given sequence ##
+    ## CreateMasterBias - this function returns the master bias for a light frame, building it if needed           ##
     #################################################################################################################
-    def createMasterFlat(self,targetFitsFileId):
-        # Load the fits file that we need the master flat for
-        light_IMAGETYP = fitsFile.objects.filter(fitsFileType="Light", fitsFileId=targetFitsFileId)
+    def createMasterBias(self, targetFitsFile, method='median'):
+        logging.info(f"Getting master bias for light frame: {targetFitsFile.fitsFileId}")
+        return self.getMaster("Bias",targetFitsFile,method=method)[0]
 
-        # Query to get flat IMAGETYPs for the file - just need one to get the sequence number
-        flat_IMAGETYP = fitsFile.objects.filter(fitsFileType="flat", 
-                                             fitsFileInstrument=light_IMAGETYP.fitsFileInstrument, 
-                                             fitsFileGain=light_IMAGETYP.fitsFileGain,
-                                             fitsFileOffset=light_IMAGETYP.fitsFileOffset,
-                                             fitsFileDate__lt=light_IMAGETYP.fitsFileDate).order_by('fitsFileDate').first()
-
-        # If we have the sequence number, get all the flat IMAGETYPs
-        targetSequenceNo=flat_IMAGETYP.fitsFileSequence
-        if flat_IMAGETYP:
-            flat_IMAGETYPs = fitsFile.objects.filter(fitsFileType="Flat",fitsFileSequence=flat_IMAGETYP.fitsFileSequence).order_by('fitsFileDate')
-        else:
-            logging.info('No flat IMAGETYPs found')
-        
-        # Read all flat IMAGETYPs
-        flat_data = []
-        for flat_IMAGETYP in flat_IMAGETYPs:
-            try:
-                with fits.open(flat_IMAGETYP['fits']) as hdul:
-                    logging.info(f"Reading flat IMAGETYP {flat_IMAGETYP[2]}")
-                    flat_data.append(hdul[0].data)
-            except Exception as e:
-                logging.info(f"Failed to read flat IMAGETYP {flat_IMAGETYP[2]}: {e}")
-
-        if not flat_data:
-            logging.info('No valid flat IMAGETYPs found')
-            return
-        
-        # Calculate the master flat IMAGETYP (median of all flat IMAGETYPs)
-        master_flat_data = np.median(flat_data, axis=0)
-        
-        # Save the master flat IMAGETYP
-        master_flat_path = os.path.join(self.repoFolder+"Masters/", f'master_flat_{targetSequenceNo}.fits')
-        try:
-            hdu = fits.PrimaryHDU(master_flat_data)
-            hdu.writeto(master_flat_path, overwrite=True)
-            logging.info(f"Master flat IMAGETYP saved to: {master_flat_path}")
-        except Exception as e:
-            logging.info(f"Failed to save master flat IMAGETYP: {e}")
-        
-        # Save the master flat filename in the database
-        newfile=fitsFile(fitsFileName=master_flat_path,fitsFileType="Masterflat",fitsFileSequence=targetSequenceNo)
-        newfile.save()
-        logging.info(f'Master flat IMAGETYP created: {master_flat_path}')
+    #################################################################################################################
+    ## CreateMasterDark - this function returns the master dark for a light frame, building it if needed. Darks    ##
+    ##                    are matched on exposure                                                                  ##
+    #################################################################################################################
+    def createMasterDark(self, targetFitsFile, method='median'):
+        logging.info(f"Getting master dark for light frame: {targetFitsFile.fitsFileId}")
+        return self.getMaster("Dark",targetFitsFile,method=method)[0]
 
-        return newfile.fitsFileId
\ No newline at end of file
+    #################################################################################################################
+    ## CreateMasterFlat - this function returns the master flat for a light frame, building it if needed. Each    ##
+    ##                    flat has the master bias subtracted and is normalised to a median of 1 before combining. ##
+    #################################################################################################################
+    def createMasterFlat(self, targetFitsFile, method='median'):
+        logging.info(f"Getting master flat for light frame: {targetFitsFile.fitsFileId}")
+        return self.getMaster("Flat",targetFitsFile,method=method)[0]
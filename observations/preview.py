@@ -0,0 +1,200 @@
+############################################################################################################
+## P R E V I E W                                                                                          ##
+############################################################################################################
+# Stretched previews and Deep Zoom (DZI) tile pyramids for the FITS file pages. Everything rendered is kept
+# on disk under a folder per file and stretch, named from a hash of the file id, its size and modification
+# time and the stretch settings, which doubles as the ETag. The stretch limits are worked out once from a
+# sample of the full frame and stored with the preview so the preview and every tile match. Tiles are made
+# when first asked for, each one reading only the part of the memory mapped image it covers. When a new
+# stretch of a file is rendered the least recently used ones beyond the last few are deleted, which also
+# clears out renders of an earlier version of the file.
+#
+from astropy.io import fits
+from PIL import Image
+import numpy as np
+import hashlib
+import json
+import math
+import os
+import shutil
+
+from observations.thumbnails import stretchLimits, applyStretch, THUMBNAIL_FORMATS, BAND_BYTES
+
+import logging
+logging=logging.getLogger(__name__)
+
+PREVIEW_SIZE=2048
+TILE_SIZE=256
+TILE_FORMAT='jpg'
+DEFAULT_LOW=0.5
+DEFAULT_HIGH=99.8
+DEFAULT_ASINH=0.1
+PREVIEW_QUALITY=90
+MAX_STRETCHES=4
+
+#################################################################################################################
+## openImage - this function memory maps a FITS file and returns the HDU list, the 2D image and its scaling     ##
+#################################################################################################################
+def openImage(fitsFileName):
+    hdul=fits.open(fitsFileName,memmap=True,do_not_scale_image_data=True)
+    data=hdul[0].data
+    if data is None:
+        hdul.close()
+        raise ValueError("No image in primary HDU")
+    # Colour cubes are previewed from their first plane
+    while data.ndim>2:
+        data=data[0]
+    return hdul,data,float(hdul[0].header.get('BSCALE',1.0)),float(hdul[0].header.get('BZERO',0.0))
+
+#################################################################################################################
+## regionAverage - this function averages factor x factor blocks of a region of a 2D array, a band of rows at  ##
+##                 a time. Blocks cut short by the edge of the region are averaged over the pixels they have   ##
+#################################################################################################################
+def regionAverage(data,y0,y1,x0,x1,factor):
+    rowStarts=np.arange(0,y1-y0,factor)
+    colStarts=np.arange(0,x1-x0,factor)
+    colCounts=np.diff(np.append(colStarts,x1-x0))
+    result=np.empty((len(rowStarts),len(colStarts)),dtype=np.float32)
+    blocksPerBand=max(1,BAND_BYTES//(factor*(x1-x0)*4))
+    for i in range(0,len(rowStarts),blocksPerBand):
+        ys=y0+rowStarts[i]
+        ye=min(y1,ys+blocksPerBand*factor)
+        band=np.asarray(data[ys:ye,x0:x1],dtype=np.float32)
+        bandRows=np.arange(0,ye-ys,factor)
+        rowCounts=np.diff(np.append(bandRows,ye-ys))
+        sums=np.add.reduceat(np.add.reduceat(band,bandRows,axis=0),colStarts,axis=1)
+        result[i:i+len(bandRows)]=sums/np.outer(rowCounts,colCounts)
+    return result
+
+#################################################################################################################
+## prunePreviews - this function deletes the least recently modified renders of a file, other than the current ##
+##                 one, until keep are left. Returns the number of renders deleted                             ##
+#################################################################################################################
+def prunePreviews(fileFolder,current=None,keep=MAX_STRETCHES):
+    try:
+        entries=[entry for entry in os.scandir(fileFolder) if entry.is_dir() and entry.name!=current]
+    except FileNotFoundError:
+        return 0
+    stats=sorted(((entry.stat().st_mtime,entry.path) for entry in entries),reverse=True)
+    deleted=0
+    for mtime,path in stats[max(0,keep-1):]:
+        try:
+            shutil.rmtree(path)
+        except OSError:
+            continue
+        deleted+=1
+    if deleted:
+        logging.info(f"Pruned {deleted} previews from {fileFolder}")
+    return deleted
+
+class PreviewRenderer(object):
+    def __init__(self,previewFolder,fitsFileId,fitsFileName,low=DEFAULT_LOW,high=DEFAULT_HIGH,asinh=DEFAULT_ASINH):
+        self.fitsFileName=fitsFileName
+        self.low=low
+        self.high=high
+        self.asinh=asinh
+        stat=os.stat(fitsFileName)
+        digest=hashlib.blake2b(f"{fitsFileId}|{stat.st_size}|{stat.st_mtime_ns}|{low}|{high}|{asinh}".encode('ascii'),digest_size=12)
+        self.etag=digest.hexdigest()
+        self.folder=os.path.join(previewFolder,str(fitsFileId),self.etag)
+        self._info=None
+
+    #############################################################################################################
+    ## info - the image size and stretch limits, worked out on first use and kept with the preview             ##
+    #############################################################################################################
+    def info(self):
+        if self._info:
+            return self._info
+        infoPath=os.path.join(self.folder,'info.json')
+        try:
+            with open(infoPath,'r') as f:
+                self._info=json.load(f)
+            return self._info
+        except (FileNotFoundError, ValueError):
+            pass
+
+        hdul,data,bscale,bzero=openImage(self.fitsFileName)
+        try:
+            lower,upper=stretchLimits(data,self.low,self.high)
+        finally:
+            hdul.close()
+        lower,upper=sorted([lower*bscale+bzero,upper*bscale+bzero])
+        height,width=data.shape
+        self._info={'width':width,'height':height,'lower':lower,'upper':upper,
+                    'maxLevel':int(math.ceil(math.log2(max(width,height,1))))}
+        self.save(infoPath,json.dumps(self._info).encode('ascii'))
+        prunePreviews(os.path.dirname(self.folder),current=self.etag)
+        return self._info
+
+    #############################################################################################################
+    ## save - write a file into the preview folder without ever leaving a partial file under the final name    ##
+    #############################################################################################################
+    def save(self,path,content):
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        tempPath=f"{path}.{os.getpid()}.tmp"
+        if isinstance(content,Image.Image):
+            content.save(tempPath,format=THUMBNAIL_FORMATS[TILE_FORMAT],quality=PREVIEW_QUALITY)
+        else:
+            with open(tempPath,'wb') as f:
+                f.write(content)
+        os.replace(tempPath,path)
+
+    #############################################################################################################
+    ## render - stretch a region of the full resolution image averaged down by factor                          ##
+    #############################################################################################################
+    def render(self,y0,y1,x0,x1,factor):
+        info=self.info()
+        hdul,data,bscale,bzero=openImage(self.fitsFileName)
+        try:
+            image=regionAverage(data,y0,y1,x0,x1,factor)
+        finally:
+            hdul.close()
+        if bscale!=1.0:
+            image*=bscale
+        if bzero!=0.0:
+            image+=bzero
+        return Image.fromarray(applyStretch(image,info['lower'],info['upper'],self.asinh),mode='L')
+
+    #############################################################################################################
+    ## preview - the path of a preview no larger than size pixels on its longest side                          ##
+    #############################################################################################################
+    def preview(self,size=PREVIEW_SIZE):
+        previewPath=os.path.join(self.folder,f'preview_{size}.{TILE_FORMAT}')
+        if not os.path.exists(previewPath):
+            info=self.info()
+            factor=max(1,int(math.ceil(max(info['width'],info['height'])/size)))
+            self.save(previewPath,self.render(0,info['height'],0,info['width'],factor))
+            logging.info(f"Preview saved to: {previewPath}")
+        return previewPath
+
+    #############################################################################################################
+    ## descriptor - the Deep Zoom descriptor of the tile pyramid                                               ##
+    #############################################################################################################
+    def descriptor(self):
+        info=self.info()
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{TILE_FORMAT}" Overlap="0" TileSize="{TILE_SIZE}">'
+                f'<Size Width="{info["width"]}" Height="{info["height"]}"/></Image>')
+
+    #############################################################################################################
+    ## tile - the path of a Deep Zoom tile, or None if the tile is outside the pyramid. Level maxLevel is full ##
+    ##        resolution and every level below halves it                                                      ##
+    #############################################################################################################
+    def tile(self,level,column,row):
+        info=self.info()
+        if level<0 or level>info['maxLevel']:
+            return None
+        factor=2**(info['maxLevel']-level)
+        levelWidth=math.ceil(info['width']/factor)
+        levelHeight=math.ceil(info['height']/factor)
+        if column<0 or row<0 or column*TILE_SIZE>=levelWidth or row*TILE_SIZE>=levelHeight:
+            return None
+
+        tilePath=os.path.join(self.folder,'tiles',str(level),f'{column}_{row}.{TILE_FORMAT}')
+        if not os.path.exists(tilePath):
+            x0=column*TILE_SIZE*factor
+            y0=row*TILE_SIZE*factor
+            x1=min(info['width'],x0+TILE_SIZE*factor)
+            y1=min(info['height'],y0+TILE_SIZE*factor)
+            self.save(tilePath,self.render(y0,y1,x0,x1,factor))
+        return tilePath
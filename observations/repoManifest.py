@@ -0,0 +1,93 @@
+############################################################################################################
+## R E P O   M A N I F E S T                                                                              ##
+############################################################################################################
+# The manifest records, for every file in the repository, the size, modification time and header hash seen
+# at the last sync along with the name it was registered under in the database. An incremental sync only
+# opens files whose size or modification time no longer match the manifest. Folders of files Obsy derives
+# from the frames, calibrated lights, masters, thumbnails and previews, and the copies it set aside on
+# ingest are not walked.
+#
+import json
+import os
+
+import logging
+logging=logging.getLogger(__name__)
+
+MANIFEST_NAME='.obsy_manifest.json'
+# Folders at the top of the repository holding files made or set aside by Obsy rather than frames to register
+DERIVED_FOLDERS=['Calibrated','Masters','Thumbnails','Previews','Duplicates']
+
+class RepoManifest(object):
+    def __init__(self,manifestPath):
+        self.manifestPath=manifestPath
+        self.entries={}
+
+    #############################################################################################################
+    ## load - read the manifest from disk, a missing or unreadable manifest is treated as empty                ##
+    #############################################################################################################
+    def load(self):
+        try:
+            with open(self.manifestPath,'r') as f:
+                self.entries=json.load(f)
+            logging.info("Loaded manifest with "+str(len(self.entries))+" entries from "+self.manifestPath)
+        except FileNotFoundError:
+            logging.info("No manifest found at "+self.manifestPath+", all files will be scanned")
+            self.entries={}
+        except (ValueError, OSError) as e:
+            logging.warning("Manifest "+self.manifestPath+" could not be read, all files will be scanned: "+str(e))
+            self.entries={}
+        return self
+
+    #############################################################################################################
+    ## save - write the manifest atomically so an interrupted sync never leaves a truncated manifest           ##
+    #############################################################################################################
+    def save(self):
+        tempPath=self.manifestPath+'.tmp'
+        with open(tempPath,'w') as f:
+            json.dump(self.entries,f)
+        os.replace(tempPath,self.manifestPath)
+        logging.info("Saved manifest with "+str(len(self.entries))+" entries to "+self.manifestPath)
+
+    def clear(self):
+        self.entries={}
+        return self
+
+    def get(self,path):
+        return self.entries.get(path)
+
+    def unchanged(self,path,size,mtime):
+        entry=self.entries.get(path)
+        return entry is not None and entry['size']==size and entry['mtime']==mtime
+
+    def record(self,path,size,mtime,headerHash,fitsFileName):
+        self.entries[path]={'size':size,'mtime':mtime,'headerHash':headerHash,'fitsFileName':fitsFileName}
+
+    def remove(self,path):
+        return self.entries.pop(path,None)
+
+    def paths(self):
+        return set(self.entries.keys())
+
+    def fileNames(self):
+        return {entry['fitsFileName'] for entry in self.entries.values() if entry['fitsFileName']}
+
+#################################################################################################################
+## walkRepository - this function yields (root, file, stat) for every file under a folder using scandir, so    ##
+##                  the stat comes from the directory listing where the platform supports it. The skipFolders  ##
+##                  directly under the folder are left out                                                     ##
+#################################################################################################################
+def walkRepository(folder,skipFolders=DERIVED_FOLDERS):
+    top=os.path.abspath(folder)
+    pending=[top]
+    while pending:
+        root=pending.pop()
+        try:
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if root!=top or entry.name not in skipFolders:
+                            pending.append(entry.path)
+                    elif entry.is_file() and entry.name!=MANIFEST_NAME and not entry.name.startswith(MANIFEST_NAME):
+                        yield root,entry.name,entry.stat()
+        except OSError as e:
+            logging.warning("Unable to scan folder "+root+": "+str(e))
@@ -0,0 +1,212 @@
+############################################################################################################
+## S E Q U E N C I N G                                                                                    ##
+############################################################################################################
+# Groups fits files into sequences. Frames of a type are read in one query, sorted by the fields that make
+# up a sequence and then by date, and cut into sequences in a single pass wherever those fields change or
+# the time since the previous frame is more than the gap threshold. Planning touches nothing, applying a
+# plan creates the fitsSequence records in bulk and assigns each one's frames with a single UPDATE, then
+# works out the new sequences' statistics and refreshes the summaries of the objects it touched.
+# Unassigned frames within the gap of a sequence with the same fields join it rather than starting another,
+# so frames loaded a few at a time through the night end up in one sequence. rebuildSequences regroups the
+# whole archive, or a date range or instrument of it, in one transaction.
+#
+from django.db import transaction
+from django.db.models import Case, When, Value
+from datetime import timedelta
+import uuid
+
+from observations.models import fitsFile, fitsSequence, Observation
+from observations.summaries import refreshSequenceStats, refreshObjectSummaries, sequenceObjectNames
+
+import logging
+logging=logging.getLogger(__name__)
+
+# Fields that must match for frames of each type to share a sequence
+SEQUENCE_FIELDS={
+    'Light': ['fitsFileObject','fitsFileTelescop','fitsFileInstrument'],
+    'Bias':  ['fitsFileTelescop','fitsFileInstrument'],
+    'Dark':  ['fitsFileTelescop','fitsFileInstrument'],
+    'Flat':  ['fitsFileTelescop','fitsFileInstrument','fitsFileFilter'],
+}
+LIGHT_TYPES=['Light']
+CALIBRATION_TYPES=['Bias','Dark','Flat']
+DEFAULT_GAP=timedelta(hours=12)
+
+# Ids per UPDATE, under the SQLite bound parameter limit
+UPDATE_BATCH_SIZE=500
+
+#################################################################################################################
+## planSequences - this function returns the sequences the frames of a type would be grouped into. frames is   ##
+##                 an optional fitsFile queryset to plan from, by default every frame not in a sequence, in    ##
+##                 which case they may join existing sequences. Each sequence is a dict of the type, the       ##
+##                 sequence fields, the first and last frame dates, the frame ids and the id of the existing   ##
+##                 sequence it joins, if any                                                                   ##
+#################################################################################################################
+def planSequences(frameType,frames=None,gap=DEFAULT_GAP):
+    joinExisting=frames is None
+    if joinExisting:
+        frames=fitsFile.objects.filter(fitsFileSequence__isnull=True)
+    keyFields=SEQUENCE_FIELDS[frameType]
+    rows=(frames.filter(fitsFileType=frameType)
+                .order_by(*keyFields,'fitsFileDate','fitsFileId')
+                .values_list('fitsFileId','fitsFileDate',*keyFields))
+
+    plan=[]
+    current=None
+    for row in rows.iterator(chunk_size=5000):
+        fitsFileId,fitsFileDate,key=row[0],row[1],row[2:]
+        if current is None or key!=current['key'] or fitsFileDate-current['end']>gap:
+            current={'type':frameType,'key':key,'fields':dict(zip(keyFields,key)),
+                     'start':fitsFileDate,'end':fitsFileDate,'frames':[],'sequenceId':None}
+            plan.append(current)
+        current['end']=fitsFileDate
+        current['frames'].append(fitsFileId)
+    if joinExisting:
+        joinExistingSequences(plan,gap)
+    logging.info(f"Planned {len(plan)} {frameType} sequences")
+    return plan
+
+#################################################################################################################
+## joinExistingSequences - this function gives each planned sequence the id of the existing sequence with the  ##
+##                         same fields that has a frame within the gap of its frames, the nearest if there are ##
+##                         several. The frames already in sequences around the plan are read in one query      ##
+#################################################################################################################
+def joinExistingSequences(plan,gap=DEFAULT_GAP):
+    if not plan:
+        return plan
+    frameType=plan[0]['type']
+    keyFields=SEQUENCE_FIELDS[frameType]
+    start=min(planned['start'] for planned in plan)-gap
+    end=max(planned['end'] for planned in plan)+gap
+    rows=(fitsFile.objects.filter(fitsFileType=frameType,fitsFileSequence__isnull=False,fitsFileDate__range=(start,end))
+                          .values_list('fitsFileDate','fitsFileSequence',*keyFields))
+    assigned={}
+    for row in rows.iterator(chunk_size=5000):
+        assigned.setdefault(row[2:],[]).append(row[:2])
+
+    for planned in plan:
+        nearest=None
+        for fitsFileDate,sequenceId in assigned.get(planned['key'],[]):
+            distance=max(planned['start']-fitsFileDate,fitsFileDate-planned['end'],timedelta(0))
+            if distance<=gap and (nearest is None or distance<nearest[0]):
+                nearest=(distance,sequenceId)
+        if nearest:
+            planned['sequenceId']=nearest[1]
+    return plan
+
+#################################################################################################################
+## applySequencePlan - this function creates the sequences of a plan, or for planned sequences that join an    ##
+##                     existing one uses that, assigns their frames and works out their statistics, refreshing ##
+##                     the summaries of their objects unless refreshSummaries is False. Returns the sequence   ##
+##                     id of each planned sequence                                                             ##
+#################################################################################################################
+def applySequencePlan(plan,refreshSummaries=True):
+    if not plan:
+        return []
+    sequenceIds=[]
+    sequences=[]
+    objectNames=set()
+    for planned in plan:
+        fields=planned['fields']
+        objectName=fields['fitsFileObject'] if planned['type'] in LIGHT_TYPES else planned['type']
+        objectNames.add(objectName)
+        if planned.get('sequenceId'):
+            sequenceIds.append(planned['sequenceId'])
+            continue
+        sequences.append(fitsSequence(fitsSequenceId=uuid.uuid4(),
+                                      fitsSequenceObjectName=objectName,
+                                      fitsSequenceDate=planned['start'],
+                                      fitsSequenceTelescope=fields.get('fitsFileTelescop'),
+                                      fitsSequenceImager=fields.get('fitsFileInstrument'),
+                                      fitsMasterBias=None,fitsMasterDark=None,fitsMasterFlat=None))
+        sequenceIds.append(sequences[-1].fitsSequenceId)
+
+    with transaction.atomic():
+        fitsSequence.objects.bulk_create(sequences,batch_size=UPDATE_BATCH_SIZE)
+        for planned,sequenceId in zip(plan,sequenceIds):
+            frames=planned['frames']
+            for i in range(0,len(frames),UPDATE_BATCH_SIZE):
+                fitsFile.objects.filter(fitsFileId__in=frames[i:i+UPDATE_BATCH_SIZE]).update(fitsFileSequence=sequenceId)
+        refreshSequenceStats(sequenceIds)
+        if refreshSummaries:
+            refreshObjectSummaries(objectNames)
+    logging.info(f"Created {len(sequences)} and extended {len(plan)-len(sequences)} sequences for "
+                 f"{sum(len(planned['frames']) for planned in plan)} frames")
+    return sequenceIds
+
+#################################################################################################################
+## moveDerivedRecords - this function moves the records that point at old sequences, calibrated lights,        ##
+##                      masters and observations, to the new sequences their frames went to. moved maps old    ##
+##                      sequence ids to new ones; records of sequences not in it are left without a sequence   ##
+#################################################################################################################
+def moveDerivedRecords(oldSequences,moved):
+    # Two parameters per sequence in the CASE and one in the IN list
+    batchSize=UPDATE_BATCH_SIZE//2
+    for i in range(0,len(oldSequences),batchSize):
+        batch=oldSequences[i:i+batchSize]
+        newSequence=Case(*[When(fitsFileSequence=old,then=Value(moved[old])) for old in batch if old in moved],
+                         default=Value(None),output_field=fitsFile._meta.get_field('fitsFileSequence'))
+        fitsFile.objects.filter(fitsFileSequence__in=batch).update(fitsFileSequence=newSequence)
+        newSequence=Case(*[When(fitsFileSequence=old,then=Value(moved[old])) for old in batch if old in moved],
+                         default=Value(None),output_field=Observation._meta.get_field('fitsFileSequence'))
+        Observation.objects.filter(fitsFileSequence__in=batch).update(fitsFileSequence=newSequence)
+
+#################################################################################################################
+## rebuildSequences - this function regroups the frames of a queryset, by default every light and calibration  ##
+##                    frame, into new sequences in a single transaction. The frames are cleared with one       ##
+##                    UPDATE and sequences left without frames are deleted, after their calibrated lights,     ##
+##                    masters and observations are moved to the new sequence most of their frames went to.     ##
+##                    With dryRun nothing is changed and the plan is only returned. Returns the plan of every  ##
+##                    type                                                                                     ##
+#################################################################################################################
+def rebuildSequences(frames=None,gap=DEFAULT_GAP,dryRun=False):
+    frameTypes=LIGHT_TYPES+CALIBRATION_TYPES
+    wholeArchive=frames is None
+    if wholeArchive:
+        frames=fitsFile.objects.all()
+    frames=frames.filter(fitsFileType__in=frameTypes)
+
+    if dryRun:
+        return [planned for frameType in frameTypes for planned in planSequences(frameType,frames,gap)]
+
+    with transaction.atomic():
+        previous=dict(frames.filter(fitsFileSequence__isnull=False).values_list('fitsFileId','fitsFileSequence').iterator(chunk_size=5000))
+        if wholeArchive:
+            oldSequences=list(fitsSequence.objects.values_list('fitsSequenceId',flat=True))
+        else:
+            oldSequences=list(set(previous.values()))
+            oldObjects=sequenceObjectNames(oldSequences)
+        cleared=frames.update(fitsFileSequence=None)
+        logging.info(f"Cleared the sequence of {cleared} frames")
+
+        plan=[]
+        votes={}
+        for frameType in frameTypes:
+            typePlan=planSequences(frameType,frames,gap)
+            for planned,sequenceId in zip(typePlan,applySequencePlan(typePlan,refreshSummaries=False)):
+                for fitsFileId in planned['frames']:
+                    if fitsFileId in previous:
+                        counts=votes.setdefault(previous[fitsFileId],{})
+                        counts[sequenceId]=counts.get(sequenceId,0)+1
+            plan+=typePlan
+        moved={old:max(counts,key=counts.get) for old,counts in votes.items()}
+
+        # Sequences that still have frames outside the rebuilt range are kept, the rest are emptied and deleted
+        emptied=[]
+        for i in range(0,len(oldSequences),UPDATE_BATCH_SIZE):
+            batch=oldSequences[i:i+UPDATE_BATCH_SIZE]
+            stillUsed=set(fitsFile.objects.filter(fitsFileSequence__in=batch,fitsFileType__in=frameTypes)
+                                          .values_list('fitsFileSequence',flat=True).distinct())
+            emptied+=[sequenceId for sequenceId in batch if sequenceId not in stillUsed]
+        moveDerivedRecords(emptied,moved)
+        for i in range(0,len(emptied),UPDATE_BATCH_SIZE):
+            fitsSequence.objects.filter(fitsSequenceId__in=emptied[i:i+UPDATE_BATCH_SIZE]).delete()
+        if not wholeArchive:
+            refreshSequenceStats(set(oldSequences)-set(emptied))
+
+        # Objects that lost sequences as well as those that gained them
+        if wholeArchive:
+            refreshObjectSummaries()
+        else:
+            refreshObjectSummaries(oldObjects|{planned['fields']['fitsFileObject'] for planned in plan if planned['type'] in LIGHT_TYPES})
+    return plan
@@ -0,0 +1,142 @@
+############################################################################################################
+## S U M M A R I E S                                                                                      ##
+############################################################################################################
+# Precomputed statistics of sequences and objects. Each sequence carries its frame count, integration,
+# per-filter counts and integration, CCD temperature range, date span and how many of its lights have been
+# calibrated, worked out with one grouped query per batch of sequences. Objects are rolled up from their
+# light sequences for the sequence list: how many sequences, when the object was first and last imaged,
+# with which telescopes and imagers, how many light frames and their total exposure. Both are refreshed
+# for just the sequences and objects that changed, by the sequencing code when it creates sequences and
+# assigns frames and by PostProcess when frames are deleted or calibrated. Called with no ids or names
+# they rebuild everything.
+#
+from django.db import transaction
+from django.db.models import Count, Sum, Min, Max, Q
+
+from observations.models import fitsFile, fitsSequence, fitsObjectSummary
+
+import logging
+logging=logging.getLogger(__name__)
+
+# Sequences of these names hold calibration frames, not an object
+CALIBRATION_NAMES=['Bias','Dark','Flat']
+# Frames counted in a sequence's statistics, not its calibrated copies or masters
+STATS_TYPES=['Light']+CALIBRATION_NAMES
+STATS_FIELDS=['fitsSequenceFrameCount','fitsSequenceIntegration','fitsSequenceFilters','fitsSequenceTempMin',
+              'fitsSequenceTempMax','fitsSequenceStart','fitsSequenceEnd','fitsSequenceCalibratedCount']
+BATCH_SIZE=500
+
+#################################################################################################################
+## sequenceObjectNames - this function returns the object names of sequences from their ids                    ##
+#################################################################################################################
+def sequenceObjectNames(sequenceIds):
+    sequenceIds=[sequenceId for sequenceId in set(sequenceIds) if sequenceId]
+    names=set()
+    for i in range(0,len(sequenceIds),BATCH_SIZE):
+        names.update(fitsSequence.objects.filter(fitsSequenceId__in=sequenceIds[i:i+BATCH_SIZE])
+                                         .values_list('fitsSequenceObjectName',flat=True))
+    return names
+
+#################################################################################################################
+## refreshSequenceStats - this function recomputes the statistics of a list of sequences, or of every sequence  ##
+##                        when sequenceIds is None. Returns the number of sequences updated                     ##
+#################################################################################################################
+def refreshSequenceStats(sequenceIds=None):
+    if sequenceIds is None:
+        sequenceIds=list(fitsSequence.objects.values_list('fitsSequenceId',flat=True))
+    else:
+        sequenceIds=[sequenceId for sequenceId in set(sequenceIds) if sequenceId]
+
+    updated=0
+    with transaction.atomic():
+        for i in range(0,len(sequenceIds),BATCH_SIZE):
+            batch=sequenceIds[i:i+BATCH_SIZE]
+            sequences={sequence.fitsSequenceId:sequence for sequence in fitsSequence.objects.filter(fitsSequenceId__in=batch).only('fitsSequenceId')}
+            for sequence in sequences.values():
+                sequence.fitsSequenceFrameCount=0
+                sequence.fitsSequenceIntegration=0
+                sequence.fitsSequenceFilters={}
+                sequence.fitsSequenceTempMin=sequence.fitsSequenceTempMax=None
+                sequence.fitsSequenceStart=sequence.fitsSequenceEnd=None
+                sequence.fitsSequenceCalibratedCount=0
+
+            # One row per sequence and filter
+            rows=(fitsFile.objects.filter(fitsFileSequence__in=batch,fitsFileType__in=STATS_TYPES)
+                                  .values('fitsFileSequence','fitsFileFilter')
+                                  .annotate(frames=Count('fitsFileId'),exposure=Sum('fitsFileExpTime'),
+                                            tempMin=Min('fitsFileCCDTemp'),tempMax=Max('fitsFileCCDTemp'),
+                                            start=Min('fitsFileDate'),end=Max('fitsFileDate'),
+                                            calibrated=Count('fitsFileId',filter=Q(fitsFileCalibrated=True))))
+            for row in rows:
+                sequence=sequences.get(row['fitsFileSequence'])
+                if sequence is None:
+                    continue
+                exposure=row['exposure'] or 0
+                sequence.fitsSequenceFrameCount+=row['frames']
+                sequence.fitsSequenceIntegration+=exposure
+                sequence.fitsSequenceCalibratedCount+=row['calibrated']
+                sequence.fitsSequenceFilters[row['fitsFileFilter'] or 'None']={'frames':row['frames'],'integration':exposure}
+                if row['tempMin'] is not None and (sequence.fitsSequenceTempMin is None or row['tempMin']<sequence.fitsSequenceTempMin):
+                    sequence.fitsSequenceTempMin=row['tempMin']
+                if row['tempMax'] is not None and (sequence.fitsSequenceTempMax is None or row['tempMax']>sequence.fitsSequenceTempMax):
+                    sequence.fitsSequenceTempMax=row['tempMax']
+                if row['start'] and (sequence.fitsSequenceStart is None or row['start']<sequence.fitsSequenceStart):
+                    sequence.fitsSequenceStart=row['start']
+                if row['end'] and (sequence.fitsSequenceEnd is None or row['end']>sequence.fitsSequenceEnd):
+                    sequence.fitsSequenceEnd=row['end']
+            fitsSequence.objects.bulk_update(sequences.values(),STATS_FIELDS,batch_size=BATCH_SIZE)
+            updated+=len(sequences)
+    logging.info(f"Refreshed the statistics of {updated} sequences")
+    return updated
+
+#################################################################################################################
+## refreshObjectSummaries - this function recomputes the summaries of a list of object names, or of every      ##
+##                          object when objectNames is None, from the statistics of their light sequences.     ##
+##                          Objects left without sequences lose their summary. Returns the number of summaries ##
+##                          written                                                                            ##
+#################################################################################################################
+def refreshObjectSummaries(objectNames=None):
+    sequences=fitsSequence.objects.exclude(fitsSequenceObjectName__in=CALIBRATION_NAMES).exclude(fitsSequenceObjectName__isnull=True)
+    if objectNames is None:
+        batches=[None]
+    else:
+        names=sorted({name for name in objectNames if name and name not in CALIBRATION_NAMES})
+        if not names:
+            return 0
+        batches=[names[i:i+BATCH_SIZE] for i in range(0,len(names),BATCH_SIZE)]
+
+    written=0
+    with transaction.atomic():
+        for batch in batches:
+            batchSequences=sequences if batch is None else sequences.filter(fitsSequenceObjectName__in=batch)
+            summaries={}
+            for name,date,telescope,imager,frames,integration,end in batchSequences.values_list(
+                    'fitsSequenceObjectName','fitsSequenceDate','fitsSequenceTelescope','fitsSequenceImager',
+                    'fitsSequenceFrameCount','fitsSequenceIntegration','fitsSequenceEnd'):
+                summary=summaries.setdefault(name,fitsObjectSummary(fitsObjectName=name,fitsObjectTelescopes=[],fitsObjectImagers=[]))
+                summary.fitsObjectSequenceCount+=1
+                summary.fitsObjectFrameCount+=frames
+                summary.fitsObjectIntegration+=integration
+                if date and (summary.fitsObjectFirstDate is None or date<summary.fitsObjectFirstDate):
+                    summary.fitsObjectFirstDate=date
+                for last in (date,end):
+                    if last and (summary.fitsObjectLastDate is None or last>summary.fitsObjectLastDate):
+                        summary.fitsObjectLastDate=last
+                if telescope and telescope not in summary.fitsObjectTelescopes:
+                    summary.fitsObjectTelescopes.append(telescope)
+                if imager and imager not in summary.fitsObjectImagers:
+                    summary.fitsObjectImagers.append(imager)
+
+            for summary in summaries.values():
+                summary.fitsObjectTelescopes.sort()
+                summary.fitsObjectImagers.sort()
+            if batch is None:
+                fitsObjectSummary.objects.all().delete()
+            else:
+                fitsObjectSummary.objects.filter(fitsObjectName__in=batch).exclude(fitsObjectName__in=list(summaries)).delete()
+            fitsObjectSummary.objects.bulk_create(summaries.values(),batch_size=BATCH_SIZE,update_conflicts=True,
+                                                  unique_fields=['fitsObjectName'],
+                                                  update_fields=[field.name for field in fitsObjectSummary._meta.fields if not field.primary_key])
+            written+=len(summaries)
+    logging.info(f"Refreshed {written} object summaries")
+    return written
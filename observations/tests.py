@@ -1,3 +1,870 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, IntegrityError
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from django.core.management import call_command
 
-# Create your tests here.
+import errno
+import io
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from unittest import mock
+import numpy as np
+from astropy.io import fits
+
+from config.models import RepositoryConfig
+from observations.models import fitsFile, fitsSequence, fitsObjectSummary, Observation
+from observations.postProcess import PostProcess
+from observations.fitsHeader import readHeader
+from observations.masterCombine import combineFrames
+from observations.calibrateWorker import calibrateFrame
+from observations.thumbnails import blockAverage, renderThumbnail, writeThumbnail
+from observations.preview import PreviewRenderer, regionAverage, MAX_STRETCHES
+from observations.views import fitsFileNeighbours, fitsFilePage
+from observations.sequencing import planSequences, rebuildSequences
+from observations.summaries import refreshObjectSummaries
+from observations.fileTransfer import FileTransfer
+from observations.repoManifest import walkRepository
+from observations.watcher import Debouncer, PollingWatcher, InotifyWatcher, IngestDaemon, fileSignature
+from datetime import timedelta
+from PIL import Image
+
+##################################################################################################
+## makeFitsFile - helper that writes a small FITS frame with the cards EKOS would write         ##
+##################################################################################################
+def makeFitsFile(path, imageType="Light", objectName="M 31", dateObs="2024-10-01T03:00:00.000",
+                 exposure=60.0, data=None, **cards):
+    if data is None:
+        data = np.random.default_rng(0).integers(0, 4000, size=(40, 60)).astype(np.uint16)
+    hdu = fits.PrimaryHDU(data)
+    hdr = hdu.header
+    hdr["IMAGETYP"] = imageType
+    hdr["DATE-OBS"] = dateObs
+    if objectName is not None and imageType == "Light":
+        hdr["OBJECT"] = objectName
+    hdr["EXPTIME"] = exposure
+    hdr["XBINNING"] = 1
+    hdr["YBINNING"] = 1
+    hdr["CCD-TEMP"] = -10.0
+    hdr["TELESCOP"] = "Test Scope"
+    hdr["INSTRUME"] = "Test Cam"
+    for key, value in cards.items():
+        hdr[key.replace('_', '-')] = value
+    hdu.writeto(path, overwrite=True)
+    return path
+
+class RepoTestCase(TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.sourceFolder = os.path.join(self.tempDir, "incoming/")
+        self.repoFolder = os.path.join(self.tempDir, "repo/")
+        os.makedirs(self.sourceFolder)
+        os.makedirs(self.repoFolder)
+        RepositoryConfig.objects.create(ppsourcepath=self.sourceFolder, pprepopath=self.repoFolder)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+class RegisterFitsImagesTests(RepoTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(6):
+            makeFitsFile(os.path.join(self.repoFolder, f"light_{i}.fits"),
+                         dateObs=f"2024-10-01T03:0{i}:00.000", FILTER="Ha")
+        makeFitsFile(os.path.join(self.repoFolder, "bias_0.fits"), imageType="Bias", exposure=0.0)
+        with open(os.path.join(self.repoFolder, "notes.txt"), "w") as f:
+            f.write("not a fits file")
+
+    def test_serial_registration(self):
+        registered = PostProcess().registerFitsImages(moveFiles=False)
+        self.assertEqual(len(registered), 7)
+        self.assertEqual(fitsFile.objects.count(), 7)
+        self.assertEqual(fitsFile.objects.filter(fitsFileType="Light", fitsFileObject="M31").count(), 6)
+
+    def test_parallel_registration_matches_serial(self):
+        registered = PostProcess().registerFitsImages(moveFiles=False, workers=2, batchSize=3)
+        self.assertEqual(len(registered), 7)
+        self.assertEqual(set(registered), set(fitsFile.objects.values_list('fitsFileId', flat=True)))
+        self.assertEqual(len(os.listdir(os.path.join(self.repoFolder, 'Thumbnails'))), 7)
+
+    def test_batches_use_bulk_inserts(self):
+        with CaptureQueriesContext(connection) as queries:
+            registered = PostProcess().registerFitsImages(moveFiles=False, batchSize=4)
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(registered), 7)
+        self.assertEqual(len(inserts), 2)
+
+    def test_header_numbers_are_stored_as_numbers(self):
+        makeFitsFile(os.path.join(self.repoFolder, "light_gain.fits"), dateObs="2024-10-01T04:00:00.000",
+                     FILTER="OIII", GAIN=120, OFFSET="30", XBINNING=2)
+        PostProcess().registerFitsImages(moveFiles=False)
+        light = fitsFile.objects.get(fitsFileFilter="OIII")
+        self.assertEqual((light.fitsFileExpTime, light.fitsFileXBinning, light.fitsFileCCDTemp), (60.0, 2, -10.0))
+        self.assertEqual((light.fitsFileGain, light.fitsFileOffset), (120.0, 30))
+        self.assertEqual(fitsFile.objects.filter(fitsFileType="Light", fitsFileExpTime__gte=30, fitsFileGain__isnull=True).count(), 6)
+
+    def test_already_registered_files_are_skipped(self):
+        first = PostProcess().registerFitsImages(moveFiles=False)
+        second = PostProcess().registerFitsImages(moveFiles=False)
+        self.assertEqual(len(first), 7)
+        self.assertEqual(second, [])
+        self.assertEqual(fitsFile.objects.count(), 7)
+
+class FileTransferTests(RepoTestCase):
+    def writeFile(self, name, content=b"frame data"):
+        path = os.path.join(self.sourceFolder, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_move_within_a_filesystem(self):
+        transfer = FileTransfer()
+        source = self.writeFile("a.fits")
+        destination = os.path.join(self.repoFolder, "M31", "a.fits")
+        with mock.patch('observations.fileTransfer.os.makedirs', wraps=os.makedirs) as makedirs:
+            self.assertEqual(transfer.move(source, destination), destination)
+            # A second file with the same name is stored alongside, never over the first
+            self.assertEqual(transfer.move(self.writeFile("a.fits", b"other"), destination), destination.replace(".fits", "_dup.fits"))
+        self.assertEqual(makedirs.call_count, 1)
+        self.assertFalse(os.path.exists(source))
+        with open(destination, "rb") as f:
+            self.assertEqual(f.read(), b"frame data")
+        self.assertEqual(transfer.stats['duplicates'], 1)
+
+    def test_move_across_filesystems(self):
+        transfer = FileTransfer()
+        source = self.writeFile("b.fits", os.urandom(200000))
+        os.utime(source, ns=(1700000000000000000, 1700000000000000000))
+        with open(source, "rb") as f:
+            content = f.read()
+        destination = os.path.join(self.repoFolder, "b.fits")
+        # Links out of the source folder cross a device, links within the repo don't
+        def link(path, candidate, link=os.link):
+            if path.startswith(self.sourceFolder):
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            return link(path, candidate)
+        with mock.patch('observations.fileTransfer.os.link', side_effect=link), \
+             mock.patch('observations.fileTransfer.os.copy_file_range', side_effect=OSError(errno.ENOSYS, "Not supported"), create=True):
+            self.assertEqual(transfer.move(source, destination), destination)
+        with open(destination, "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.stat(destination).st_mtime_ns, 1700000000000000000)
+        self.assertEqual(os.listdir(self.repoFolder), ["b.fits"])
+        self.assertEqual((transfer.stats['copied'], transfer.stats['bytesCopied']), (1, 200000))
+
+    def test_ingest_moves_files_before_registering(self):
+        source = makeFitsFile(os.path.join(self.sourceFolder, "light.fits"))
+        registered = PostProcess().registerFitsImages()
+        record = fitsFile.objects.get(fitsFileId=registered[0])
+        self.assertTrue(record.fitsFileName.startswith(os.path.join(self.repoFolder, "Light", "M31")))
+        self.assertTrue(os.path.exists(record.fitsFileName))
+        self.assertFalse(os.path.exists(source))
+
+    def test_files_are_returned_when_their_records_fail(self):
+        source = makeFitsFile(os.path.join(self.sourceFolder, "light.fits"))
+        failure = IntegrityError("database is locked")
+        with mock.patch('django.db.models.query.QuerySet.bulk_create', side_effect=failure), \
+             mock.patch.object(fitsFile, 'save', side_effect=failure):
+            self.assertEqual(PostProcess().registerFitsImages(), [])
+        self.assertTrue(os.path.exists(source))
+        self.assertEqual(sum(len(files) for root, dirs, files in os.walk(os.path.join(self.repoFolder, "Light"))), 0)
+
+class DeduplicationTests(RepoTestCase):
+    def test_copies_are_set_aside(self):
+        first = makeFitsFile(os.path.join(self.sourceFolder, "light.fits"))
+        with open(first, "rb") as f:
+            content = f.read()
+        # A file with no registered file of the same date and size is never hashed
+        with mock.patch('observations.postProcess.contentHash') as contentHash:
+            self.assertEqual(len(PostProcess().registerFitsImages()), 1)
+        contentHash.assert_not_called()
+        self.assertIsNone(fitsFile.objects.get().fitsFileHash)
+
+        for name in ("light_copy.fits", "light_copy2.fits"):
+            with open(os.path.join(self.sourceFolder, name), "wb") as f:
+                f.write(content)
+        postProcess = PostProcess()
+        self.assertEqual(postProcess.registerFitsImages(batchSize=1), [])
+        self.assertEqual(os.listdir(self.sourceFolder), [])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.repoFolder, "Duplicates"))), ["light_copy.fits", "light_copy2.fits"])
+        self.assertEqual(fitsFile.objects.count(), 1)
+        self.assertEqual(len(fitsFile.objects.get().fitsFileHash), 64)
+
+        with open(os.path.join(self.sourceFolder, "light_copy3.fits"), "wb") as f:
+            f.write(content)
+        postProcess.removeDuplicates = True
+        self.assertEqual(postProcess.registerFitsImages(), [])
+        self.assertEqual(os.listdir(self.sourceFolder), [])
+        self.assertEqual(len(os.listdir(os.path.join(self.repoFolder, "Duplicates"))), 2)
+
+    def test_dedupe_repo(self):
+        makeFitsFile(os.path.join(self.sourceFolder, "light.fits"))
+        makeFitsFile(os.path.join(self.sourceFolder, "other.fits"), dateObs="2024-10-01T04:00:00.000")
+        PostProcess().registerFitsImages()
+        original, other = fitsFile.objects.order_by('fitsFileDate').values_list('fitsFileName', flat=True)
+        # Records from before content hashes, for a copy and a second record for the same file
+        copy = original.replace(".fits", "_dup.fits")
+        shutil.copyfile(original, copy)
+        fitsFile.objects.update(fitsFileHash=None)
+        for fileName, registered in ((copy, original), (other, other)):
+            record = fitsFile.objects.get(fitsFileName=registered)
+            fitsFile.objects.create(fitsFileName=fileName, fitsFileType="Light", fitsFileDate=record.fitsFileDate, fitsFileSize=record.fitsFileSize)
+        self.assertEqual(fitsFile.objects.count(), 4)
+
+        call_command('dedupe_repo', '--dry-run', stdout=io.StringIO())
+        self.assertEqual(fitsFile.objects.count(), 4)
+        self.assertFalse(fitsFile.objects.filter(fitsFileHash__isnull=False).exists())
+        self.assertTrue(os.path.exists(copy))
+
+        results = PostProcess().dedupeRepository(batchSize=2)
+        self.assertEqual((results['hashed'], results['duplicates']), (2, 2))
+        self.assertEqual(results['bytes'], os.path.getsize(original))
+        self.assertFalse(os.path.exists(copy))
+        self.assertTrue(os.path.exists(other))
+        self.assertEqual(sorted(fitsFile.objects.values_list('fitsFileName', flat=True)), [original, other])
+        self.assertFalse(fitsFile.objects.filter(fitsFileHash__isnull=True).exists())
+
+class IncrementalSyncTests(RepoTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            makeFitsFile(os.path.join(self.repoFolder, f"light_{i}.fits"), dateObs=f"2024-10-01T03:0{i}:00.000")
+
+    def test_unchanged_files_are_not_opened(self):
+        first = PostProcess().syncRepository()
+        self.assertEqual(len(first['inserted']), 3)
+        with mock.patch('observations.ingestWorker.readHeader') as readHeader:
+            second = PostProcess().syncRepository()
+        readHeader.assert_not_called()
+        self.assertEqual(second['unchanged'], 3)
+        self.assertEqual(fitsFile.objects.count(), 3)
+
+    def test_changed_added_and_removed_files(self):
+        PostProcess().syncRepository()
+        os.remove(os.path.join(self.repoFolder, "light_0.fits"))
+        makeFitsFile(os.path.join(self.repoFolder, "light_1.fits"), objectName="M 42", dateObs="2024-10-01T03:01:00.000")
+        makeFitsFile(os.path.join(self.repoFolder, "light_3.fits"), dateObs="2024-10-01T03:03:00.000")
+        results = PostProcess().syncRepository()
+        self.assertEqual(results['deleted'], 1)
+        self.assertEqual(results['updated'], 1)
+        self.assertEqual(len(results['inserted']), 2)
+        self.assertEqual(results['unchanged'], 1)
+        self.assertEqual(sorted(fitsFile.objects.values_list('fitsFileObject', flat=True)), ["M31", "M31", "M42"])
+
+    def test_records_are_kept_while_a_file_maps_to_them(self):
+        copy = os.path.join(self.repoFolder, "light_0_dup.fits")
+        shutil.copyfile(os.path.join(self.repoFolder, "light_0.fits"), copy)
+        self.assertEqual(len(PostProcess().syncRepository()['inserted']), 3)
+        # The copy was skipped, so removing it leaves the original's record
+        os.remove(copy)
+        self.assertEqual(PostProcess().syncRepository()['deleted'], 0)
+        self.assertEqual(fitsFile.objects.count(), 3)
+        # A full sync finds each file's own record again
+        self.assertEqual(PostProcess().syncRepository(full=True)['inserted'], [])
+        os.remove(os.path.join(self.repoFolder, "light_0.fits"))
+        self.assertEqual(PostProcess().syncRepository()['deleted'], 1)
+        self.assertEqual(fitsFile.objects.count(), 2)
+
+class FitsHeaderTests(SimpleTestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.fileName = makeFitsFile(os.path.join(self.tempDir, "light.fits"), FILTER="O'III", CDELT1=1e-4)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_values_match_astropy(self):
+        hdr = readHeader(self.fileName)
+        astropyHeader = fits.getheader(self.fileName)
+        for keyword in ["IMAGETYP", "DATE-OBS", "OBJECT", "EXPTIME", "XBINNING", "CCD-TEMP", "FILTER", "CDELT1", "NAXIS1"]:
+            self.assertEqual(hdr[keyword], astropyHeader[keyword])
+
+    def test_unchanged_card_is_not_written(self):
+        with open(self.fileName, 'rb') as f:
+            before = f.read()
+        hdr = readHeader(self.fileName)
+        self.assertFalse(hdr.set("OBJECT", "M 31"))
+        self.assertFalse(hdr.flush())
+        with open(self.fileName, 'rb') as f:
+            self.assertEqual(f.read(), before)
+
+    def test_edits_are_made_in_place(self):
+        size = os.path.getsize(self.fileName)
+        hdr = readHeader(self.fileName)
+        hdr.set("OBJECT", "M31", "Adjusted via Obsy")
+        hdr.set("CD1_1", 1.5e-4, "Adjusted via Obsy")
+        hdr.flush()
+        self.assertEqual(os.path.getsize(self.fileName), size)
+        with fits.open(self.fileName) as hdul:
+            self.assertEqual(hdul[0].header["OBJECT"], "M31")
+            self.assertEqual(hdul[0].header["CD1_1"], 1.5e-4)
+            self.assertEqual(hdul[0].data.shape, (40, 60))
+
+    def test_full_header_falls_back_to_astropy(self):
+        hdr = readHeader(self.fileName)
+        for i in range(40):
+            hdr.set(f"KEY{i}", i)
+        hdr.flush()
+        reread = readHeader(self.fileName)
+        self.assertEqual(reread["KEY39"], 39)
+        self.assertEqual(fits.getdata(self.fileName).shape, (40, 60))
+
+class CombineFramesTests(SimpleTestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        rng = np.random.default_rng(1)
+        self.stack = rng.integers(1000, 60000, size=(7, 50, 30)).astype(np.uint16)
+        self.stack[3, 10, 5] = 65000  # a hot pixel for clipping to remove
+        self.fileNames = []
+        for i, frame in enumerate(self.stack):
+            fileName = os.path.join(self.tempDir, f"bias_{i}.fits")
+            fits.PrimaryHDU(frame).writeto(fileName)
+            self.fileNames.append(fileName)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_median_in_small_tiles_matches_numpy(self):
+        combined, count = combineFrames(self.fileNames, method='median', memoryBudget=7*30*4*4*3)
+        self.assertEqual(count, 7)
+        self.assertEqual(combined.dtype, np.float32)
+        np.testing.assert_allclose(combined, np.median(self.stack.astype(np.float64), axis=0))
+
+    def test_mean_matches_numpy(self):
+        combined, count = combineFrames(self.fileNames, method='mean', memoryBudget=1)
+        np.testing.assert_allclose(combined, self.stack.astype(np.float64).mean(axis=0), rtol=1e-6)
+
+    def test_sigma_clipped_mean_rejects_outliers(self):
+        stack = np.full((7, 4, 4), 100, dtype=np.float32)
+        stack[:, 0, 0] = [100, 101, 99, 100, 101, 99, 5000]
+        fileNames = []
+        for i, frame in enumerate(stack):
+            fileName = os.path.join(self.tempDir, f"flat_{i}.fits")
+            fits.PrimaryHDU(frame).writeto(fileName)
+            fileNames.append(fileName)
+        combined, count = combineFrames(fileNames, method='sigmaclip', sigma=2.0)
+        self.assertAlmostEqual(float(combined[0, 0]), 100.0, places=3)
+        self.assertTrue(np.all(combined[1:] == 100))
+
+    def test_mismatched_and_missing_frames_are_skipped(self):
+        odd = os.path.join(self.tempDir, "odd.fits")
+        fits.PrimaryHDU(np.zeros((10, 10), dtype=np.uint16)).writeto(odd)
+        combined, count = combineFrames(self.fileNames + [odd, os.path.join(self.tempDir, "missing.fits")])
+        self.assertEqual(count, 7)
+        self.assertEqual(combined.shape, (50, 30))
+
+class ThumbnailTests(SimpleTestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempDir)
+        self.fileName = makeFitsFile(os.path.join(self.tempDir, "light.fits"),
+                                     data=np.arange(600 * 400, dtype=np.uint16).reshape(400, 600))
+
+    def test_block_average(self):
+        data = np.arange(36, dtype=np.float32).reshape(6, 6)
+        np.testing.assert_array_equal(blockAverage(data, 3), [[7, 10], [25, 28]])
+
+    def test_thumbnail_fits_size_and_is_scaled(self):
+        image = renderThumbnail(self.fileName, size=100)
+        self.assertEqual(image.shape, (66, 100))
+        self.assertEqual(image.dtype, np.uint8)
+        self.assertEqual((image.min(), image.max()), (0, 255))
+
+    def test_existing_thumbnail_is_reused(self):
+        thumbnailFolder = os.path.join(self.tempDir, "Thumbnails")
+        first = writeThumbnail(self.fileName, thumbnailFolder)
+        with Image.open(first) as image:
+            self.assertEqual(image.size, (200, 133))
+        with mock.patch('observations.thumbnails.renderThumbnail') as render:
+            self.assertEqual(writeThumbnail(self.fileName, thumbnailFolder), first)
+        render.assert_not_called()
+        self.assertNotEqual(writeThumbnail(self.fileName, thumbnailFolder, fmt='webp'), first)
+
+class PreviewTests(RepoTestCase):
+    def setUp(self):
+        super().setUp()
+        fileName = makeFitsFile(os.path.join(self.repoFolder, "light.fits"),
+                                data=np.arange(300 * 500, dtype=np.uint16).reshape(300, 500))
+        self.fitsFile = fitsFile.objects.create(fitsFileName=fileName, fitsFileType="Light", fitsFileDate="2024-10-01T03:00:00Z")
+        self.client.force_login(get_user_model().objects.create_user(username="observer", password="secret"))
+
+    def test_region_average_keeps_partial_blocks(self):
+        data = np.arange(25, dtype=np.float32).reshape(5, 5)
+        np.testing.assert_array_equal(regionAverage(data, 0, 5, 0, 5, 2), [[3, 5, 6.5], [13, 15, 16.5], [20.5, 22.5, 24]])
+
+    def test_tile_pyramid(self):
+        renderer = PreviewRenderer(os.path.join(self.repoFolder, "Previews"), self.fitsFile.fitsFileId, self.fitsFile.fitsFileName)
+        self.assertEqual(renderer.info()['maxLevel'], 9)
+        with Image.open(renderer.tile(9, 1, 1)) as tile:
+            self.assertEqual(tile.size, (244, 44))
+        with Image.open(renderer.tile(0, 0, 0)) as tile:
+            self.assertEqual(tile.size, (1, 1))
+        self.assertIsNone(renderer.tile(9, 2, 0))
+        self.assertIsNone(renderer.tile(10, 0, 0))
+
+    def test_preview_served_with_etag(self):
+        url = reverse('fits_file_preview', args=[self.fitsFile.pk])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        with mock.patch('observations.preview.PreviewRenderer.render') as render:
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            self.assertEqual(self.client.get(url).status_code, 200)
+        render.assert_not_called()
+        self.assertNotEqual(self.client.get(url, {'low': 5}).get('ETag'), response['ETag'])
+        self.assertEqual(self.client.get(url, {'low': 'bright'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'low': 50, 'high': 10}).status_code, 400)
+
+    def test_old_stretches_are_pruned(self):
+        previewFolder = os.path.join(self.repoFolder, "Previews")
+        renderers = [PreviewRenderer(previewFolder, self.fitsFile.fitsFileId, self.fitsFile.fitsFileName, low=low)
+                     for low in range(MAX_STRETCHES + 2)]
+        for i, renderer in enumerate(renderers):
+            renderer.info()
+            os.utime(renderer.folder, (1700000000 + i, 1700000000 + i))
+        self.assertEqual(sorted(os.listdir(os.path.join(previewFolder, str(self.fitsFile.fitsFileId)))),
+                         sorted(renderer.etag for renderer in renderers[-MAX_STRETCHES:]))
+
+    def test_detail_page_links_preview(self):
+        response = self.client.get(reverse('fits_file_detail', args=[self.fitsFile.pk]))
+        self.assertContains(response, reverse('fits_file_preview', args=[self.fitsFile.pk]))
+        self.assertContains(response, reverse('fits_file_dzi', args=[self.fitsFile.pk]))
+        self.assertEqual(self.client.get(reverse('fits_file_tile', args=[self.fitsFile.pk, 9, 5, 5])).status_code, 404)
+
+class FitsFileNavigationTests(TestCase):
+    def setUp(self):
+        self.sequence = uuid.uuid4()
+        self.files = [fitsFile.objects.create(fitsFileName=f"/repo/file_{i}.fits", fitsFileType="Light",
+                                              fitsFileObject="M31" if i % 2 else "M42",
+                                              fitsFileSequence=self.sequence if i < 3 else None,
+                                              fitsFileDate="2024-10-01T03:00:00Z") for i in range(6)]
+
+    def test_neighbours_by_name(self):
+        with self.assertNumQueries(4):
+            first, prev, next, last = fitsFileNeighbours(self.files[2])
+        self.assertEqual([first, prev, next, last], [self.files[0], self.files[1], self.files[3], self.files[5]])
+        self.assertEqual(fitsFileNeighbours(self.files[0])[:2], (None, None))
+        self.assertEqual(fitsFileNeighbours(self.files[5])[2:], (None, None))
+
+    def test_neighbours_within_scope(self):
+        self.assertEqual(fitsFileNeighbours(self.files[1], 'sequence'), (self.files[0], self.files[0], self.files[2], self.files[2]))
+        self.assertEqual(fitsFileNeighbours(self.files[3], 'object'), (self.files[1], self.files[1], self.files[5], self.files[5]))
+
+    def test_duplicate_names_are_ordered_by_id(self):
+        twins = sorted([fitsFile.objects.create(fitsFileName="/repo/twin.fits", fitsFileDate="2024-10-01T03:00:00Z")
+                        for i in range(2)], key=lambda f: f.pk)
+        self.assertEqual(fitsFileNeighbours(twins[0])[2], twins[1])
+        self.assertEqual(fitsFileNeighbours(twins[1])[1], twins[0])
+
+class FitsFileBrowserTests(TestCase):
+    def setUp(self):
+        for i in range(7):
+            fitsFile.objects.create(fitsFileName=f"/repo/Light/M31/light_{i}.fits", fitsFileType="Light",
+                                    fitsFileObject="M31" if i < 5 else "M42", fitsFileFilter="Ha" if i % 2 else "OIII",
+                                    fitsFileCalibrated=i == 0, fitsFileDate=f"2024-10-0{i + 1}T03:00:00Z")
+        fitsFile.objects.create(fitsFileName="/repo/bias.fits", fitsFileType="Bias", fitsFileDate="2024-10-09T03:00:00Z")
+        self.client.force_login(get_user_model().objects.create_user(username="observer", password="secret"))
+
+    def test_pages_follow_cursors(self):
+        url = reverse('list_fits_files_api')
+        first = self.client.get(url, {'page_size': 3}).json()
+        self.assertEqual([row['fitsFileName'] for row in first['results']], ["light_6.fits", "light_5.fits", "light_4.fits"])
+        self.assertIsNone(first['previous'])
+        with self.assertNumQueries(1):
+            second = fitsFilePage({'page_size': 3, 'after': first['next']})
+        self.assertEqual([row['fitsFileName'] for row in second['results']], ["light_3.fits", "light_2.fits", "light_1.fits"])
+        last = self.client.get(url, {'page_size': 3, 'after': second['next']}).json()
+        self.assertEqual([row['fitsFileName'] for row in last['results']], ["light_0.fits"])
+        self.assertIsNone(last['next'])
+        back = self.client.get(url, {'page_size': 3, 'before': last['previous']}).json()
+        self.assertEqual(back['results'], self.client.get(url, {'page_size': 3, 'after': first['next']}).json()['results'])
+
+    def test_filters(self):
+        page = fitsFilePage({'object': 'M31', 'filter': 'Ha', 'calibrated': 'no'})
+        self.assertEqual([row['fitsFileName'] for row in page['results']], ["light_3.fits", "light_1.fits"])
+        page = fitsFilePage({'date_from': '2024-10-02', 'date_to': '2024-10-03'})
+        self.assertEqual(len(page['results']), 2)
+        self.assertEqual(fitsFilePage({'type': 'Bias'})['results'][0]['displayName'], "Bias")
+
+    def test_bad_cursor_is_rejected(self):
+        self.assertEqual(self.client.get(reverse('list_fits_files'), {'after': 'nonsense'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('list_fits_files'), {'date_from': '2024-13-45'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('list_fits_files_api'), {'date_to': 'yesterday'}).status_code, 400)
+        response = self.client.get(reverse('list_fits_files'), {'object': 'M42'})
+        self.assertContains(response, "light_6.fits")
+        self.assertNotContains(response, "light_4.fits")
+
+class WatcherTests(RepoTestCase):
+    def test_debouncer_waits_for_writes_to_stop(self):
+        path = makeFitsFile(os.path.join(self.sourceFolder, "light.fits"))
+        debouncer = Debouncer(settle=2.0)
+        debouncer.touch(path, fileSignature(path), now=100.0)
+        self.assertEqual(debouncer.ready(101.0), [])
+        # Still being written when it was due to settle, so it waits again
+        with open(path, "ab") as f:
+            f.write(b"\0" * 2880)
+        self.assertEqual(debouncer.ready(102.0), [])
+        self.assertEqual(debouncer.ready(104.0), [(path, fileSignature(path))])
+        self.assertEqual(len(debouncer), 0)
+
+    def test_polling_watcher_reports_changes(self):
+        watcher = PollingWatcher(self.sourceFolder, interval=0)
+        path = makeFitsFile(os.path.join(self.sourceFolder, "light.fits"))
+        open(os.path.join(self.sourceFolder, "notes.txt"), "w").close()
+        self.assertEqual(watcher.poll(), [(path, fileSignature(path))])
+        self.assertEqual(watcher.poll(), [])
+        os.remove(path)
+        self.assertEqual(watcher.poll(), [(path, None)])
+
+    def test_full_queue_holds_back_the_watcher(self):
+        paths = [makeFitsFile(os.path.join(self.sourceFolder, f"light_{i}.fits")) for i in range(5)]
+        watcher = mock.Mock(folder=self.sourceFolder)
+        watcher.name = "test"
+        watcher.poll.side_effect = lambda timeout: [(path, fileSignature(path)) for path in paths]
+        daemon = IngestDaemon(PostProcess(), watcher, settle=0, queueSize=2, batchSize=10, batchWindow=0)
+        daemon.start()
+        try:
+            deadline = time.monotonic() + 5
+            while daemon.queue.qsize() < 2 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            time.sleep(0.2)
+            self.assertEqual(daemon.queue.qsize(), 2)
+            self.assertEqual(len(daemon.nextBatch()), 2)
+        finally:
+            daemon.stop()
+            daemon.thread.join()
+
+    def test_new_files_are_registered(self):
+        try:
+            watcher = InotifyWatcher(self.sourceFolder)
+        except OSError as e:
+            self.skipTest(str(e))
+        daemon = IngestDaemon(PostProcess(), watcher, settle=0.2, batchWindow=0.2)
+        daemon.start()
+        try:
+            os.makedirs(os.path.join(self.sourceFolder, "M 31"))
+            makeFitsFile(os.path.join(self.sourceFolder, "M 31", "light.fits"))
+            registered = []
+            deadline = time.monotonic() + 10
+            while not registered and time.monotonic() < deadline:
+                registered = daemon.processNext()
+        finally:
+            daemon.stop()
+            daemon.thread.join()
+        self.assertEqual(len(registered), 1)
+        self.assertIsNotNone(fitsFile.objects.get(fitsFileId=registered[0]).fitsFileSequence)
+
+    def test_batches_from_one_night_share_a_sequence(self):
+        watcher = mock.Mock(folder=self.sourceFolder)
+        daemon = IngestDaemon(PostProcess(), watcher, batchWindow=0)
+        registered = []
+        for i in range(2):
+            daemon.queue.put(makeFitsFile(os.path.join(self.sourceFolder, f"light_{i}.fits"), dateObs=f"2024-10-01T03:{i * 30:02d}:00.000"))
+            registered += daemon.processNext()
+        self.assertEqual(len(registered), 2)
+        self.assertEqual(fitsSequence.objects.count(), 1)
+        sequence = fitsSequence.objects.get()
+        self.assertEqual(set(fitsFile.objects.values_list('fitsFileSequence', flat=True)), {sequence.fitsSequenceId})
+        self.assertEqual(sequence.fitsSequenceFrameCount, 2)
+
+class SequencingTests(TestCase):
+    def setUp(self):
+        # Two nights of M31, a target change, then M31 again on another telescope, and a night of bias frames
+        frames = [("Light", "M31", "Scope A", "2024-10-01T03:00:00Z"), ("Light", "M31", "Scope A", "2024-10-01T03:05:00Z"),
+                  ("Light", "M42", "Scope A", "2024-10-01T05:00:00Z"), ("Light", "M31", "Scope A", "2024-10-03T03:00:00Z"),
+                  ("Light", "M31", "Scope B", "2024-10-01T03:10:00Z"),
+                  ("Bias", None, "Scope A", "2024-10-01T12:00:00Z"), ("Bias", None, "Scope A", "2024-10-01T12:01:00Z")]
+        for i, (frameType, objectName, telescope, date) in enumerate(frames):
+            fitsFile.objects.create(fitsFileName=f"frame_{i}.fits", fitsFileType=frameType, fitsFileObject=objectName,
+                                    fitsFileTelescop=telescope, fitsFileInstrument="Test Cam", fitsFileDate=date)
+
+    def sequenceOf(self, name):
+        return fitsFile.objects.get(fitsFileName=name).fitsFileSequence
+
+    def test_light_sequences(self):
+        # The unassigned frames, then the frames already in sequences around them
+        with self.assertNumQueries(2):
+            plan = planSequences("Light")
+        self.assertEqual([len(planned['frames']) for planned in plan], [2, 1, 1, 1])
+        created = PostProcess().createLightSequences()
+        self.assertEqual(len(created), 4)
+        self.assertEqual(self.sequenceOf("frame_0.fits"), self.sequenceOf("frame_1.fits"))
+        self.assertEqual(len({self.sequenceOf(f"frame_{i}.fits") for i in [0, 2, 3, 4]}), 4)
+        sequence = fitsSequence.objects.get(fitsSequenceId=self.sequenceOf("frame_4.fits"))
+        self.assertEqual((sequence.fitsSequenceObjectName, sequence.fitsSequenceTelescope), ("M31", "Scope B"))
+
+    def test_gap_threshold(self):
+        PostProcess().createLightSequences(gap=timedelta(days=3))
+        self.assertEqual(self.sequenceOf("frame_0.fits"), self.sequenceOf("frame_3.fits"))
+
+    def test_later_frames_join_the_nights_sequence(self):
+        PostProcess().createLightSequences()
+        fitsFile.objects.create(fitsFileName="frame_7.fits", fitsFileType="Light", fitsFileObject="M31",
+                                fitsFileTelescop="Scope A", fitsFileInstrument="Test Cam", fitsFileDate="2024-10-01T04:00:00Z")
+        fitsFile.objects.create(fitsFileName="frame_8.fits", fitsFileType="Light", fitsFileObject="M31",
+                                fitsFileTelescop="Scope A", fitsFileInstrument="Test Cam", fitsFileDate="2024-10-02T18:00:00Z")
+        created = PostProcess().createLightSequences()
+        self.assertEqual(self.sequenceOf("frame_7.fits"), self.sequenceOf("frame_0.fits"))
+        # Nearer the next night's frames than the first night's
+        self.assertEqual(self.sequenceOf("frame_8.fits"), self.sequenceOf("frame_3.fits"))
+        self.assertEqual(fitsSequence.objects.count(), 4)
+        self.assertEqual(len(created), 2)
+        self.assertEqual(fitsSequence.objects.get(fitsSequenceId=self.sequenceOf("frame_0.fits")).fitsSequenceFrameCount, 3)
+
+    def test_calibration_sequences_are_bulk_written(self):
+        postProcess = PostProcess()
+        # Planning each type, then for the Bias sequence the sequences it could join, its insert, frame assignment and statistics
+        with self.assertNumQueries(13):
+            created = postProcess.createCalibrationSequences()
+        self.assertEqual(len(created), 1)
+        self.assertEqual(fitsSequence.objects.get().fitsSequenceObjectName, "Bias")
+        self.assertEqual(fitsFile.objects.filter(fitsFileSequence=created[0]).count(), 2)
+
+    def test_rebuild_dry_run_changes_nothing(self):
+        PostProcess().createLightSequences()
+        before = dict(fitsFile.objects.values_list('fitsFileName', 'fitsFileSequence'))
+        out = io.StringIO()
+        call_command('create_sequences', '--dry-run', stdout=out)
+        self.assertIn("Dry run, would create 4 light and 1 calibration sequences for 7 frames", out.getvalue())
+        self.assertEqual(dict(fitsFile.objects.values_list('fitsFileName', 'fitsFileSequence')), before)
+
+    def test_rebuild_date_range(self):
+        PostProcess().createLightSequences()
+        keep = self.sequenceOf("frame_3.fits")
+        rebuilt = self.sequenceOf("frame_0.fits")
+        with CaptureQueriesContext(connection) as queries:
+            rebuildSequences(fitsFile.objects.filter(fitsFileDate__date__lte="2024-10-01"))
+        # One UPDATE clears the range, one assigns each of the 4 new sequences, one writes the statistics of each type's
+        # and two move the calibrated lights, masters and observations of the emptied sequence
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE')]), 9)
+        self.assertEqual(self.sequenceOf("frame_3.fits"), keep)
+        self.assertNotEqual(self.sequenceOf("frame_0.fits"), rebuilt)
+        self.assertFalse(fitsSequence.objects.filter(fitsSequenceId=rebuilt).exists())
+        self.assertEqual(fitsSequence.objects.count(), 5)
+        self.assertFalse(fitsFile.objects.filter(fitsFileSequence__isnull=True).exists())
+
+    def test_rebuild_keeps_calibrated_lights_and_masters(self):
+        PostProcess().createSequences(["Light", "Bias"])
+        lightSequence = self.sequenceOf("frame_0.fits")
+        biasSequence = self.sequenceOf("frame_5.fits")
+        fitsFile.objects.create(fitsFileName="Calibrated/frame_0.fits", fitsFileType="CalibratedLight", fitsFileSequence=lightSequence)
+        fitsFile.objects.create(fitsFileName="Masters/bias.fits", fitsFileType="MasterBias", fitsFileSequence=biasSequence)
+        observation = Observation.objects.create(targetId=uuid.uuid4(), targetName="M31", userId="1", fitsFileSequence_id=lightSequence)
+        rebuildSequences()
+        self.assertFalse(fitsSequence.objects.filter(fitsSequenceId__in=[lightSequence, biasSequence]).exists())
+        self.assertEqual(self.sequenceOf("Calibrated/frame_0.fits"), self.sequenceOf("frame_0.fits"))
+        self.assertEqual(self.sequenceOf("Masters/bias.fits"), self.sequenceOf("frame_5.fits"))
+        observation.refresh_from_db()
+        self.assertEqual(observation.fitsFileSequence_id, self.sequenceOf("frame_0.fits"))
+        self.assertEqual(fitsSequence.objects.count(), 5)
+
+class ObjectSummaryTests(TestCase):
+    def setUp(self):
+        # The frames of SequencingTests, with light exposures to total
+        SequencingTests.setUp(self)
+        fitsFile.objects.filter(fitsFileType="Light").update(fitsFileExpTime=300.0)
+
+    def summaries(self):
+        return {summary.fitsObjectName: summary for summary in fitsObjectSummary.objects.all()}
+
+    def test_summaries_follow_new_sequences(self):
+        PostProcess().createSequences(["Light", "Bias"])
+        summaries = self.summaries()
+        self.assertEqual(set(summaries), {"M31", "M42"})
+        self.assertEqual((summaries["M31"].fitsObjectSequenceCount, summaries["M31"].fitsObjectFrameCount), (3, 4))
+        self.assertEqual(summaries["M31"].fitsObjectIntegration, 1200.0)
+        self.assertEqual(summaries["M31"].fitsObjectTelescopes, ["Scope A", "Scope B"])
+        self.assertEqual(summaries["M31"].fitsObjectLastDate.isoformat(), "2024-10-03T03:00:00+00:00")
+        self.assertEqual(refreshObjectSummaries(), 2)
+        self.assertEqual(self.summaries()["M31"].fitsObjectFrameCount, 4)
+
+    def test_rebuild_and_delete_update_summaries(self):
+        PostProcess().createLightSequences()
+        fitsFile.objects.filter(fitsFileName="frame_2.fits").update(fitsFileObject="M31")
+        rebuildSequences(fitsFile.objects.filter(fitsFileDate__date__lte="2024-10-01"))
+        self.assertEqual(set(self.summaries()), {"M31"})
+        self.assertEqual(self.summaries()["M31"].fitsObjectFrameCount, 5)
+        PostProcess().deleteRegisteredFiles(["frame_0.fits", "frame_1.fits"])
+        self.assertEqual(self.summaries()["M31"].fitsObjectFrameCount, 3)
+        self.assertEqual(self.summaries()["M31"].fitsObjectIntegration, 900.0)
+
+    def test_sequence_stats(self):
+        fitsFile.objects.filter(fitsFileName__in=["frame_0.fits", "frame_3.fits"]).update(fitsFileFilter="Ha", fitsFileCCDTemp=-10.5)
+        fitsFile.objects.filter(fitsFileName="frame_1.fits").update(fitsFileFilter="OIII", fitsFileCCDTemp=-9.5, fitsFileCalibrated=True)
+        PostProcess().createLightSequences(gap=timedelta(days=3))
+        sequence = fitsSequence.objects.get(fitsSequenceId=fitsFile.objects.get(fitsFileName="frame_0.fits").fitsFileSequence)
+        self.assertEqual(sequence.fitsSequenceFilters, {"Ha": {"frames": 2, "integration": 600.0}, "OIII": {"frames": 1, "integration": 300.0}})
+        self.assertEqual((sequence.fitsSequenceFrameCount, sequence.fitsSequenceIntegration), (3, 900.0))
+        self.assertEqual((sequence.fitsSequenceTempMin, sequence.fitsSequenceTempMax), (-10.5, -9.5))
+        self.assertEqual((sequence.fitsSequenceStart.isoformat(), sequence.fitsSequenceEnd.isoformat()),
+                         ("2024-10-01T03:00:00+00:00", "2024-10-03T03:00:00+00:00"))
+        self.assertEqual((sequence.fitsSequenceCalibratedCount, sequence.calibratedPercent), (1, 33))
+        PostProcess().deleteRegisteredFiles(["frame_3.fits"])
+        sequence.refresh_from_db()
+        self.assertEqual(sequence.fitsSequenceFilters["Ha"], {"frames": 1, "integration": 300.0})
+
+    def test_sequence_detail_pages_frames(self):
+        PostProcess().createLightSequences()
+        sequenceId = fitsFile.objects.get(fitsFileName="frame_0.fits").fitsFileSequence
+        fitsFile.objects.bulk_create([fitsFile(fitsFileName=f"extra_{i}.fits", fitsFileType="Light", fitsFileSequence=sequenceId,
+                                               fitsFileDate=f"2024-10-01T04:{i:02}:00Z") for i in range(60)])
+        get_user_model().objects.create_user(username="observer", password="secret")
+        self.client.login(username="observer", password="secret")
+        response = self.client.get(reverse('fits_sequence_detail', args=[sequenceId]), {'lights': 2})
+        self.assertEqual(len(response.context['light_frames']), 12)
+        self.assertEqual(response.context['light_frames'].paginator.count, 62)
+        self.assertEqual(response.context['light_frames'][-1].fitsFileName, "extra_59.fits")
+
+    def test_list_pages_in_the_database(self):
+        PostProcess().createLightSequences()
+        for i in range(20):
+            fitsObjectSummary.objects.create(fitsObjectName=f"Abell {i:04}")
+        # Count and page of summaries, then the sequences of the page's objects
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('fits_file_sequence_list'))
+        rows = response.context['fits_file_sequences']
+        self.assertEqual(len(rows), 15)
+        self.assertEqual(response.context['paginator'].num_pages, 2)
+        response = self.client.get(reverse('fits_file_sequence_list'), {'page': 2})
+        summary, sequences = response.context['fits_file_sequences'][-1]
+        self.assertEqual((summary.fitsObjectName, len(sequences)), ("M42", 1))
+        self.assertContains(response, reverse('fits_sequence_detail', args=[sequences[0].fitsSequenceId]))
+
+class MasterFrameTests(RepoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.oldSequence, self.newSequence = uuid.uuid4(), uuid.uuid4()
+        for i, (sequence, date) in enumerate([(self.oldSequence, "2024-09-01T01:00:00Z"), (self.newSequence, "2024-10-01T01:00:00Z"),
+                                              (self.newSequence, "2024-10-01T01:01:00Z"), (self.newSequence, "2024-10-01T01:02:00Z")]):
+            fileName = makeFitsFile(os.path.join(self.repoFolder, f"bias_{i}.fits"), imageType="Bias", exposure=0.0,
+                                    data=np.full((40, 60), 100 + i, dtype=np.uint16))
+            fitsFile.objects.create(fitsFileName=fileName, fitsFileType="Bias", fitsFileDate=date, fitsFileSequence=sequence,
+                                    fitsFileTelescop="Test Scope", fitsFileInstrument="Test Cam")
+        for i in range(3):
+            fitsFile.objects.create(fitsFileName=f"light_{i}.fits", fitsFileType="Light", fitsFileDate=f"2024-10-01T0{3+i}:00:00Z",
+                                    fitsFileTelescop="Test Scope", fitsFileInstrument="Test Cam")
+        self.lights = list(fitsFile.objects.filter(fitsFileType="Light").order_by('fitsFileDate'))
+
+    def test_master_bias_from_latest_bias_sequence(self):
+        masterId = PostProcess().createMasterBias(self.lights[0])
+        master = fitsFile.objects.get(fitsFileId=masterId)
+        self.assertEqual(master.fitsFileType, "MasterBias")
+        self.assertEqual(master.fitsFileSequence, self.newSequence)
+        np.testing.assert_array_equal(fits.getdata(master.fitsFileName), np.full((40, 60), 102, dtype=np.float32))
+
+    def test_master_bias_matches_ccd_temperature(self):
+        fitsFile.objects.filter(fitsFileSequence=self.newSequence).update(fitsFileCCDTemp=-20.0)
+        fitsFile.objects.filter(fitsFileSequence=self.oldSequence).update(fitsFileCCDTemp=-10.2)
+        fitsFile.objects.filter(fitsFileType="Light").update(fitsFileCCDTemp=-9.8)
+        light = fitsFile.objects.filter(fitsFileType="Light").first()
+        master = fitsFile.objects.get(fitsFileId=PostProcess().createMasterBias(light))
+        self.assertEqual(master.fitsFileSequence, self.oldSequence)
+
+    def test_master_is_built_once_per_night(self):
+        postProcess = PostProcess()
+        with mock.patch('observations.postProcess.combineFrames', wraps=combineFrames) as combine:
+            masterIds = {postProcess.createMasterBias(light) for light in self.lights}
+        self.assertEqual(len(masterIds), 1)
+        self.assertEqual(combine.call_count, 1)
+        self.assertEqual(postProcess.masterCache.hits, 2)
+
+    def test_master_on_disk_is_reused(self):
+        masterId = PostProcess().createMasterBias(self.lights[0])
+        with mock.patch('observations.postProcess.combineFrames') as combine:
+            self.assertEqual(PostProcess().createMasterBias(self.lights[1]), masterId)
+        combine.assert_not_called()
+        self.assertEqual(fitsFile.objects.filter(fitsFileType="MasterBias").count(), 1)
+
+    def test_master_flats_matched_on_filter(self):
+        flatSequences = {"Ha": uuid.uuid4(), "OIII": uuid.uuid4()}
+        for i, filterName in enumerate(["Ha", "OIII", "Ha", "OIII"]):
+            fileName = makeFitsFile(os.path.join(self.repoFolder, f"flat_{i}.fits"), imageType="Flat", exposure=1.0,
+                                    data=np.full((40, 60), 20000 + 10000 * (filterName == "OIII"), dtype=np.uint16), FILTER=filterName)
+            fitsFile.objects.create(fitsFileName=fileName, fitsFileType="Flat", fitsFileDate=f"2024-10-01T01:1{i}:00Z",
+                                    fitsFileSequence=flatSequences[filterName], fitsFileFilter=filterName,
+                                    fitsFileTelescop="Test Scope", fitsFileInstrument="Test Cam")
+        fitsFile.objects.filter(fitsFileId=self.lights[0].fitsFileId).update(fitsFileFilter="Ha")
+        fitsFile.objects.filter(fitsFileId=self.lights[1].fitsFileId).update(fitsFileFilter="OIII")
+        postProcess = PostProcess()
+        masters = [fitsFile.objects.get(fitsFileId=postProcess.createMasterFlat(light))
+                   for light in fitsFile.objects.filter(fitsFileType="Light").order_by('fitsFileDate')[:2]]
+        self.assertNotEqual(masters[0].fitsFileName, masters[1].fitsFileName)
+        self.assertEqual([(master.fitsFileFilter, master.fitsFileSequence) for master in masters],
+                         [("Ha", flatSequences["Ha"]), ("OIII", flatSequences["OIII"])])
+
+    def test_master_flat_is_bias_subtracted(self):
+        # Vignetted corners at half the illumination of the centre, on top of the 102 pedestal of the master bias
+        flatSequence = uuid.uuid4()
+        for i in range(3):
+            data = np.full((40, 60), 102 + 2000 * (i + 1), dtype=np.uint16)
+            data[:10, :15] = 102 + 1000 * (i + 1)
+            fileName = makeFitsFile(os.path.join(self.repoFolder, f"flat_{i}.fits"), imageType="Flat", exposure=1.0, data=data)
+            fitsFile.objects.create(fitsFileName=fileName, fitsFileType="Flat", fitsFileDate=f"2024-10-01T01:1{i}:00Z",
+                                    fitsFileSequence=flatSequence, fitsFileTelescop="Test Scope", fitsFileInstrument="Test Cam")
+        master = fitsFile.objects.get(fitsFileId=PostProcess().createMasterFlat(self.lights[0]))
+        data = fits.getdata(master.fitsFileName)
+        np.testing.assert_allclose(data[0, 0], 0.5, rtol=1e-6)
+        np.testing.assert_allclose(data[20, 30], 1.0, rtol=1e-6)
+
+    def makeLightFrames(self):
+        fitsFile.objects.filter(fitsFileType="Light").delete()
+        self.lightSequence = uuid.uuid4()
+        fitsSequence.objects.create(fitsSequenceId=self.lightSequence, fitsSequenceObjectName="M 31")
+        os.makedirs(os.path.join(self.repoFolder, "Light", "M 31"))
+        for i in range(3):
+            fileName = makeFitsFile(os.path.join(self.repoFolder, "Light", "M 31", f"light_{i}.fits"), imageType="Light",
+                                    data=np.full((40, 60), 1000 + i, dtype=np.uint16))
+            fitsFile.objects.create(fitsFileName=fileName, fitsFileType="Light", fitsFileDate=f"2024-10-01T0{3+i}:00:00Z",
+                                    fitsFileSequence=self.lightSequence, fitsFileTelescop="Test Scope", fitsFileInstrument="Test Cam")
+
+    def test_lights_calibrated_in_one_batch(self):
+        self.makeLightFrames()
+        with CaptureQueriesContext(connection) as queries:
+            results = PostProcess().calibrateFitsImages(batchSize=10)
+        self.assertEqual(len(results['calibrated']), 3)
+        self.assertEqual(results['failed'], 0)
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('INSERT INTO "observations_fitsfile"')]), 2)
+        self.assertFalse(fitsFile.objects.filter(fitsFileType="Light", fitsFileCalibrated=False).exists())
+
+        calibrated = fitsFile.objects.get(fitsFileType="CalibratedLight", fitsFileName__endswith="light_1.fits")
+        self.assertTrue(calibrated.fitsFileName.startswith(os.path.join(self.repoFolder, "Calibrated", "M 31")))
+        with fits.open(calibrated.fitsFileName) as hdul:
+            np.testing.assert_array_equal(hdul[0].data, np.full((40, 60), 1001 - 102, dtype=np.float32))
+            self.assertEqual(hdul[0].header['CALSTAT'], "B")
+            self.assertEqual(hdul[0].header['IMAGETYP'], "CalibratedLight")
+        master = fitsFile.objects.get(fitsFileType="MasterBias")
+        sequence = fitsSequence.objects.get(fitsSequenceId=self.lightSequence)
+        self.assertEqual(sequence.fitsMasterBias, str(master.fitsFileId))
+        # Calibrated copies are not counted as frames of the sequence, but its coverage is updated
+        self.assertEqual((sequence.fitsSequenceFrameCount, sequence.fitsSequenceCalibratedCount), (3, 3))
+
+    def test_derived_files_are_not_registered_again(self):
+        self.makeLightFrames()
+        PostProcess().calibrateFitsImages()
+        walked = [os.path.relpath(root, self.repoFolder) for root, file, stat in walkRepository(self.repoFolder)]
+        self.assertEqual(sorted(set(walked)), [".", os.path.join("Light", "M 31")])
+        self.assertTrue(os.listdir(os.path.join(self.repoFolder, "Calibrated", "M 31")))
+        registered = PostProcess().registerFitsImages(moveFiles=False)
+        self.assertFalse(fitsFile.objects.filter(fitsFileId__in=registered).exclude(fitsFileType__in=["Light", "Bias"]).exists())
+
+    def test_lights_without_masters_fail(self):
+        self.makeLightFrames()
+        fitsFile.objects.filter(fitsFileType="Bias").delete()
+        results = PostProcess().calibrateFitsImages()
+        self.assertEqual(results['calibrated'], [])
+        self.assertEqual(results['failed'], 3)
+
+    def test_master_rebuilt_in_place_is_reread(self):
+        light = makeFitsFile(os.path.join(self.tempDir, "light.fits"), data=np.full((40, 60), 1000, dtype=np.uint16))
+        bias = makeFitsFile(os.path.join(self.tempDir, "master_bias.fits"), imageType="MasterBias", data=np.full((40, 60), 100, dtype=np.uint16))
+        output = os.path.join(self.tempDir, "calibrated.fits")
+        calibrateFrame(light, output, biasFileName=bias)
+        makeFitsFile(bias, imageType="MasterBias", data=np.full((40, 60), 200, dtype=np.uint16))
+        stat = os.stat(bias)
+        os.utime(bias, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+        calibrateFrame(light, output, biasFileName=bias)
+        np.testing.assert_array_equal(fits.getdata(output), np.full((40, 60), 800, dtype=np.float32))
@@ -0,0 +1,161 @@
+############################################################################################################
+## T H U M B N A I L S                                                                                    ##
+############################################################################################################
+# Thumbnails for FITS images. The image is memory mapped and block averaged a band of rows at a time, so
+# only a few MB are resident however large the frame is, then stretched between percentiles taken from a
+# sample of the pixels and encoded with Pillow. Thumbnails are named from a hash of the FITS header, the
+# file size and the render settings, so an existing thumbnail is found without opening the image and a
+# changed file or setting gets a new one. The thumbnail folder is a cache, pruneThumbnails keeps it
+# under a size limit.
+#
+from astropy.io import fits
+from PIL import Image
+import numpy as np
+import hashlib
+import os
+
+from observations.fitsHeader import readHeader
+
+import logging
+logging=logging.getLogger(__name__)
+
+THUMBNAIL_SIZE=256
+THUMBNAIL_FORMATS={'jpg':'JPEG','webp':'WEBP'}
+DEFAULT_FORMAT='jpg'
+DEFAULT_QUALITY=85
+DEFAULT_STRETCH=(0.5,99.8)
+MAX_CACHE_BYTES=1024*1024*1024
+
+# Rows of float32 read per band while block averaging
+BAND_BYTES=16*1024*1024
+# Pixels sampled to estimate the stretch percentiles
+STRETCH_SAMPLE=65536
+
+#################################################################################################################
+## thumbnailName - this function returns the file name of the thumbnail of an image with the given header       ##
+#################################################################################################################
+def thumbnailName(headerBytes,fileSize,size=THUMBNAIL_SIZE,fmt=DEFAULT_FORMAT,stretch=DEFAULT_STRETCH):
+    digest=hashlib.blake2b(headerBytes,digest_size=16)
+    digest.update(f"|{fileSize}|{size}|{stretch[0]}|{stretch[1]}".encode('ascii'))
+    return f"thumbnail_{digest.hexdigest()}.{fmt}"
+
+#################################################################################################################
+## blockAverage - this function shrinks a 2D array by averaging factor x factor blocks, reading a band of rows  ##
+##                at a time so a memory mapped image is never loaded whole                                     ##
+#################################################################################################################
+def blockAverage(data,factor):
+    height,width=data.shape
+    factor=max(1,min(factor,height,width))
+    outHeight,outWidth=height//factor,width//factor
+    result=np.empty((outHeight,outWidth),dtype=np.float32)
+    rowsPerBand=max(1,BAND_BYTES//(factor*width*4))
+    for y0 in range(0,outHeight,rowsPerBand):
+        y1=min(outHeight,y0+rowsPerBand)
+        band=np.asarray(data[y0*factor:y1*factor,:outWidth*factor],dtype=np.float32)
+        result[y0:y1]=band.reshape(y1-y0,factor,outWidth,factor).mean(axis=(1,3))
+    return result
+
+#################################################################################################################
+## stretchLimits - this function returns the values at two percentiles of an image, estimated from a sample    ##
+#################################################################################################################
+def stretchLimits(image,low=DEFAULT_STRETCH[0],high=DEFAULT_STRETCH[1]):
+    step=max(1,int(np.sqrt(image.size/STRETCH_SAMPLE)))
+    sample=np.asarray(image[::step,::step],dtype=np.float32)
+    sample=sample[np.isfinite(sample)]
+    if sample.size==0:
+        return 0.0,1.0
+    lower,upper=np.percentile(sample,[low,high])
+    if upper<=lower:
+        upper=lower+1.0
+    return float(lower),float(upper)
+
+#################################################################################################################
+## applyStretch - this function scales an image to 8 bits between two limits, with an optional asinh curve     ##
+##                that lifts faint detail (smaller asinh is a harder stretch, 0 is linear)                     ##
+#################################################################################################################
+def applyStretch(image,lower,upper,asinh=0.0):
+    scaled=np.clip((image-lower)*(1.0/(upper-lower)),0.0,1.0)
+    np.nan_to_num(scaled,copy=False,nan=0.0)
+    if asinh>0:
+        scaled=np.arcsinh(scaled/asinh)/np.arcsinh(1.0/asinh)
+    return (scaled*255.0+0.5).astype(np.uint8)
+
+#################################################################################################################
+## stretchImage - this function scales an image to 8 bits between two percentiles estimated from a sample     ##
+#################################################################################################################
+def stretchImage(image,low=DEFAULT_STRETCH[0],high=DEFAULT_STRETCH[1]):
+    return applyStretch(image,*stretchLimits(image,low,high))
+
+#################################################################################################################
+## renderThumbnail - this function returns an 8 bit thumbnail of the primary image of a FITS file, no larger   ##
+##                   than size pixels on its longest side                                                     ##
+#################################################################################################################
+def renderThumbnail(fitsFileName,size=THUMBNAIL_SIZE,stretch=DEFAULT_STRETCH):
+    with fits.open(fitsFileName,memmap=True,do_not_scale_image_data=True) as hdul:
+        hdr=hdul[0].header
+        data=hdul[0].data
+        if data is None:
+            raise ValueError("No image in primary HDU")
+        # Colour cubes are previewed from their first plane
+        while data.ndim>2:
+            data=data[0]
+        factor=int(np.ceil(max(data.shape)/size))
+        image=blockAverage(data,factor)
+        # Scaling is linear so it can be applied after averaging
+        bscale,bzero=float(hdr.get('BSCALE',1.0)),float(hdr.get('BZERO',0.0))
+        if bscale!=1.0:
+            image*=bscale
+        if bzero!=0.0:
+            image+=bzero
+    return stretchImage(image,*stretch)
+
+#################################################################################################################
+## writeThumbnail - this function makes the thumbnail of a FITS file in a folder unless it already exists.     ##
+##                  Returns the thumbnail path, or None if the file could not be read                          ##
+#################################################################################################################
+def writeThumbnail(fitsFileName,thumbnailFolder,size=THUMBNAIL_SIZE,fmt=DEFAULT_FORMAT,quality=DEFAULT_QUALITY,
+                   stretch=DEFAULT_STRETCH,headerBytes=None):
+    try:
+        if headerBytes is None:
+            headerBytes=readHeader(fitsFileName).headerBytes()
+        thumbnailPath=os.path.join(thumbnailFolder,thumbnailName(headerBytes,os.path.getsize(fitsFileName),size,fmt,stretch))
+        if os.path.exists(thumbnailPath):
+            # Mark it as used so pruning drops the thumbnails nobody looks at first
+            os.utime(thumbnailPath)
+            return thumbnailPath
+
+        image=Image.fromarray(renderThumbnail(fitsFileName,size,stretch),mode='L')
+        os.makedirs(thumbnailFolder,exist_ok=True)
+        tempPath=thumbnailPath+'.tmp'
+        image.save(tempPath,format=THUMBNAIL_FORMATS[fmt],quality=quality)
+        os.replace(tempPath,thumbnailPath)
+        logging.info(f"Thumbnail image saved to: {thumbnailPath}")
+        return thumbnailPath
+    except Exception as e:
+        logging.info(f"Failed to create thumbnail for {fitsFileName}: {e}")
+        return None
+
+#################################################################################################################
+## pruneThumbnails - this function deletes the least recently modified thumbnails until the folder is under   ##
+##                   maxBytes. Returns the number of thumbnails deleted                                        ##
+#################################################################################################################
+def pruneThumbnails(thumbnailFolder,maxBytes=MAX_CACHE_BYTES):
+    try:
+        entries=[entry for entry in os.scandir(thumbnailFolder) if entry.is_file() and entry.name.startswith('thumbnail_')]
+    except FileNotFoundError:
+        return 0
+    stats=[(entry.stat().st_mtime,entry.stat().st_size,entry.path) for entry in entries]
+    total=sum(size for mtime,size,path in stats)
+    deleted=0
+    for mtime,size,path in sorted(stats):
+        if total<=maxBytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total-=size
+        deleted+=1
+    if deleted:
+        logging.info(f"Pruned {deleted} thumbnails from {thumbnailFolder}")
+    return deleted
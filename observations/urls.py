@@ -4,7 +4,7 @@ from django.urls import path,include
 from . import views
 from .views import observation_detail_view, observation_all_list
 from .views import observation_create,observation_update,observation_delete,ScheduleUpdateView,ScheduleDeleteView, \
-    scheduleMasterList,ScheduleCreateView, ScheduleDownload, list_fits_files, fitsfile_detail, sequence_file_list, \
+    scheduleMasterList,ScheduleCreateView, ScheduleDownload, list_fits_files, list_fits_files_api, fitsfile_detail, fitsfile_thumbnail, fitsfile_preview, fitsfile_dzi, fitsfile_tile, sequence_file_list, \
     sequence_file_create, sequence_file_edit, sequence_file_delete,observation_updateDS, FitsFileSequenceListView, fits_sequence_detail
 from targets.models import Target
 
@@ -25,7 +25,12 @@ urlpatterns = [
     path('schedule/download/<uuid:pk>/',    ScheduleDownload,             name='schedule_download'),
     # Fits Files
     path('list_fits_files/',                list_fits_files, name='list_fits_files'),
+    path('api/fitsfiles/',                  list_fits_files_api, name='list_fits_files_api'),
     path('fitsfile/<uuid:pk>/',             fitsfile_detail, name='fits_file_detail'),
+    path('fitsfile/<uuid:pk>/thumbnail/',   fitsfile_thumbnail, name='fits_file_thumbnail'),
+    path('fitsfile/<uuid:pk>/preview.jpg',  fitsfile_preview, name='fits_file_preview'),
+    path('fitsfile/<uuid:pk>/preview.dzi',  fitsfile_dzi, name='fits_file_dzi'),
+    path('fitsfile/<uuid:pk>/preview_files/<int:level>/<int:column>_<int:row>.jpg', fitsfile_tile, name='fits_file_tile'),
     path('fitsfilesequences/',              FitsFileSequenceListView.as_view(), name='fits_file_sequence_list'),
     path('fits_sequence/<uuid:pk>/',        fits_sequence_detail, name='fits_sequence_detail'),
     # Sequence Files
@@ -6,10 +6,13 @@ from django.urls import reverse_lazy
 from django.views.generic.edit import UpdateView, DeleteView
 from django.core.mail import send_mail
 from django.utils import timezone
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, FileResponse, Http404, JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib import messages
+from django.db.models import Q
 
 from .forms import ObservationDSForm, SequenceFileForm, ScheduleMasterForm
 from .models import Observation, scheduleMaster,fitsFile,scheduleDetail,sequenceFile,fitsSequence
@@ -17,12 +20,15 @@ from targets.models import Target
 from setup.models import observatory,telescope,imager
 from observations.models import Observation
 from observations.postProcess import PostProcess
+from observations.thumbnails import THUMBNAIL_FORMATS, DEFAULT_FORMAT
+from observations.preview import PreviewRenderer, DEFAULT_LOW, DEFAULT_HIGH, DEFAULT_ASINH
 
 
-import base64
-import io
-import matplotlib.pyplot as plt
-from datetime import timedelta
+import os
+import uuid
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from urllib.parse import urlencode
+from datetime import date, datetime, timedelta
 from astropy import units as u
 from astropy.coordinates import get_constellation
 from astropy.io import fits
@@ -192,33 +198,140 @@ def ScheduleRegen(request, pk):
     return redirect('schedule_list')
 
 ##################################################################################################
-# list_fits_files -  List all FITS files in the database                                        ##
+## fitsFilePage -  One page of the FITS file browser. Files are filtered in the database and   ##
+##                 paged newest first with keyset cursors on (fitsFileDate, fitsFileId), so any ##
+##                 page costs one indexed query however deep it is. Only the listed columns are ##
+##                 fetched and the file name is cut to its basename for the page rows only.     ##
+##################################################################################################
+FITS_PAGE_SIZE = 50
+FITS_MAX_PAGE_SIZE = 500
+FITS_LIST_FIELDS = ['fitsFileId', 'fitsFileName', 'fitsFileType', 'fitsFileObject', 'fitsFileDate', 'fitsFileExpTime',
+                    'fitsFileXBinning', 'fitsFileYBinning', 'fitsFileCCDTemp', 'fitsFileTelescop', 'fitsFileInstrument',
+                    'fitsFileFilter', 'fitsFileCalibrated', 'fitsFileStacked', 'fitsFileSequence']
+FITS_TIME_FILTERS = {'24_hours': timedelta(hours=24), '7_days': timedelta(days=7), '30_days': timedelta(days=30)}
+FITS_TEXT_FILTERS = {'object': 'fitsFileObject', 'telescope': 'fitsFileTelescop', 'instrument': 'fitsFileInstrument',
+                     'filter': 'fitsFileFilter', 'type': 'fitsFileType'}
+
+def encodeCursor(row):
+    return urlsafe_b64encode(f"{row['fitsFileDate'].isoformat()}|{row['fitsFileId']}".encode('ascii')).decode('ascii')
+
+def decodeCursor(cursor):
+    try:
+        date, pk = urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split('|')
+        return datetime.fromisoformat(date), uuid.UUID(pk)
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid page cursor")
+
+def decodeDate(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError("Invalid date " + value)
+
+def fitsFilePage(params):
+    files = fitsFile.objects.filter(fitsFileType=params.get('type') or 'Light')
+    for param, field in FITS_TEXT_FILTERS.items():
+        if param != 'type' and params.get(param):
+            files = files.filter(**{field: params[param]})
+
+    time_filter = params.get('time_filter', 'all')
+    if time_filter in FITS_TIME_FILTERS:
+        files = files.filter(fitsFileDate__gte=timezone.now() - FITS_TIME_FILTERS[time_filter])
+    if params.get('date_from'):
+        files = files.filter(fitsFileDate__date__gte=decodeDate(params['date_from']))
+    if params.get('date_to'):
+        files = files.filter(fitsFileDate__date__lte=decodeDate(params['date_to']))
+    if params.get('calibrated') in ('yes', 'no'):
+        files = files.filter(fitsFileCalibrated=params['calibrated'] == 'yes')
+
+    try:
+        page_size = min(FITS_MAX_PAGE_SIZE, max(1, int(params.get('page_size', FITS_PAGE_SIZE))))
+    except ValueError:
+        page_size = FITS_PAGE_SIZE
+
+    # Fetch one extra row to know whether there is another page in the direction we are going
+    files = files.values(*FITS_LIST_FIELDS)
+    if params.get('before'):
+        date, pk = decodeCursor(params['before'])
+        rows = list(files.filter(Q(fitsFileDate__gt=date) | Q(fitsFileDate=date, fitsFileId__gt=pk))
+                         .order_by('fitsFileDate', 'fitsFileId')[:page_size + 1])
+        has_previous, has_next = len(rows) > page_size, True
+        rows = rows[:page_size][::-1]
+    else:
+        if params.get('after'):
+            date, pk = decodeCursor(params['after'])
+            files = files.filter(Q(fitsFileDate__lt=date) | Q(fitsFileDate=date, fitsFileId__lt=pk))
+        rows = list(files.order_by('-fitsFileDate', '-fitsFileId')[:page_size + 1])
+        has_previous, has_next = bool(params.get('after')), len(rows) > page_size
+        rows = rows[:page_size]
+
+    for row in rows:
+        row['fitsFileName'] = os.path.basename(row['fitsFileName'] or '')
+        row['displayName'] = row['fitsFileType'] if row['fitsFileType'] in ["Flat", "Dark", "Bias"] else row['fitsFileObject']
+    return {
+        'results': rows,
+        'next': encodeCursor(rows[-1]) if rows and has_next else None,
+        'previous': encodeCursor(rows[0]) if rows and has_previous else None,
+    }
+
+##################################################################################################
+# list_fits_files -  Browse the FITS files in the database a page at a time                     ##
 ##################################################################################################
 @login_required
 def list_fits_files(request):
-    time_filter = request.GET.get('time_filter', 'all')
-    now = timezone.now()
-
-    if time_filter == '24_hours':
-        time_threshold = now - timedelta(hours=24)
-    elif time_filter == '7_days':
-        time_threshold = now - timedelta(days=7)
-    elif time_filter == '30_days':
-        time_threshold = now - timedelta(days=30)
-    else:
-        time_threshold = None
-
-    if time_threshold:
-        fits_files = fitsFile.objects.filter(fitsFileDate__gte=time_threshold).filter(fitsFileType='Light').order_by('-fitsFileObject')
-    else:
-        # Get all Light files 
-        fits_files = fitsFile.objects.all().filter(fitsFileType='Light').order_by('-fitsFileObject')
+    try:
+        page = fitsFilePage(request.GET)
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+
+    # Links to the next and previous pages keep the filters
+    filters = request.GET.copy()
+    for param in ['after', 'before']:
+        filters.pop(param, None)
+    context = {
+        'fits_files': page['results'],
+        'time_filter': request.GET.get('time_filter', 'all'),
+        'filters': request.GET,
+        'filter_query': filters.urlencode(),
+        'next_cursor': page['next'],
+        'previous_cursor': page['previous'],
+    }
+    return render(request, 'observations/list_fits_files.html', context)
 
-    # Parse the filename to exclude the path
-    for fits_file in fits_files:
-        fits_file.fitsFileName = fits_file.fitsFileName.split('/')[-1]
-    
-    return render(request, 'observations/list_fits_files.html', {'fits_files': fits_files, 'time_filter': time_filter})
+##################################################################################################
+# list_fits_files_api -  The FITS file browser as JSON                                          ##
+##################################################################################################
+@login_required
+def list_fits_files_api(request):
+    try:
+        page = fitsFilePage(request.GET)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(page)
+
+##################################################################################################
+## fitsFileNeighbours -  The first, previous, next and last files around a FITS file in name    ##
+##                       order, found with keyset queries on (fitsFileName, fitsFileId) so each ##
+##                       is a single indexed lookup. scope limits them to the file's sequence   ##
+##                       or object.                                                             ##
+##################################################################################################
+NAVIGATION_SCOPES = {'all': 'All files', 'sequence': 'This sequence', 'object': 'This object'}
+
+def fitsFileNeighbours(fitsfile, scope='all'):
+    files = fitsFile.objects.only('fitsFileId', 'fitsFileName')
+    if scope == 'sequence':
+        files = files.filter(fitsFileSequence=fitsfile.fitsFileSequence)
+    elif scope == 'object':
+        files = files.filter(fitsFileObject=fitsfile.fitsFileObject)
+
+    name, pk = fitsfile.fitsFileName, fitsfile.pk
+    before = files.filter(Q(fitsFileName__lt=name) | Q(fitsFileName=name, fitsFileId__lt=pk))
+    after = files.filter(Q(fitsFileName__gt=name) | Q(fitsFileName=name, fitsFileId__gt=pk))
+    prev_file = before.order_by('-fitsFileName', '-fitsFileId').first()
+    next_file = after.order_by('fitsFileName', 'fitsFileId').first()
+    first = files.order_by('fitsFileName', 'fitsFileId').first() if prev_file else None
+    last = files.order_by('-fitsFileName', '-fitsFileId').first() if next_file else None
+    return first, prev_file, next_file, last
 
 ##################################################################################################
 ## fitsfile_detail -  Display a detailed view of a FITS file                                    ##
@@ -227,43 +340,21 @@ def list_fits_files(request):
 def fitsfile_detail(request, pk):
     fitsfile = get_object_or_404(fitsFile, pk=pk)
     
-    # Get next/previous files
-    all_files = list(fitsFile.objects.all().order_by('fitsFileName'))
-    current_index = all_files.index(fitsfile)
-    first = all_files[0]
-    last = all_files[-1]
-    prev_file = all_files[current_index - 1] if current_index > 0 else None
-    next_file = all_files[current_index + 1] if current_index < len(all_files)-1 else None
-    
-    # Load FITS data
-    hdul = fits.open(fitsfile.fitsFileName)
-    image_data = hdul[0].data
-    
-    # Apply asinh stretch
-    # Normalize data to 0-1 range first
-    vmin = np.percentile(image_data, 1)
-    vmax = np.percentile(image_data, 99)
-    norm_data = (image_data - vmin) / (vmax - vmin)
-    
-    # Apply asinh stretch
-    a = 0.1  # Adjustable parameter for stretch intensity
-    stretched_data = np.arcsinh(norm_data / a) / np.arcsinh(1 / a)
-    
-    # Convert to displayable image
-    plt.figure(figsize=(14,14))
-    plt.imshow(image_data, cmap='grey', origin='lower', vmin=vmin, vmax=vmax)
-    plt.axis('off')
-    
-    # Save plot to base64 string
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0)
-    buf.seek(0)
-    image_base64 = base64.b64encode(buf.read()).decode('utf-8')
-    plt.close()
-    
+    # Get first/next/previous/last files in the chosen scope
+    scope = request.GET.get('scope', 'all')
+    if scope not in NAVIGATION_SCOPES:
+        scope = 'all'
+    first, prev_file, next_file, last = fitsFileNeighbours(fitsfile, scope)
+
+    # The image itself is served by fitsfile_preview so the page stays small and cacheable
+    stretch = {'low': request.GET.get('low', DEFAULT_LOW), 'high': request.GET.get('high', DEFAULT_HIGH),
+               'asinh': request.GET.get('asinh', DEFAULT_ASINH)}
+
     context = {
         'fitsfile': fitsfile,
-        'image_base64': image_base64,
+        'stretch': urlencode(stretch),
+        'scope': scope,
+        'scopes': NAVIGATION_SCOPES,
         'first': first,
         'prev': prev_file,
         'next': next_file, 
@@ -271,6 +362,85 @@ def fitsfile_detail(request, pk):
     }
     return render(request, 'observations/fits_file_detail.html', context)
 
+##################################################################################################
+## previewRenderer -  The preview renderer of a FITS file for the stretch given in the request, ##
+##                     raises ValueError if the stretch is invalid                              ##
+##################################################################################################
+def previewRenderer(request, pk):
+    fitsfile = get_object_or_404(fitsFile, pk=pk)
+    try:
+        low = float(request.GET.get('low', DEFAULT_LOW))
+        high = float(request.GET.get('high', DEFAULT_HIGH))
+        asinh = float(request.GET.get('asinh', DEFAULT_ASINH))
+    except ValueError:
+        raise ValueError("Invalid stretch")
+    if not (0 <= low < high <= 100) or asinh < 0:
+        raise ValueError("Invalid stretch")
+    try:
+        return PreviewRenderer(PostProcess().previewFolder, fitsfile.fitsFileId, fitsfile.fitsFileName, low, high, asinh)
+    except OSError:
+        raise Http404("FITS file not found")
+
+##################################################################################################
+## servePreviewFile -  Send a rendered preview file, or 304 if the browser already has it       ##
+##################################################################################################
+def servePreviewFile(request, pk, render, content_type):
+    try:
+        renderer = previewRenderer(request, pk)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    etag = quote_etag(renderer.etag)
+    notModified = get_conditional_response(request, etag=etag)
+    if notModified:
+        return notModified
+    try:
+        content = render(renderer)
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to render preview of {renderer.fitsFileName}: {e}")
+        raise Http404("No preview available")
+    if content is None:
+        raise Http404("No such tile")
+    if isinstance(content, str) and os.path.isfile(content):
+        response = FileResponse(open(content, 'rb'), content_type=content_type)
+    else:
+        response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+##################################################################################################
+## fitsfile_preview -  Serve the stretched preview image of a FITS file                         ##
+##################################################################################################
+@login_required
+def fitsfile_preview(request, pk):
+    return servePreviewFile(request, pk, lambda renderer: renderer.preview(), 'image/jpeg')
+
+##################################################################################################
+## fitsfile_dzi -  Serve the Deep Zoom descriptor and tiles of a FITS file                      ##
+##################################################################################################
+@login_required
+def fitsfile_dzi(request, pk):
+    return servePreviewFile(request, pk, lambda renderer: renderer.descriptor(), 'application/xml')
+
+@login_required
+def fitsfile_tile(request, pk, level, column, row):
+    return servePreviewFile(request, pk, lambda renderer: renderer.tile(level, column, row), 'image/jpeg')
+
+##################################################################################################
+## fitsfile_thumbnail -  Serve the thumbnail of a FITS file, made on first request              ##
+##################################################################################################
+@login_required
+def fitsfile_thumbnail(request, pk):
+    fmt = request.GET.get('format', DEFAULT_FORMAT)
+    if fmt not in THUMBNAIL_FORMATS:
+        return HttpResponse("Invalid thumbnail format", status=400)
+    thumbnail_path = PostProcess().createThumbnail(pk, fmt=fmt)
+    if not thumbnail_path:
+        raise Http404("No thumbnail available")
+    response = FileResponse(open(thumbnail_path, 'rb'), content_type='image/jpeg' if fmt == 'jpg' else 'image/webp')
+    response['Cache-Control'] = 'private, max-age=3600'
+    return response
+
 ##################################################################################################
 ## Sequence File List -  List all sequence files                                                ##
 ##################################################################################################
@@ -335,49 +505,50 @@ def sequence_file_delete(request, pk):
     return render(request, 'observations/sequence_file_confirm_delete.html', {'sequence': sequence_instance})
 
 ##################################################################################################
-## Sequence File Detail -  Display a detailed view of a sequence file                           ##
+## Fits File Sequence List - One row per object from the summary table, paged in the database, ##
+##                           with the sequences of the objects on the page in one query         ##
 ##################################################################################################
 from django.core.paginator import Paginator
-from django.shortcuts import render
-from .models import fitsSequence
+from .models import fitsObjectSummary
+from observations.summaries import CALIBRATION_NAMES
 from collections import defaultdict
 
 class FitsFileSequenceListView(ListView):
-    model = fitsSequence
+    model = fitsObjectSummary
     template_name = 'observations/fits_file_sequence_list.html'
     context_object_name = 'fits_file_sequences'
     paginate_by = 15
 
     def get_queryset(self):
-        sequences = fitsSequence.objects.exclude(
-            fitsSequenceObjectName__in=['Dark', 'Flat', 'Bias']
-        ).order_by('fitsSequenceObjectName','fitsSequenceDate','fitsSequenceTelescope','fitsSequenceImager')
-        grouped_sequences = defaultdict(list)
-        for sequence in sequences:
-            grouped_sequences[sequence.fitsSequenceObjectName].append({
-                'date': sequence.fitsSequenceDate,
-                'telescope': sequence.fitsSequenceTelescope,
-                'imager': sequence.fitsSequenceImager,
-            })
-        return list(grouped_sequences.items())
+        return fitsObjectSummary.objects.order_by('fitsObjectName')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        queryset = self.get_queryset()
-        paginator = Paginator(queryset, self.paginate_by)
-        page = self.request.GET.get('page')
-        fits_file_sequences = paginator.get_page(page)
-        context['fits_file_sequences'] = fits_file_sequences
+        summaries = list(context['fits_file_sequences'])
+        sequences = defaultdict(list)
+        for sequence in (fitsSequence.objects.filter(fitsSequenceObjectName__in=[summary.fitsObjectName for summary in summaries])
+                                             .exclude(fitsSequenceObjectName__in=CALIBRATION_NAMES)
+                                             .order_by('fitsSequenceObjectName','fitsSequenceDate','fitsSequenceTelescope','fitsSequenceImager')):
+            sequences[sequence.fitsSequenceObjectName].append(sequence)
+        context['fits_file_sequences'] = [(summary, sequences[summary.fitsObjectName]) for summary in summaries]
         return context
 
+##################################################################################################
+## Fits Sequence Detail -  Display a sequence's precomputed statistics with its light and      ##
+##                         calibration frames a page at a time                                 ##
+##################################################################################################
+SEQUENCE_FRAMES_PER_PAGE = 50
+
 @login_required
 def fits_sequence_detail(request, pk):
     sequence = get_object_or_404(fitsSequence, pk=pk)
-    light_frames = fitsFile.objects.filter(fitsFileSequence=sequence, fitsFileType="Light")
-    calibration_frames = fitsFile.objects.filter(fitsFileSequence=sequence).exclude(fitsFileType="Light")
-    
+    frames = fitsFile.objects.filter(fitsFileSequence=sequence.fitsSequenceId).order_by('fitsFileDate', 'fitsFileId')
+    light_frames = Paginator(frames.filter(fitsFileType="Light"), SEQUENCE_FRAMES_PER_PAGE).get_page(request.GET.get('lights'))
+    calibration_frames = Paginator(frames.exclude(fitsFileType="Light"), SEQUENCE_FRAMES_PER_PAGE).get_page(request.GET.get('calibration'))
+
     context = {
         'sequence': sequence,
+        'filters': sorted(sequence.fitsSequenceFilters.items()),
         'light_frames': light_frames,
         'calibration_frames': calibration_frames,
     }
@@ -0,0 +1,411 @@
+############################################################################################################
+## W A T C H E R                                                                                          ##
+############################################################################################################
+# Watches the source folder for new FITS files and registers them as they arrive, instead of once a night.
+# On Linux the folder tree is watched with inotify through ctypes; network mounts, where inotify doesn't
+# see writes made by other machines, and other platforms fall back to polling the tree. A file is only
+# handed on once it has gone SETTLE_SECONDS without changing size or modification time, so files still
+# being written are never read. A watcher thread feeds settled paths into a bounded queue that the main
+# thread drains in batches through PostProcess. When ingest falls behind, the queue fills and the watcher
+# stops reading events until there is room: inotify buffers them in the kernel, and if its buffer
+# overflows the tree is rescanned. Files already handed on with the same size and time are not sent again.
+#
+from collections import OrderedDict
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+
+from observations.repoManifest import walkRepository
+
+import logging
+logging=logging.getLogger(__name__)
+
+SETTLE_SECONDS=2.0          # Quiet time before a file is taken to be completely written
+POLL_INTERVAL=5.0           # Seconds between scans of a polled folder
+TICK=0.5                    # Seconds the threads wait before checking for a stop
+QUEUE_SIZE=1000             # Settled files waiting for ingest
+MAX_PENDING=10000           # Files waiting to settle before events stop being read
+HANDLED_LIMIT=100000        # Files remembered as already handed on
+BATCH_SIZE=100              # Files per ingest batch
+BATCH_WINDOW=1.0            # Seconds to wait for a batch to fill once the first file arrives
+
+# Filesystems where inotify misses changes made by other machines
+NETWORK_FILESYSTEMS={'nfs','nfs4','cifs','smbfs','smb3','9p','afs','ceph','glusterfs','fuse.sshfs','fuse.rclone','davfs','fuse.davfs2'}
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY=0x00000002
+IN_CLOSE_WRITE=0x00000008
+IN_MOVED_FROM=0x00000040
+IN_MOVED_TO=0x00000080
+IN_CREATE=0x00000100
+IN_DELETE=0x00000200
+IN_DELETE_SELF=0x00000400
+IN_MOVE_SELF=0x00000800
+IN_Q_OVERFLOW=0x00004000
+IN_IGNORED=0x00008000
+IN_ISDIR=0x40000000
+IN_NONBLOCK=0o4000
+IN_CLOEXEC=0o2000000
+WATCH_MASK=IN_MODIFY|IN_CLOSE_WRITE|IN_MOVED_FROM|IN_MOVED_TO|IN_CREATE|IN_DELETE|IN_DELETE_SELF|IN_MOVE_SELF
+EVENT_HEADER=struct.Struct('iIII')
+READ_SIZE=64*1024
+
+#################################################################################################################
+## isFitsName - this function returns whether a file name looks like a FITS file, skipping hidden and partial  ##
+##              files the same way ingestWorker.scanFitsFile skips anything without "fit" in the extension     ##
+#################################################################################################################
+def isFitsName(name):
+    return not name.startswith('.') and "fit" in os.path.splitext(name)[1].lower()
+
+#################################################################################################################
+## fileSignature - this function returns the size and modification time of a file, or None if it is gone      ##
+#################################################################################################################
+def fileSignature(path,stat=None):
+    try:
+        stat=stat or os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size,stat.st_mtime_ns)
+
+#################################################################################################################
+## scanFolder - this function returns (path, signature) for every FITS file under a folder                     ##
+#################################################################################################################
+def scanFolder(folder):
+    return [(os.path.join(root,name),fileSignature(None,stat)) for root,name,stat in walkRepository(folder) if isFitsName(name)]
+
+#################################################################################################################
+## isNetworkMount - this function returns whether a path is on a network filesystem, from /proc/mounts        ##
+#################################################################################################################
+def isNetworkMount(path,mountsFile='/proc/mounts'):
+    path=os.path.realpath(path)
+    best,bestType='',None
+    try:
+        with open(mountsFile) as f:
+            for line in f:
+                fields=line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces in mount points are escaped as \040
+                mountPoint=fields[1].replace('\\040',' ')
+                if (path==mountPoint or path.startswith(mountPoint.rstrip('/')+'/')) and len(mountPoint)>=len(best):
+                    best,bestType=mountPoint,fields[2]
+    except OSError:
+        return False
+    return bestType in NETWORK_FILESYSTEMS
+
+#################################################################################################################
+## PollingWatcher - finds changes by scanning the folder every interval and comparing with the last scan      ##
+#################################################################################################################
+class PollingWatcher(object):
+    name='polling'
+
+    def __init__(self,folder,interval=POLL_INTERVAL):
+        self.folder=os.path.abspath(folder)
+        self.interval=interval
+        self.snapshot={}
+        self.nextScan=0.0
+
+    #############################################################################################################
+    ## poll - wait up to timeout and return (path, signature) for files added or changed since the last scan,  ##
+    ##        with a signature of None for files that have gone                                                ##
+    #############################################################################################################
+    def poll(self,timeout=TICK):
+        wait=self.nextScan-time.monotonic()
+        if wait > 0:
+            time.sleep(min(wait,timeout))
+            if time.monotonic() < self.nextScan:
+                return []
+        self.nextScan=time.monotonic()+self.interval
+        current=dict(scanFolder(self.folder))
+        changes=[(path,signature) for path,signature in current.items() if self.snapshot.get(path)!=signature]
+        changes+=[(path,None) for path in self.snapshot if path not in current]
+        self.snapshot=current
+        return changes
+
+    def close(self):
+        pass
+
+#################################################################################################################
+## InotifyWatcher - finds changes from inotify events on every folder of the tree, using libc through ctypes   ##
+#################################################################################################################
+class InotifyWatcher(object):
+    name='inotify'
+
+    def __init__(self,folder):
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        self.folder=os.path.abspath(folder)
+        self.libc=ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',use_errno=True)
+        if not hasattr(self.libc,'inotify_init1'):
+            raise OSError("inotify is not available in this C library")
+        self.libc.inotify_add_watch.argtypes=[ctypes.c_int,ctypes.c_char_p,ctypes.c_uint32]
+        self.libc.inotify_rm_watch.argtypes=[ctypes.c_int,ctypes.c_int]
+        self.fd=self.libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+        if self.fd < 0:
+            errno=ctypes.get_errno()
+            raise OSError(errno,"inotify_init1 failed: "+os.strerror(errno))
+        self.watches={}
+        self.initial=self.addTree(self.folder)
+
+    #############################################################################################################
+    ## addTree - watch a folder and every folder under it. Returns (path, signature) of the files already in   ##
+    ##           them, which may have been written before the watch was in place                               ##
+    #############################################################################################################
+    def addTree(self,folder):
+        found=[]
+        for root,dirs,files in os.walk(folder):
+            wd=self.libc.inotify_add_watch(self.fd,os.fsencode(root),WATCH_MASK)
+            if wd < 0:
+                errno=ctypes.get_errno()
+                logging.warning("Unable to watch folder "+root+": "+os.strerror(errno))
+                continue
+            self.watches[wd]=root
+            for name in files:
+                if isFitsName(name):
+                    path=os.path.join(root,name)
+                    found.append((path,fileSignature(path)))
+        return [(path,signature) for path,signature in found if signature is not None]
+
+    #############################################################################################################
+    ## poll - wait up to timeout for events and return (path, signature) for files added or changed, with a    ##
+    ##        signature of None for files that have gone. The first call returns the files already present     ##
+    #############################################################################################################
+    def poll(self,timeout=TICK):
+        if self.initial is not None:
+            changes,self.initial=self.initial,None
+            return changes
+        ready,_,_=select.select([self.fd],[],[],timeout)
+        if not ready:
+            return []
+        try:
+            data=os.read(self.fd,READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        changes=[]
+        offset=0
+        while offset+EVENT_HEADER.size <= len(data):
+            wd,mask,cookie,length=EVENT_HEADER.unpack_from(data,offset)
+            name=os.fsdecode(data[offset+EVENT_HEADER.size:offset+EVENT_HEADER.size+length].rstrip(b'\0'))
+            offset+=EVENT_HEADER.size+length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify event queue overflowed, rescanning "+self.folder)
+                changes+=scanFolder(self.folder)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd,None)
+                continue
+            root=self.watches.get(wd)
+            if root is None or not name:
+                continue
+            path=os.path.join(root,name)
+            if mask & IN_ISDIR:
+                # Folders created or moved in are watched too, along with anything already written into them
+                if mask & (IN_CREATE|IN_MOVED_TO):
+                    changes+=self.addTree(path)
+            elif isFitsName(name):
+                if mask & (IN_DELETE|IN_MOVED_FROM):
+                    changes.append((path,None))
+                else:
+                    signature=fileSignature(path)
+                    if signature is not None:
+                        changes.append((path,signature))
+        return changes
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd=-1
+
+#################################################################################################################
+## openWatcher - this function returns an inotify watcher for a folder, or a polling watcher when poll is set, ##
+##               the folder is on a network mount or inotify is unavailable                                    ##
+#################################################################################################################
+def openWatcher(folder,poll=False,interval=POLL_INTERVAL):
+    if poll:
+        return PollingWatcher(folder,interval)
+    if isNetworkMount(folder):
+        logging.info(folder+" is on a network filesystem, polling every "+str(interval)+" seconds")
+        return PollingWatcher(folder,interval)
+    try:
+        return InotifyWatcher(folder)
+    except OSError as e:
+        logging.warning("inotify unavailable, polling "+folder+" every "+str(interval)+" seconds: "+str(e))
+        return PollingWatcher(folder,interval)
+
+#################################################################################################################
+## Debouncer - holds changed files until they have been quiet for settle seconds and their size and time match ##
+## what was seen at the last change                                                                            ##
+#################################################################################################################
+class Debouncer(object):
+    def __init__(self,settle=SETTLE_SECONDS,limit=MAX_PENDING):
+        self.settle=settle
+        self.limit=limit
+        self.pending={}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def full(self):
+        return len(self.pending) >= self.limit
+
+    def touch(self,path,signature,now):
+        self.pending[path]=(signature,now)
+
+    def discard(self,path):
+        self.pending.pop(path,None)
+
+    #############################################################################################################
+    ## ready - return (path, signature) for the files that have settled, removing them from the pending set.   ##
+    ##         Files that changed since their last event start settling again, files that have gone are dropped##
+    #############################################################################################################
+    def ready(self,now):
+        settled=[]
+        for path,(signature,changed) in list(self.pending.items()):
+            if now-changed < self.settle:
+                continue
+            current=fileSignature(path)
+            if current is None:
+                del self.pending[path]
+            elif current!=signature:
+                self.pending[path]=(current,now)
+            else:
+                del self.pending[path]
+                settled.append((path,signature))
+        return settled
+
+#################################################################################################################
+## IngestDaemon - runs a watcher in a background thread and registers the settled files it finds in batches    ##
+## from the thread that calls run, which is the only one to touch the database                                 ##
+#################################################################################################################
+class IngestDaemon(object):
+    def __init__(self,postProcess,watcher,settle=SETTLE_SECONDS,queueSize=QUEUE_SIZE,maxPending=MAX_PENDING,
+                 batchSize=BATCH_SIZE,batchWindow=BATCH_WINDOW,workers=1):
+        self.postProcess=postProcess
+        self.watcher=watcher
+        self.debouncer=Debouncer(settle,maxPending)
+        self.queue=queue.Queue(maxsize=queueSize)
+        self.batchSize=batchSize
+        self.batchWindow=batchWindow
+        self.workers=workers
+        self.handled=OrderedDict()
+        self.handledLock=threading.Lock()
+        self.stopping=threading.Event()
+        self.thread=None
+        self.totals={'files':0,'registered':0,'batches':0}
+
+    def start(self):
+        self.thread=threading.Thread(target=self.watch,name='obsy-watcher',daemon=True)
+        self.thread.start()
+        logging.info("Watching "+self.watcher.folder+" with "+self.watcher.name)
+
+    def stop(self):
+        self.stopping.set()
+
+    #############################################################################################################
+    ## watch - the watcher thread: read changes, let them settle and queue them for ingest. While too many     ##
+    ##         files are waiting to settle no more events are read, and a full queue blocks until there is room ##
+    #############################################################################################################
+    def watch(self):
+        while not self.stopping.is_set():
+            try:
+                if self.debouncer.full():
+                    time.sleep(TICK)
+                    changes=[]
+                else:
+                    changes=self.watcher.poll(min(TICK,self.debouncer.settle))
+                now=time.monotonic()
+                with self.handledLock:
+                    for path,signature in changes:
+                        if signature is None:
+                            self.debouncer.discard(path)
+                            self.handled.pop(path,None)
+                        elif self.handled.get(path)!=signature:
+                            self.debouncer.touch(path,signature,now)
+                for path,signature in self.debouncer.ready(now):
+                    if not self.put(path):
+                        return
+                    with self.handledLock:
+                        self.handled[path]=signature
+                        self.handled.move_to_end(path)
+                        while len(self.handled) > HANDLED_LIMIT:
+                            self.handled.popitem(last=False)
+            except Exception as e:
+                logging.error("Watcher error, carrying on: "+str(e))
+                time.sleep(TICK)
+        self.watcher.close()
+
+    def put(self,path):
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(path,timeout=TICK)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    #############################################################################################################
+    ## nextBatch - wait up to timeout for a settled file, then collect more for up to batchWindow seconds or    ##
+    ##             until the batch is full                                                                     ##
+    #############################################################################################################
+    def nextBatch(self,timeout=TICK):
+        try:
+            batch=[self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        deadline=time.monotonic()+self.batchWindow
+        while len(batch) < self.batchSize:
+            remaining=deadline-time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    #############################################################################################################
+    ## processNext - register the next batch of settled files and sequence them, joining the sequences of      ##
+    ##               earlier batches from the same night. Returns the ids registered                           ##
+    #############################################################################################################
+    def processNext(self,timeout=TICK):
+        batch=self.nextBatch(timeout)
+        if not batch:
+            return []
+        startTime=time.perf_counter()
+        try:
+            registered=self.postProcess.registerFitsFiles(batch,workers=self.workers,batchSize=len(batch))
+            if registered:
+                self.postProcess.createLightSequences()
+                self.postProcess.createCalibrationSequences()
+        except Exception as e:
+            # A failed batch is forgotten so the files are picked up again the next time they change or on restart
+            logging.error("Failed to ingest "+str(len(batch))+" files: "+str(e))
+            with self.handledLock:
+                for path in batch:
+                    self.handled.pop(path,None)
+            return []
+        self.totals['files']+=len(batch)
+        self.totals['registered']+=len(registered)
+        self.totals['batches']+=1
+        logging.info(f"Registered {len(registered)} of {len(batch)} files in {time.perf_counter()-startTime:.1f}s, "
+                     f"{self.queue.qsize()} queued and {len(self.debouncer)} settling")
+        return registered
+
+    #############################################################################################################
+    ## run - watch and ingest until stop is called                                                             ##
+    #############################################################################################################
+    def run(self):
+        self.start()
+        try:
+            while not self.stopping.is_set():
+                self.processNext()
+        finally:
+            self.stop()
+            self.thread.join()
+        return self.totals
@@ -1,2 +1,7 @@
 # obsy/__init__.py
 from __future__ import absolute_import, unicode_literals
+
+# Load the Celery app whenever Django starts so shared tasks use it
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
@@ -0,0 +1,14 @@
+#############################################################################################################
+## C E L E R Y                                                                                             ##
+#############################################################################################################
+# Background job queue. Start a worker with bin/celery_worker.sh or
+#   celery -A obsy worker -l info
+#
+import os
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'obsy.settings')
+
+app = Celery('obsy')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
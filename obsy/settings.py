@@ -134,6 +134,19 @@ LOGOUT_REDIRECT_URL = "home"
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5" 
 CRISPY_TEMPLATE_PACK = "bootstrap5" 
 
+###########################################################################################
+## Celery Configuration                                                                  ##
+###########################################################################################
+# Background jobs such as target thumbnail downloads, run with bin/celery_worker.sh
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+CELERY_TIMEZONE = TIME_ZONE
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Days a name resolved by SIMBAD is used before asking SIMBAD again
+SIMBAD_CACHE_TTL_DAYS = 90
+
 ###########################################################################################
 ## Logging Configuration                                                                 ##
 ###########################################################################################
@@ -1,7 +1,12 @@
 from django.contrib import admin
-from .models import Target
+from .models import Target, TargetImportJob
 
 class targetAdmin(admin.ModelAdmin):
     list_display = ("targetName","targetClass","targetType")
     
-admin.site.register(Target, targetAdmin)
\ No newline at end of file
+admin.site.register(Target, targetAdmin)
+
+class targetImportJobAdmin(admin.ModelAdmin):
+    list_display = ("importFileName","importStatus","importTotal","importCreated","importCreatedAt")
+
+admin.site.register(TargetImportJob, targetImportJobAdmin)
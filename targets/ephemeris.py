@@ -0,0 +1,122 @@
+############################################################################################################
+## E P H E M E R I S                                                                                      ##
+############################################################################################################
+# Rise, transit and set times for many fixed targets at once. Coordinates are parsed into NumPy arrays,
+# precessed from J2000 to the current equinox in one SkyCoord transform, and the next rise, transit and
+# set follow directly from the local sidereal time and each target's hour angle at the horizon. There is
+# no per-target solver, so a catalogue of thousands of targets is a handful of array operations.
+# Targets that never set or never rise get no rise or set time, like astroplan.
+#
+from datetime import datetime, timedelta
+from astropy.time import Time
+from astropy import units as u
+from astropy.coordinates import SkyCoord, FK5
+from django.db import transaction
+import numpy as np
+import pytz
+
+from config.models import GeneralConfig
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Length of a sidereal day in solar days
+SIDEREAL_RATE = 0.9972695663
+# Altitude the target has to cross to count as risen or set, astroplan's default horizon
+DEFAULT_HORIZON = 0.0
+# Targets per UPDATE, three fields each keeps well under SQLite's 999 parameter limit
+UPDATE_BATCH_SIZE = 100
+
+##################################################################################################
+## parseSexagesimal - Parse "dd mm ss", "dd:mm:ss", "dd mm" or decimal strings to decimal      ##
+##                    values, the sign of the first field applies to the whole value. Values   ##
+##                    that can't be parsed are NaN                                             ##
+##################################################################################################
+def parseSexagesimal(values):
+    parsed = np.full(len(values), np.nan)
+    for i, value in enumerate(values):
+        fields = str(value).replace(':', ' ').split()
+        if not fields or len(fields) > 3:
+            continue
+        try:
+            numbers = [abs(float(field)) for field in fields]
+        except ValueError:
+            continue
+        sign = -1.0 if fields[0].startswith('-') else 1.0
+        parsed[i] = sign * sum(number / 60 ** power for power, number in enumerate(numbers))
+    return parsed
+
+##################################################################################################
+## observerLocation - The observatory latitude, longitude and elevation from GeneralConfig     ##
+##################################################################################################
+def observerLocation():
+    genSettings = GeneralConfig.objects.first()
+    if genSettings is None:
+        return None
+    return float(genSettings.latitude), float(genSettings.longitude), float(genSettings.elevation)
+
+##################################################################################################
+## riseTransitSet - The next rise, transit and set after a time for arrays of J2000 RA (hours) ##
+##                  and Dec (degrees). Returns three lists of UTC datetimes, None where there  ##
+##                  is no such event                                                           ##
+##################################################################################################
+def riseTransitSet(raHours, decDegrees, latitude, longitude, time=None, horizon=DEFAULT_HORIZON):
+    time = Time(time or datetime.now(pytz.UTC))
+    raHours = np.asarray(raHours, dtype=float)
+    decDegrees = np.asarray(decDegrees, dtype=float)
+    valid = np.isfinite(raHours) & np.isfinite(decDegrees)
+
+    # Precess to the equinox of date so the hour angle matches the sidereal time
+    coords = SkyCoord(ra=np.where(valid, raHours, 0) * 15 * u.deg, dec=np.where(valid, decDegrees, 0) * u.deg, frame='icrs')
+    coords = coords.transform_to(FK5(equinox=time))
+    ra = coords.ra.deg
+    dec = coords.dec.radian
+    lst = time.sidereal_time('apparent', longitude=longitude * u.deg).deg
+
+    # Hour angle at which the target crosses the horizon
+    lat = np.radians(latitude)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosH0 = (np.sin(np.radians(horizon)) - np.sin(lat) * np.sin(dec)) / (np.cos(lat) * np.cos(dec))
+    crosses = valid & (np.abs(cosH0) <= 1)
+    h0 = np.degrees(np.arccos(np.clip(cosH0, -1, 1)))
+
+    # Sidereal degrees until each event, turned into solar days
+    def nextEvent(hourAngle, mask):
+        days = np.mod(ra + hourAngle - lst, 360.0) / 360.0 * SIDEREAL_RATE
+        start = time.to_datetime(timezone=pytz.UTC)
+        return [start + timedelta(days=float(day)) if ok else None for day, ok in zip(days, mask)]
+
+    return nextEvent(-h0, crosses), nextEvent(0.0, valid), nextEvent(h0, crosses)
+
+##################################################################################################
+## updateRiseTransitSet - Compute and store the rise, transit and set times of targets, by     ##
+##                        default all of them, with bulk updates in one transaction. Returns   ##
+##                        the number updated                                                    ##
+##################################################################################################
+def updateRiseTransitSet(targets=None, time=None):
+    from targets.models import Target
+
+    location = observerLocation()
+    if location is None:
+        logger.info("[*]  Unable to load settings, aborting")
+        return 0
+    latitude, longitude, elevation = location
+
+    if targets is None:
+        targets = Target.objects.all()
+    targets = list(targets.only('targetId', 'targetName', 'targetRA2000', 'targetDec2000'))
+    if not targets:
+        return 0
+
+    raHours = parseSexagesimal([target.targetRA2000 for target in targets])
+    decDegrees = parseSexagesimal([target.targetDec2000 for target in targets])
+    rises, transits, sets = riseTransitSet(raHours, decDegrees, latitude, longitude, time)
+
+    for target, rise, transit, setTime in zip(targets, rises, transits, sets):
+        if transit is None:
+            logger.warning("Unable to parse coordinates of "+target.targetName)
+        target.targetRise, target.targetTransit, target.targetSet = rise, transit, setTime
+    with transaction.atomic():
+        Target.objects.bulk_update(targets, ['targetRise', 'targetTransit', 'targetSet'], batch_size=UPDATE_BATCH_SIZE)
+    logger.info("Updated rise, transit and set times of "+str(len(targets))+" targets")
+    return len(targets)
@@ -0,0 +1,114 @@
+############################################################################################################
+## I M P O R T E R                                                                                        ##
+############################################################################################################
+# Bulk target import. Names are read from a KStars observing list and resolved through the local name
+# cache, with the names it doesn't hold sent to SIMBAD a batch at a time (see resolver.py), so importing
+# the same list again never goes back to SIMBAD. Constellations for all targets come from one vectorised
+# get_constellation call, and the targets are inserted with bulk_create. importTargetList runs the whole
+# pipeline for a TargetImportJob and reports its progress on the job, it is run by a background task.
+#
+from django.db import transaction
+from django.utils import timezone
+from astropy.coordinates import SkyCoord, get_constellation
+from astropy import units as u
+import xml.etree.ElementTree as ET
+import numpy as np
+
+from targets.models import Target, TargetImportJob
+from targets.ephemeris import parseSexagesimal
+from targets.resolver import resolveNames, normaliseName, LOOKUP_BATCH_SIZE
+
+import logging
+logger = logging.getLogger(__name__)
+
+INSERT_BATCH_SIZE = 1000
+
+##################################################################################################
+## parseObservingList - The object names in a KStars observing list (.OAL), in file order      ##
+##################################################################################################
+def parseObservingList(file):
+    root = ET.parse(file).getroot()
+    names = []
+    for target in root.iter('target'):
+        name = target.find('name')
+        if name is not None and name.text and name.text.strip():
+            names.append(name.text.strip())
+    return names
+
+##################################################################################################
+## constellations - The constellation name of every position, in one vectorised call           ##
+##################################################################################################
+def constellations(raList, decList):
+    ra = parseSexagesimal(raList)
+    dec = parseSexagesimal(decList)
+    valid = np.isfinite(ra) & np.isfinite(dec)
+    result = [''] * len(ra)
+    if valid.any():
+        coords = SkyCoord(ra=ra[valid] * 15 * u.deg, dec=dec[valid] * u.deg, frame='icrs')
+        for index, name in zip(np.flatnonzero(valid), get_constellation(coords)):
+            result[index] = str(name)
+    return result
+
+##################################################################################################
+## buildTargets - Unsaved Targets for resolved names, skipping objects already in the catalogue ##
+##                and names that resolve to the same object                                    ##
+##################################################################################################
+def buildTargets(resolvedNames):
+    byName = {}
+    for resolved in resolvedNames:
+        byName.setdefault(resolved.simbadMainId.replace(' ', ''), resolved)
+    existing = set()
+    names = list(byName)
+    for i in range(0, len(names), LOOKUP_BATCH_SIZE):
+        existing.update(Target.objects.filter(targetName__in=names[i:i+LOOKUP_BATCH_SIZE]).values_list('targetName', flat=True))
+    fresh = [(name, resolved) for name, resolved in byName.items() if name not in existing]
+
+    constellationList = constellations([resolved.simbadRA2000 for name, resolved in fresh],
+                                       [resolved.simbadDec2000 for name, resolved in fresh])
+    return [Target(targetName=name, targetType=resolved.simbadType, targetClass="DS",
+                   targetRA2000=resolved.simbadRA2000, targetDec2000=resolved.simbadDec2000,
+                   targetConst=constellation, targetMag='' if resolved.simbadMagV is None else str(resolved.simbadMagV))
+            for (name, resolved), constellation in zip(fresh, constellationList)]
+
+##################################################################################################
+## importTargetList - Run an import job: resolve its names, create the new targets and fetch   ##
+##                    their thumbnails, updating the job's progress as it goes                 ##
+##################################################################################################
+def importTargetList(jobId, client=None):
+    from targets.thumbnails import backfillThumbnails
+
+    job = TargetImportJob.objects.get(importId=jobId)
+    def report(**fields):
+        for field, value in fields.items():
+            setattr(job, field, value)
+        job.importUpdatedAt = timezone.now()
+        TargetImportJob.objects.filter(importId=jobId).update(importUpdatedAt=job.importUpdatedAt, **fields)
+
+    try:
+        names = job.importNames
+        report(importStatus=TargetImportJob.RESOLVING, importTotal=len(names))
+        resolved = resolveNames(names, client, progress=lambda count: report(importResolved=count))
+        unresolved = [name for name in dict.fromkeys(normaliseName(name) for name in names) if name not in resolved]
+        if unresolved:
+            logger.warning("Unable to resolve "+", ".join(unresolved))
+
+        report(importStatus=TargetImportJob.CREATING, importResolved=len(resolved), importFailed=len(unresolved))
+        targets = buildTargets(resolved.values())
+        with transaction.atomic():
+            Target.objects.bulk_create(targets, batch_size=INSERT_BATCH_SIZE)
+        report(importCreated=len(targets), importSkipped=len(resolved) - len(targets))
+        logger.info("Imported "+str(len(targets))+" targets from "+job.importFileName)
+
+        # Thumbnails are best effort, the targets are usable without them
+        report(importStatus=TargetImportJob.THUMBNAILS)
+        try:
+            targetIds = [target.targetId for target in targets]
+            for i in range(0, len(targetIds), LOOKUP_BATCH_SIZE):
+                backfillThumbnails(Target.objects.filter(targetId__in=targetIds[i:i+LOOKUP_BATCH_SIZE]))
+        except Exception as e:
+            logger.error("Failed to fetch thumbnails for "+job.importFileName+" with error "+str(e))
+        report(importStatus=TargetImportJob.DONE)
+    except Exception as e:
+        logger.exception("Import of "+job.importFileName+" failed")
+        report(importStatus=TargetImportJob.FAILED, importMessage=str(e))
+    return job
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from targets.thumbnails import backfillThumbnails, DEFAULT_WORKERS, DEFAULT_RETRY_BUDGET
+import time
+
+class Command(BaseCommand):
+    help = 'Download the DSS thumbnails missing from the Target catalogue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                            help='Number of DSS requests in flight at once (default %d)' % DEFAULT_WORKERS)
+        parser.add_argument('--retries', type=int, default=DEFAULT_RETRY_BUDGET,
+                            help='Number of retries shared by the whole backfill (default %d)' % DEFAULT_RETRY_BUDGET)
+        parser.add_argument('--url', default=None,
+                            help='DSS image service to use instead of STScI')
+
+    def handle(self, *args, **kwargs):
+        start = time.monotonic()
+        results = backfillThumbnails(workers=kwargs['workers'], retries=kwargs['retries'], url=kwargs['url'])
+        seconds = time.monotonic() - start
+
+        if results['failed']:
+            self.stdout.write(self.style.ERROR('Failed to retrieve ' + str(results['failed']) + ' thumbnails, see log for details'))
+        self.stdout.write(self.style.SUCCESS('Downloaded ' + str(results['fetched']) + ' thumbnails and updated '
+                                             + str(results['updated']) + ' of ' + str(results['targets'])
+                                             + ' targets in %.1fs' % seconds))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from targets.resolver import seedCatalogue, CATALOGUE_FILE
+
+class Command(BaseCommand):
+    help = 'Load a catalogue of object names into the local name resolution cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=CATALOGUE_FILE,
+                            help='Catalogue CSV with name, main_id, ra, dec, type, mag_b, mag_v, mag_r, mag_i columns '
+                                 '(default the bundled bright star list)')
+
+    def handle(self, *args, **kwargs):
+        count = seedCatalogue(kwargs['file'])
+        self.stdout.write(self.style.SUCCESS('Successfully loaded ' + str(count) + ' names from ' + kwargs['file']))
@@ -0,0 +1,46 @@
+# Generated by Django 6.1.2 on 2026-10-18 11:53
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('targets', '0003_target_targetrise_target_targetset_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimbadName',
+            fields=[
+                ('simbadNameKey', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('simbadMainId', models.CharField(max_length=255)),
+                ('simbadRA2000', models.CharField(max_length=255)),
+                ('simbadDec2000', models.CharField(max_length=255)),
+                ('simbadType', models.CharField(blank=True, max_length=255)),
+                ('simbadMagB', models.FloatField(blank=True, null=True)),
+                ('simbadMagV', models.FloatField(blank=True, null=True)),
+                ('simbadMagR', models.FloatField(blank=True, null=True)),
+                ('simbadMagI', models.FloatField(blank=True, null=True)),
+                ('simbadResolvedAt', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TargetImportJob',
+            fields=[
+                ('importId', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('importFileName', models.CharField(max_length=255)),
+                ('importNames', models.JSONField(default=list)),
+                ('importStatus', models.CharField(choices=[('Queued', 'Queued'), ('Resolving', 'Resolving'), ('Creating', 'Creating'), ('Thumbnails', 'Thumbnails'), ('Done', 'Done'), ('Failed', 'Failed')], default='Queued', max_length=20)),
+                ('importTotal', models.IntegerField(default=0)),
+                ('importResolved', models.IntegerField(default=0)),
+                ('importCreated', models.IntegerField(default=0)),
+                ('importSkipped', models.IntegerField(default=0)),
+                ('importFailed', models.IntegerField(default=0)),
+                ('importMessage', models.TextField(blank=True, default='')),
+                ('importCreatedAt', models.DateTimeField(auto_now_add=True)),
+                ('importUpdatedAt', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 6.1.2 on 2026-10-18 11:56
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('targets', '0004_simbadname_targetimportjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='simbadname',
+            name='simbadMainId',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='simbadname',
+            name='simbadResolvedAt',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
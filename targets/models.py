@@ -1,27 +1,42 @@
 import uuid
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from django.conf import settings
 from django.urls import reverse
 from setup.models import observatory, telescope, imager
 from django.core.validators import MaxValueValidator, MinValueValidator
-from datetime import datetime
 import csv
 import os
 import logging
-import requests
-from astropy.io import fits
-from PIL import Image
-import numpy as np
 
-from obsy.config import GeneralConfig
-from astropy.time import Time
-from astropy import units as u
-from astropy.coordinates import EarthLocation, SkyCoord
-from astroplan import Observer, FixedTarget
-import pytz
+from targets.thumbnails import thumbnailName, thumbnailPath, THUMBNAIL_FOLDER
 
 logger = logging.getLogger(__name__)
 
+##################################################################################################
+## queueThumbnail - Queue the background download of a target's thumbnail. A broker that is    ##
+##                  down is logged, the thumbnail can be fetched later                         ##
+##################################################################################################
+def queueThumbnail(targetId):
+    from targets.tasks import fetchTargetThumbnail
+    try:
+        fetchTargetThumbnail.delay(str(targetId))
+    except Exception as e:
+        logger.error("Unable to queue thumbnail for target "+str(targetId)+" with error "+str(e))
+
+##################################################################################################
+## queueImport - Queue a target import job. If the job can't be queued it is marked failed so  ##
+##               the progress page says so                                                     ##
+##################################################################################################
+def queueImport(importId):
+    from targets.tasks import importTargets
+    try:
+        importTargets.delay(str(importId))
+    except Exception as e:
+        logger.error("Unable to queue import "+str(importId)+" with error "+str(e))
+        TargetImportJob.objects.filter(importId=importId).update(importStatus=TargetImportJob.FAILED,
+                                                                 importMessage="Unable to queue the import: "+str(e))
+
 ##################################################################################################
 ## Target - an object for which we may wish to create an Observation                           ##
 ################################################################################################## 
@@ -48,81 +63,31 @@ class Target(models.Model):
     def get_absolute_url(self):
         return reverse("target_detail", args=[str(self.targetId)])
     
-    # On create or update, generate the thumbnail file
+    # On create or update, point at the cached DSS thumbnail for the target's position, queueing a
+    # download when it isn't cached yet. Nothing here waits on the network, and bulk_create,
+    # bulk_update and queryset updates skip thumbnails entirely
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        coordinatesSaved = update_fields is None or {'targetRA2000', 'targetDec2000'} & set(update_fields)
+        name = thumbnailName(self.targetRA2000, self.targetDec2000) if coordinatesSaved else None
+        fetch = False
+        if name is not None and self.targetDefaultThumbnail.name != name:
+            if os.path.exists(thumbnailPath(name)):
+                self.targetDefaultThumbnail = name
+                if update_fields is not None:
+                    kwargs['update_fields'] = set(update_fields) | {'targetDefaultThumbnail'}
+            else:
+                fetch = True
         super().save(*args, **kwargs)
-        # Check if the thumbnail folder exists
-        if not os.path.exists('media/images/thumbnails'):
-            os.makedirs('media/images/thumbnails')
-        # Create relative path with no extension (used for fits and jpg)
-        relative_path = os.path.join('media/images/thumbnails', f"{self.targetName}") 
-        if self.targetDefaultThumbnail:
-            try:
-                os.remove(relative_path+'.jpg')
-            except:
-                logger.error("Failed to remove thumbnail file "+relative_path+'.jpg')
-
-        # Add a default thumbnail from SDSS/SS for the Target
-        width = 15 # Width of the image in arcmin
-        height = 15  # Height of the image in arcmin
-        
-        # Construct the URL for the STSCI Digitized Sky Survey (DSS) image
-        logger.debug("Constructing URL for image")
-        url = 'https://archive.stsci.edu/cgi-bin/dss_search?r='+self.targetRA2000+'&d='+self.targetDec2000+'&w='+str(width)+'&h='+str(height)+'&e=J2000'
-        logger.debug("Requesting image "+url)
-
-        # Create an appropriate filename for the image
-        jpg_filename = os.path.join(settings.BASE_DIR, relative_path)+'.jpg'
-        fits_filename = os.path.join(settings.BASE_DIR, relative_path)+'.fits'
-        logger.debug("Will save image "+fits_filename+" as "+jpg_filename)
-
-        # Make the request to fetch the image
-        try:
-            response = requests.get(url)
-        except Exception as e:
-            logger.error("Failed to retrieve image "+fits_filename+"with error "+str(e))
-        logger.debug("Response code "+str(response.status_code))
-
-        # Check if the request was successful
-        if response.status_code == 200:
-            with open(fits_filename, 'wb') as f:
-                f.write(response.content)
-                logger.debug("Image saved as "+fits_filename)
-            # Open the FITS file and save as jpg
-            with fits.open(fits_filename) as hdul:
-                logger.debug("Opened FITS file "+fits_filename)
-                # Get the image data from the primary HDU
-                image_data = hdul[0].data
-                logger.debug("Got image data from FITS file")
-
-                # Normalize the image data to the range 0-255
-                logger.debug("Normalizing image data")
-                image_data = image_data - np.min(image_data)
-                image_data = (image_data / np.max(image_data) * 255).astype(np.uint8)
-
-                # Convert to a PIL image
-                logger.debug("Converting image to PIL")
-                image = Image.fromarray(image_data)
-                logger.debug("Converted image to PIL")
-
-                # Resize the image to 150x150
-                logger.debug("Resizing image")
-                image = image.resize((150, 150))
-
-                # Save as JPG
-                logger.debug("Saving image as JPG")
-                image.save(jpg_filename)
-
-            # Remove the temporary FITS file
-            logger.debug("Removing FITS file "+fits_filename)
-            os.remove(fits_filename)
-        else:
-            logger.error("Failed to retrieve image "+fits_filename)
-
+        if fetch:
+            targetId = self.targetId
+            transaction.on_commit(lambda: queueThumbnail(targetId))
 
     ##############################################################################################
-    # On delete, remove the thumbnail file                                                      ##       
+    # On delete, remove the thumbnail file unless it's in the DSS cache shared by position     ##       
     def delete(self, *args, **kwargs):
+        if (self.targetDefaultThumbnail.name or '').startswith(THUMBNAIL_FOLDER):
+            return super().delete(*args, **kwargs)
         relative_path = os.path.join('media/images/thumbnails', f"{self.targetName}") 
         jpg_filename = relative_path+'.jpg'
         logger.debug("Deleting thumbnail file "+jpg_filename)
@@ -132,72 +97,67 @@ class Target(models.Model):
             except:
                 logger.warning("Failed to remove thumbnail file "+jpg_filename)
         super().delete(*args, **kwargs)
-        return 
-    
-    ##############################################################################################
-    # Set Rise / Transit / Set times for the Target                                             ##
-    ##############################################################################################
-    def set_rise_transit_set(self):
-         # Get General config
-        genSettings = GeneralConfig.objects.first()
-        if genSettings == None:
-            logger.info("[*]  Unable to load settings, aborting")
-            return False
-        
-        # Define the observer's location
-        location = EarthLocation(lat=float(genSettings.latitude) * u.deg, lon=float(genSettings.longitude) * u.deg, height=float(genSettings.elevation) * u.m)
-        observer = Observer(location=location, timezone=settings.TIME_ZONE, name="Observer")
-        
-        # Define the current time in UTC
-        utc_now = datetime.now(pytz.UTC)
-        time = Time(utc_now)
+        return
 
-        # Convert RA and Dec to decimal degrees
-        raList = self.targetRA2000.split(' ')
-        if len(raList) == 3:
-            ra_hrs, ra_min, ra_sec = raList
-        else:
-            ra_hrs, ra_min = raList
-            ra_sec = 0  
-        ra_decimal = (float(ra_hrs) + float(ra_min)/60 + float(ra_sec)/3600) * 15
-        
-        decList = self.targetDec2000.split(' ')
-        if len(decList) == 3:
-            dec_deg, dec_min, dec_sec = decList
-        else:
-            dec_deg, dec_min = decList
-            dec_sec = 0       
-        dec_decimal = float(dec_deg) + float(dec_min)/60 + float(dec_sec)/3600
+##################################################################################################
+## SimbadName - A name resolved by SIMBAD or seeded from a catalogue, kept so the same name    ##
+##              isn't queried again until it expires (see resolver.py)                        ##
+##################################################################################################
+class SimbadName(models.Model):
+    simbadNameKey   = models.CharField(max_length=255, primary_key=True)
+    simbadMainId    = models.CharField(max_length=255, db_index=True)
+    simbadRA2000    = models.CharField(max_length=255)
+    simbadDec2000   = models.CharField(max_length=255)
+    simbadType      = models.CharField(max_length=255, blank=True)
+    simbadMagB      = models.FloatField(null=True, blank=True)
+    simbadMagV      = models.FloatField(null=True, blank=True)
+    simbadMagR      = models.FloatField(null=True, blank=True)
+    simbadMagI      = models.FloatField(null=True, blank=True)
+    simbadResolvedAt = models.DateTimeField(default=timezone.now)
 
-        # Create a SkyCoord object for the target
-        target_coord = SkyCoord(ra=ra_decimal * u.deg, dec=dec_decimal * u.deg, frame='icrs')
-        target_fixed = FixedTarget(coord=target_coord, name=self.targetName)
+    def __str__(self):
+        return f"{self.simbadNameKey} ({self.simbadMainId})"
 
-        # Calculate rise, transit, and set times
-        local_tz = pytz.timezone(settings.TIME_ZONE)
-        rise_timeJD = observer.target_rise_time(time, target_fixed, which='next')
-        rise_timeUTC = rise_timeJD.to_datetime()
-        transit_timeJD = observer.target_meridian_transit_time(time, target_fixed, which='next')
-        transit_timeUTC = transit_timeJD.to_datetime()
-        set_timeJD = observer.target_set_time(time, target_fixed, which='next')
-        set_timeUTC = set_timeJD.to_datetime()
-        
-        logger.info("Processing object name: "+self.targetName)
-        
-        # Convert to local time and assign to object attributes
-        if type(rise_timeUTC) == datetime:
-            self.targetRise=rise_timeUTC.replace(tzinfo=pytz.UTC).astimezone(local_tz)
-        else:
-            self.targetRise=None
-        if type(transit_timeUTC) == datetime:
-            self.targetTransit=transit_timeUTC.replace(tzinfo=pytz.UTC).astimezone(local_tz)
-        else:
-            self.targetTransit=None
-        if type(set_timeUTC) == datetime:
-            self.targetSet=set_timeUTC.replace(tzinfo=pytz.UTC).astimezone(local_tz)
-        else:
-            self.targetSet=None
+##################################################################################################
+## TargetImportJob - A background import of an observing list and how far it has got           ##
+##################################################################################################
+class TargetImportJob(models.Model):
+    QUEUED = "Queued"
+    RESOLVING = "Resolving"
+    CREATING = "Creating"
+    THUMBNAILS = "Thumbnails"
+    DONE = "Done"
+    FAILED = "Failed"
+    STATUS_CHOICES = [(status, status) for status in (QUEUED, RESOLVING, CREATING, THUMBNAILS, DONE, FAILED)]
+
+    importId        = models.UUIDField(
+                        primary_key=True,
+                        default=uuid.uuid4,
+                        editable=False)
+    importFileName  = models.CharField(max_length=255)
+    importNames     = models.JSONField(default=list)
+    importStatus    = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    importTotal     = models.IntegerField(default=0)
+    importResolved  = models.IntegerField(default=0)
+    importCreated   = models.IntegerField(default=0)
+    importSkipped   = models.IntegerField(default=0)
+    importFailed    = models.IntegerField(default=0)
+    importMessage   = models.TextField(blank=True, default="")
+    importCreatedAt = models.DateTimeField(auto_now_add=True)
+    importUpdatedAt = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.importFileName} ({self.importStatus})"
+
+    def get_absolute_url(self):
+        return reverse("target_import_status", args=[str(self.importId)])
 
-        self.save()
+    @property
+    def finished(self):
+        return self.importStatus in (self.DONE, self.FAILED)
 
-        return
\ No newline at end of file
+    @property
+    def percent(self):
+        if self.importStatus == self.DONE:
+            return 100
+        return int(100 * self.importResolved / self.importTotal) if self.importTotal else 0
@@ -0,0 +1,237 @@
+############################################################################################################
+## R E S O L V E R                                                                                        ##
+############################################################################################################
+# Object name resolution with a local cache. Every name SIMBAD resolves is kept in the SimbadName table
+# with its coordinates, type and magnitudes, under the name asked for and under SIMBAD's main identifier.
+# Entries are used without going to SIMBAD until they are older than SIMBAD_CACHE_TTL_DAYS, and an
+# expired entry is still used when SIMBAD can't be reached, so repeat lookups work offline. The cache can
+# be seeded from a catalogue file (see seed_names), and lookupNames finds cached names by prefix or by
+# close spelling for search suggestions.
+#
+from django.conf import settings
+from django.utils import timezone
+from datetime import timedelta
+import numpy as np
+import difflib
+import csv
+import os
+
+from targets.models import SimbadName
+
+import logging
+logger = logging.getLogger(__name__)
+
+SIMBAD_FIELDS = ('flux(B)', 'flux(V)', 'flux(R)', 'flux(I)', 'otype(main)')
+SIMBAD_TIMEOUT = 60
+QUERY_BATCH_SIZE = 200      # Names per SIMBAD query
+LOOKUP_BATCH_SIZE = 500     # Names per cache lookup, under the SQLite bound parameter limit
+CACHE_TTL = timedelta(days=getattr(settings, 'SIMBAD_CACHE_TTL_DAYS', 90))
+CATALOGUE_FILE = os.path.join(os.path.dirname(__file__), 'data', 'bright_stars.csv')
+CATALOGUE_FIELDS = ['name', 'main_id', 'ra', 'dec', 'type', 'mag_b', 'mag_v', 'mag_r', 'mag_i']
+CACHED_FIELDS = ['simbadMainId', 'simbadRA2000', 'simbadDec2000', 'simbadType',
+                 'simbadMagB', 'simbadMagV', 'simbadMagR', 'simbadMagI', 'simbadResolvedAt']
+WILDCARD_CHARACTERS = '*?['
+FUZZY_CUTOFF = 0.75
+FUZZY_PREFIX = 2            # Close spellings must share this many leading characters with the term
+FUZZY_CANDIDATES = 2000     # Most names compared for close spellings per lookup
+
+##################################################################################################
+## normaliseName - The cache key of an object name, case and spacing don't matter              ##
+##################################################################################################
+def normaliseName(name):
+    return ' '.join(str(name).split()).upper()
+
+##################################################################################################
+## isWildcard - Whether a search term is a SIMBAD wildcard pattern                             ##
+##################################################################################################
+def isWildcard(term):
+    return any(character in term for character in WILDCARD_CHARACTERS)
+
+##################################################################################################
+## isFresh - Whether a cached name is young enough to use without asking SIMBAD again          ##
+##################################################################################################
+def isFresh(entry, now=None):
+    return (now or timezone.now()) - entry.simbadResolvedAt < CACHE_TTL
+
+##################################################################################################
+## simbadClient - A SIMBAD client with the fields we store, added to this instance rather than ##
+##                to the shared Simbad class                                                   ##
+##################################################################################################
+def simbadClient():
+    from astroquery.simbad import Simbad
+    client = Simbad()
+    client.TIMEOUT = SIMBAD_TIMEOUT
+    client.add_votable_fields(*SIMBAD_FIELDS)
+    return client
+
+##################################################################################################
+## cellValue - A table cell as text or a float, None when masked or empty                      ##
+##################################################################################################
+def cellValue(row, column, cast=str):
+    if column not in row.colnames or np.ma.is_masked(row[column]):
+        return None
+    value = row[column]
+    if isinstance(value, bytes):
+        value = value.decode()
+    if cast is float:
+        value = float(value)
+        return value if np.isfinite(value) else None
+    value = str(value).strip()
+    return value or None
+
+##################################################################################################
+## rowEntry - An unsaved cache entry from a row of a SIMBAD result, None if it has no object   ##
+##################################################################################################
+def rowEntry(row, key=None):
+    mainId = cellValue(row, 'MAIN_ID')
+    if mainId is None:
+        return None
+    mainId = ' '.join(mainId.split())
+    return SimbadName(simbadNameKey=key or normaliseName(mainId), simbadMainId=mainId,
+                      simbadRA2000=cellValue(row, 'RA') or '', simbadDec2000=cellValue(row, 'DEC') or '',
+                      simbadType=cellValue(row, 'OTYPE_main') or '',
+                      simbadMagB=cellValue(row, 'FLUX_B', float), simbadMagV=cellValue(row, 'FLUX_V', float),
+                      simbadMagR=cellValue(row, 'FLUX_R', float), simbadMagI=cellValue(row, 'FLUX_I', float),
+                      simbadResolvedAt=timezone.now())
+
+##################################################################################################
+## aliasEntry - A copy of a cache entry under another name                                      ##
+##################################################################################################
+def aliasEntry(entry, key):
+    return SimbadName(simbadNameKey=key, **{field: getattr(entry, field) for field in CACHED_FIELDS})
+
+##################################################################################################
+## saveEntries - Add or refresh cache entries, with one statement per batch                    ##
+##################################################################################################
+def saveEntries(entries):
+    SimbadName.objects.bulk_create(entries, batch_size=LOOKUP_BATCH_SIZE, update_conflicts=True,
+                                   unique_fields=['simbadNameKey'], update_fields=CACHED_FIELDS)
+
+##################################################################################################
+## querySimbad - Resolve a list of names with one SIMBAD query. Returns a dict of cache key to ##
+##               an unsaved SimbadName for each name that resolved                             ##
+##################################################################################################
+def querySimbad(names, client=None):
+    table = (client or simbadClient()).query_objects(names)
+    if table is None:
+        return {}
+    resolved = {}
+    for index, row in enumerate(table):
+        # SCRIPT_NUMBER_ID is the 1-based position of the name in the query
+        number = cellValue(row, 'SCRIPT_NUMBER_ID', float)
+        position = int(number) - 1 if number is not None else index
+        if not 0 <= position < len(names):
+            continue
+        entry = rowEntry(row, normaliseName(names[position]))
+        if entry is not None:
+            resolved[entry.simbadNameKey] = entry
+    return resolved
+
+##################################################################################################
+## queryWildcard - Every object matching a SIMBAD wildcard pattern, added to the cache under   ##
+##                 their main identifiers. Patterns always go to SIMBAD                        ##
+##################################################################################################
+def queryWildcard(pattern, client=None):
+    table = (client or simbadClient()).query_object(pattern, wildcard=True)
+    if table is None:
+        return []
+    entries = list({entry.simbadNameKey: entry for entry in (rowEntry(row) for row in table) if entry is not None}.values())
+    saveEntries(entries)
+    return entries
+
+##################################################################################################
+## resolveNames - Resolve names from the cache and SIMBAD. Returns a dict of cache key to      ##
+##                SimbadName for the names that resolved. Fresh cache entries are used as they ##
+##                are, expired ones are refreshed from SIMBAD when it answers. progress is     ##
+##                called with the number of names handled so far                               ##
+##################################################################################################
+def resolveNames(names, client=None, progress=None):
+    keys = list(dict.fromkeys(normaliseName(name) for name in names))
+    cached = {}
+    for i in range(0, len(keys), LOOKUP_BATCH_SIZE):
+        for entry in SimbadName.objects.filter(simbadNameKey__in=keys[i:i+LOOKUP_BATCH_SIZE]):
+            cached[entry.simbadNameKey] = entry
+    now = timezone.now()
+    resolved = {key: entry for key, entry in cached.items() if isFresh(entry, now)}
+    logger.info("Resolved "+str(len(resolved))+" of "+str(len(keys))+" names from the cache")
+    if progress:
+        progress(len(resolved))
+
+    missing = [key for key in keys if key not in resolved]
+    for i in range(0, len(missing), QUERY_BATCH_SIZE):
+        batch = missing[i:i+QUERY_BATCH_SIZE]
+        try:
+            found = querySimbad(batch, client)
+        except Exception as e:
+            logger.error("Error searching SIMBAD for "+str(len(batch))+" names with error "+str(e))
+            found = {}
+        # Keep each object under its main identifier too, so searching for that hits the cache
+        aliases = {}
+        for entry in found.values():
+            mainKey = normaliseName(entry.simbadMainId)
+            if mainKey not in found:
+                aliases[mainKey] = aliasEntry(entry, mainKey)
+        saveEntries(list(found.values()) + list(aliases.values()))
+        for key in batch:
+            if key in found:
+                resolved[key] = found[key]
+            elif key in cached:
+                logger.info("Using expired cache entry for "+key)
+                resolved[key] = cached[key]
+        if progress:
+            progress(len(keys) - len(missing) + i + len(batch))
+    return resolved
+
+##################################################################################################
+## lookupNames - Cached names matching a search term without going to SIMBAD: the exact name,  ##
+##               then names and main identifiers starting with it, then close spellings among  ##
+##               a bounded range of names sharing the term's first characters, read from the   ##
+##               primary key index                                                             ##
+##################################################################################################
+def lookupNames(term, limit=10):
+    key = normaliseName(term)
+    if not key:
+        return []
+    matches = {}
+    exact = SimbadName.objects.filter(simbadNameKey=key).first()
+    if exact is not None:
+        matches[exact.simbadNameKey] = exact
+    for entry in SimbadName.objects.filter(simbadNameKey__startswith=key).order_by('simbadNameKey')[:limit]:
+        matches.setdefault(entry.simbadNameKey, entry)
+    if len(matches) < limit:
+        for entry in SimbadName.objects.filter(simbadMainId__istartswith=term.strip()).order_by('simbadNameKey')[:limit]:
+            matches.setdefault(entry.simbadNameKey, entry)
+    if len(matches) < limit:
+        prefix = key[:FUZZY_PREFIX]
+        candidates = (SimbadName.objects.filter(simbadNameKey__gte=prefix, simbadNameKey__lt=prefix+'\uffff')
+                                        .order_by('simbadNameKey').values_list('simbadNameKey', flat=True)[:FUZZY_CANDIDATES])
+        close = difflib.get_close_matches(key, list(candidates), n=limit, cutoff=FUZZY_CUTOFF)
+        for entry in SimbadName.objects.filter(simbadNameKey__in=close):
+            matches.setdefault(entry.simbadNameKey, entry)
+    return list(matches.values())[:limit]
+
+##################################################################################################
+## seedCatalogue - Load a catalogue CSV into the cache. Columns are name, main_id, ra, dec,    ##
+##                 type and mag_b, mag_v, mag_r, mag_i with blanks for unknown magnitudes.     ##
+##                 Returns the number of names loaded                                          ##
+##################################################################################################
+def seedCatalogue(path=CATALOGUE_FILE):
+    def magnitude(value):
+        return float(value) if value not in (None, '') else None
+
+    now = timezone.now()
+    entries = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            key = normaliseName(row['name'])
+            if not key:
+                continue
+            entries[key] = SimbadName(simbadNameKey=key, simbadMainId=' '.join((row['main_id'] or row['name']).split()),
+                                      simbadRA2000=row['ra'].strip(), simbadDec2000=row['dec'].strip(),
+                                      simbadType=(row.get('type') or '').strip(),
+                                      simbadMagB=magnitude(row.get('mag_b')), simbadMagV=magnitude(row.get('mag_v')),
+                                      simbadMagR=magnitude(row.get('mag_r')), simbadMagI=magnitude(row.get('mag_i')),
+                                      simbadResolvedAt=now)
+    saveEntries(list(entries.values()))
+    logger.info("Seeded "+str(len(entries))+" names from "+path)
+    return len(entries)
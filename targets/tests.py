@@ -0,0 +1,448 @@
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, IntegrityError
+from django.db.models.query import QuerySet
+from django.core.management import call_command
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from django.core.cache import cache
+from astropy.table import Table
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+from astropy.io import fits
+from datetime import datetime, timedelta, date
+import numpy as np
+import tempfile
+import threading
+import shutil
+import requests
+import pytz
+import io
+import os
+
+from config.models import GeneralConfig
+from .models import Target, TargetImportJob, SimbadName
+from .ephemeris import parseSexagesimal, riseTransitSet, updateRiseTransitSet
+from .thumbnails import thumbnailName, thumbnailPath, backfillThumbnails
+from .tasks import fetchTargetThumbnail
+from .importer import parseObservingList, importTargetList
+from .resolver import resolveNames, lookupNames, seedCatalogue, CACHE_TTL
+from .visibility import targetCurve, airmass, nightOf, localTime
+
+sessionSend = requests.Session.send
+
+class ParseSexagesimalTests(SimpleTestCase):
+    def test_separators_and_precision(self):
+        parsed = parseSexagesimal(['05 35 17.3', '05:35:17.3', '05 35', '5.5'])
+        np.testing.assert_allclose(parsed, [5.588139, 5.588139, 5.583333, 5.5], atol=1e-6)
+
+    def test_sign_applies_to_every_field(self):
+        parsed = parseSexagesimal(['-05 23 28', '-00 30 00', '+41 16 09'])
+        np.testing.assert_allclose(parsed, [-5.391111, -0.5, 41.269167], atol=1e-6)
+
+    def test_unparseable_values_are_nan(self):
+        self.assertTrue(np.isnan(parseSexagesimal(['', 'n/a', '1 2 3 4'])).all())
+
+class RiseTransitSetTests(SimpleTestCase):
+    time = datetime(2024, 10, 1, 12, tzinfo=pytz.UTC)
+
+    def test_events_follow_the_hour_angle(self):
+        # M42 from 49.9N, checked against astroplan to within a minute
+        rises, transits, sets = riseTransitSet([5.588], [-5.391], 49.9, -97.1, self.time)
+        self.assertAlmostEqual((rises[0] - datetime(2024, 10, 2, 5, 44, 47, tzinfo=pytz.UTC)).total_seconds(), 0, delta=60)
+        self.assertAlmostEqual((transits[0] - datetime(2024, 10, 2, 11, 18, 14, tzinfo=pytz.UTC)).total_seconds(), 0, delta=60)
+        self.assertAlmostEqual((sets[0] - datetime(2024, 10, 1, 16, 55, 36, tzinfo=pytz.UTC)).total_seconds(), 0, delta=60)
+        for event in (rises[0], transits[0], sets[0]):
+            self.assertTrue(self.time <= event < self.time + timedelta(days=1))
+
+    def test_circumpolar_and_never_rising_targets(self):
+        rises, transits, sets = riseTransitSet([2.5, 12.0, np.nan], [89.0, -80.0, 10.0], 49.9, -97.1, self.time)
+        self.assertEqual(rises, [None, None, None])
+        self.assertEqual(sets, [None, None, None])
+        self.assertIsNotNone(transits[0])
+        self.assertIsNone(transits[2])
+
+class UpdateRiseTransitSetTests(TestCase):
+    def setUp(self):
+        GeneralConfig.objects.create(latitude=49.9, longitude=-97.1, elevation=250)
+        # bulk_create skips Target.save, which downloads a thumbnail
+        Target.objects.bulk_create([Target(targetName=f"T{i}", targetType="Galaxy", targetRA2000=f"{i % 24:02d} 00 00",
+                                           targetDec2000=f"{(i % 120) - 40:+03d} 30 00", targetConst="", targetMag="")
+                                    for i in range(300)])
+
+    def test_updates_every_target_in_bulk(self):
+        time = datetime(2024, 10, 1, 12, tzinfo=pytz.UTC)
+        with CaptureQueriesContext(connection) as queries:
+            updated = updateRiseTransitSet(time=time)
+        self.assertEqual(updated, 300)
+        self.assertEqual(len([q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]), 3)
+        targets = list(Target.objects.order_by('targetName'))
+        rises, transits, sets = riseTransitSet(parseSexagesimal([t.targetRA2000 for t in targets]),
+                                               parseSexagesimal([t.targetDec2000 for t in targets]), 49.9, -97.1, time)
+        self.assertEqual([(t.targetRise, t.targetTransit, t.targetSet) for t in targets], list(zip(rises, transits, sets)))
+        self.assertFalse(Target.objects.filter(targetTransit__isnull=True).exists())
+        self.assertTrue(Target.objects.filter(targetRise__isnull=False).exists())
+
+    def test_failed_update_changes_nothing(self):
+        # The third UPDATE fails after the first two have been written
+        update = QuerySet.update
+        calls = []
+        def failOnThird(queryset, **fields):
+            calls.append(fields)
+            if len(calls) == 3:
+                raise IntegrityError("disk full")
+            return update(queryset, **fields)
+        with mock.patch.object(QuerySet, 'update', failOnThird):
+            with self.assertRaises(IntegrityError):
+                updateRiseTransitSet(time=datetime(2024, 10, 1, 12, tzinfo=pytz.UTC))
+        self.assertFalse(Target.objects.filter(targetTransit__isnull=False).exists())
+
+    def test_without_settings_nothing_is_updated(self):
+        GeneralConfig.objects.all().delete()
+        self.assertEqual(updateRiseTransitSet(), 0)
+        self.assertFalse(Target.objects.filter(targetTransit__isnull=False).exists())
+
+class TargetThumbnailTests(TestCase):
+    def setUp(self):
+        self.mediaRoot = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.mediaRoot)
+        settingsOverride = override_settings(MEDIA_ROOT=self.mediaRoot)
+        settingsOverride.enable()
+        self.addCleanup(settingsOverride.disable)
+        # Saving a target must never reach the network
+        networkPatch = mock.patch.object(requests.Session, 'send', side_effect=AssertionError("network used"))
+        networkPatch.start()
+        self.addCleanup(networkPatch.stop)
+
+    def createTarget(self, **fields):
+        values = dict(targetName="M42", targetType="HII", targetRA2000="05 35 17.3", targetDec2000="-05 23 28",
+                      targetConst="Ori", targetMag="4")
+        values.update(fields)
+        return Target.objects.create(**values)
+
+    def test_name_depends_only_on_position_and_field(self):
+        self.assertEqual(thumbnailName("05 35 17.3", "-05 23 28"), thumbnailName("05:35:17.3", "-5 23 28.0"))
+        self.assertNotEqual(thumbnailName("05 35 17.3", "-05 23 28"), thumbnailName("05 35 17.3", "+05 23 28"))
+        self.assertNotEqual(thumbnailName("05 35 17.3", "-05 23 28"), thumbnailName("05 35 17.3", "-05 23 28", 30))
+        self.assertIsNone(thumbnailName("", "-05 23 28"))
+
+    def test_save_queues_the_download_after_commit(self):
+        with mock.patch('targets.tasks.fetchTargetThumbnail.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                target = self.createTarget()
+                self.assertFalse(delay.called)
+        self.assertEqual(len(callbacks), 1)
+        delay.assert_called_once_with(str(target.targetId))
+
+    def test_cached_thumbnail_is_used_without_queueing(self):
+        name = thumbnailName("05 35 17.3", "-05 23 28")
+        os.makedirs(os.path.dirname(thumbnailPath(name)))
+        open(thumbnailPath(name), 'wb').close()
+        with self.captureOnCommitCallbacks() as callbacks:
+            target = self.createTarget()
+        self.assertEqual(callbacks, [])
+        self.assertEqual(Target.objects.get(pk=target.pk).targetDefaultThumbnail.name, name)
+
+    def test_saves_and_bulk_operations_that_keep_the_position_skip_thumbnails(self):
+        with mock.patch('targets.tasks.fetchTargetThumbnail.delay'):
+            target = self.createTarget()
+        with self.captureOnCommitCallbacks() as callbacks:
+            target.targetMag = "5"
+            target.save(update_fields=['targetMag'])
+            Target.objects.bulk_create([Target(targetName="M1", targetType="SNR", targetRA2000="05 34 31.9",
+                                               targetDec2000="+22 00 52", targetConst="Tau", targetMag="8")])
+        self.assertEqual(callbacks, [])
+
+    def test_task_downloads_once_and_points_the_target_at_the_cache(self):
+        with mock.patch('targets.tasks.fetchTargetThumbnail.delay'):
+            target = self.createTarget()
+        stub = DssStub()
+        self.addCleanup(stub.stop)
+        with mock.patch.object(requests.Session, 'send', sessionSend), mock.patch('targets.thumbnails.DSS_URL', stub.url):
+            name = fetchTargetThumbnail(str(target.targetId))
+            self.assertEqual(fetchTargetThumbnail(str(target.targetId)), name)
+        self.assertEqual(len(stub.requests), 1)
+        self.assertTrue(os.path.exists(thumbnailPath(name)))
+        self.assertEqual(Target.objects.get(pk=target.pk).targetDefaultThumbnail.name, name)
+
+class DssStub(ThreadingHTTPServer):
+    """A local stand in for the DSS image service. The first `failures` requests get a 503"""
+    def __init__(self, failures=0):
+        super().__init__(('127.0.0.1', 0), DssStubHandler)
+        self.failures = failures
+        self.requests = []
+        self.lock = threading.Lock()
+        buffer = io.BytesIO()
+        fits.PrimaryHDU(np.arange(400, dtype=np.int16).reshape(20, 20)).writeto(buffer)
+        self.image = buffer.getvalue()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/cgi-bin/dss_search' % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class DssStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            failing = self.server.failures > 0
+            self.server.failures -= 1
+        if failing:
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(self.server.image)))
+        self.end_headers()
+        self.wfile.write(self.server.image)
+
+    def log_message(self, *args):
+        pass
+
+class ThumbnailBackfillTests(TestCase):
+    def setUp(self):
+        self.mediaRoot = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.mediaRoot)
+        settingsOverride = override_settings(MEDIA_ROOT=self.mediaRoot)
+        settingsOverride.enable()
+        self.addCleanup(settingsOverride.disable)
+        backoffPatch = mock.patch('targets.thumbnails.BACKOFF_BASE', 0)
+        backoffPatch.start()
+        self.addCleanup(backoffPatch.stop)
+        # Two targets share a position, so four downloads cover five targets
+        positions = [("00 42 44.3", "+41 16 09"), ("05 35 17.3", "-05 23 28"), ("05:35:17.3", "-5 23 28"),
+                     ("13 29 52.7", "+47 11 43"), ("18 53 35.1", "+33 01 45")]
+        Target.objects.bulk_create([Target(targetName=f"T{i}", targetType="Galaxy", targetRA2000=ra, targetDec2000=dec,
+                                           targetConst="", targetMag="") for i, (ra, dec) in enumerate(positions)])
+
+    def startStub(self, failures=0):
+        stub = DssStub(failures)
+        self.addCleanup(stub.stop)
+        return stub
+
+    def test_backfill_downloads_each_position_once(self):
+        stub = self.startStub()
+        out = io.StringIO()
+        call_command('backfill_thumbnails', url=stub.url, workers=4, stdout=out)
+        self.assertEqual(len(stub.requests), 4)
+        self.assertIn('Downloaded 4 thumbnails and updated 5 of 5 targets', out.getvalue())
+        for target in Target.objects.all():
+            self.assertEqual(target.targetDefaultThumbnail.name, thumbnailName(target.targetRA2000, target.targetDec2000))
+            self.assertTrue(os.path.exists(thumbnailPath(target.targetDefaultThumbnail.name)))
+
+        call_command('backfill_thumbnails', url=stub.url, stdout=io.StringIO())
+        self.assertEqual(len(stub.requests), 4)
+
+    def test_transient_failures_are_retried(self):
+        stub = self.startStub(failures=3)
+        results = backfillThumbnails(url=stub.url, workers=2)
+        self.assertEqual(results, {'targets': 5, 'fetched': 4, 'failed': 0, 'updated': 5})
+        self.assertEqual(len(stub.requests), 7)
+
+    def test_retry_budget_is_shared_by_the_backfill(self):
+        stub = self.startStub(failures=1000)
+        results = backfillThumbnails(url=stub.url, workers=2, retries=2)
+        self.assertEqual(results['failed'], 4)
+        self.assertEqual(results['updated'], 0)
+        self.assertEqual(len(stub.requests), 4 + 2)
+
+OBSERVING_LIST = b"""<?xml version="1.0" encoding="UTF-8"?>
+<oal:observations xmlns:oal="http://observation.sourceforge.net/openastronomylog" version="2.0">
+<targets>
+<target id="1"><name>M42</name></target>
+<target id="2"><name>  m 42 </name></target>
+<target id="3"><name>M31</name></target>
+<target id="4"><name>Not An Object</name></target>
+</targets>
+</oal:observations>"""
+
+class FakeSimbad(object):
+    """Answers query_objects like SIMBAD for a few known objects"""
+    objects = {'M42': ('M  42', '05 35 17.3', '-05 23 28', 'HII', 4.0),
+               'M 42': ('M  42', '05 35 17.3', '-05 23 28', 'HII', 4.0),
+               'M31': ('M  31', '00 42 44.330', '+41 16 07.50', 'G', 3.44)}
+
+    def __init__(self):
+        self.queries = []
+
+    def query_objects(self, names):
+        self.queries.append(list(names))
+        rows = [(self.objects[name] + (number,)) for number, name in enumerate(names, 1) if name in self.objects]
+        return Table(rows=rows or None, names=('MAIN_ID', 'RA', 'DEC', 'OTYPE_main', 'FLUX_V', 'SCRIPT_NUMBER_ID'))
+
+class TargetImportTests(TestCase):
+    def setUp(self):
+        thumbnailPatch = mock.patch('targets.thumbnails.backfillThumbnails')
+        self.backfill = thumbnailPatch.start()
+        self.addCleanup(thumbnailPatch.stop)
+
+    def createJob(self):
+        return TargetImportJob.objects.create(importFileName="list.oal", importNames=parseObservingList(io.BytesIO(OBSERVING_LIST)))
+
+    def test_observing_list_names(self):
+        self.assertEqual(parseObservingList(io.BytesIO(OBSERVING_LIST)), ["M42", "m 42", "M31", "Not An Object"])
+
+    def test_import_resolves_in_one_query_and_bulk_creates(self):
+        simbad = FakeSimbad()
+        with self.captureOnCommitCallbacks() as callbacks:
+            importTargetList(self.createJob().importId, simbad)
+        self.assertEqual(simbad.queries, [["M42", "M 42", "M31", "NOT AN OBJECT"]])
+        self.assertEqual(callbacks, [])
+
+        job = TargetImportJob.objects.get()
+        self.assertEqual((job.importStatus, job.importTotal, job.importResolved, job.importCreated, job.importSkipped, job.importFailed),
+                         (TargetImportJob.DONE, 4, 3, 2, 1, 1))
+        self.assertEqual(job.percent, 100)
+        m42 = Target.objects.get(targetName="M42")
+        self.assertEqual((m42.targetRA2000, m42.targetDec2000, m42.targetConst, m42.targetType, m42.targetMag),
+                         ("05 35 17.3", "-05 23 28", "Orion", "HII", "4.0"))
+        self.assertEqual(Target.objects.get(targetName="M31").targetConst, "Andromeda")
+        # The three names asked for, and M31 under its main identifier
+        self.assertEqual(SimbadName.objects.count(), 4)
+        self.assertTrue(self.backfill.called)
+
+    def test_reimport_uses_the_cache_and_skips_existing_targets(self):
+        importTargetList(self.createJob().importId, FakeSimbad())
+        simbad = FakeSimbad()
+        importTargetList(self.createJob().importId, simbad)
+        # Only the name SIMBAD didn't know is asked again
+        self.assertEqual(simbad.queries, [["NOT AN OBJECT"]])
+        self.assertEqual(Target.objects.count(), 2)
+        job = TargetImportJob.objects.latest('importCreatedAt')
+        self.assertEqual((job.importCreated, job.importSkipped), (0, 3))
+
+    def test_simbad_errors_fail_names_not_the_job(self):
+        simbad = mock.Mock()
+        simbad.query_objects.side_effect = ConnectionError("uplink down")
+        importTargetList(self.createJob().importId, simbad)
+        job = TargetImportJob.objects.get()
+        self.assertEqual((job.importStatus, job.importCreated, job.importFailed), (TargetImportJob.DONE, 0, 4))
+
+    def test_upload_queues_a_job_and_reports_progress(self):
+        self.client.force_login(get_user_model().objects.create_user(username="observer", password="secret"))
+        upload = SimpleUploadedFile("list.oal", OBSERVING_LIST)
+        with mock.patch('targets.tasks.importTargets.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(reverse('upload_targets'), {'file': upload})
+        job = TargetImportJob.objects.get()
+        self.assertRedirects(response, reverse('target_import_status', args=[job.importId]))
+        delay.assert_called_once_with(str(job.importId))
+        self.assertFalse(Target.objects.exists())
+
+        response = self.client.get(reverse('target_import_status', args=[job.importId]), {'format': 'json'})
+        self.assertEqual(response.json()['status'], TargetImportJob.QUEUED)
+        self.assertEqual(response.json()['total'], 4)
+        self.assertContains(self.client.get(reverse('target_import_status', args=[job.importId])), "list.oal")
+
+class NameResolverTests(TestCase):
+    def test_fresh_entries_are_used_without_simbad(self):
+        resolveNames(["M42"], FakeSimbad())
+        simbad = mock.Mock()
+        resolved = resolveNames(["m42", "M  42"], simbad)
+        self.assertFalse(simbad.query_objects.called)
+        self.assertEqual(resolved["M42"].simbadMainId, "M 42")
+        self.assertEqual(set(resolved), {"M42", "M 42"})
+
+    def test_expired_entries_are_refreshed_or_used_offline(self):
+        resolveNames(["M31"], FakeSimbad())
+        SimbadName.objects.update(simbadResolvedAt=datetime.now(pytz.UTC) - CACHE_TTL - timedelta(days=1))
+
+        offline = mock.Mock()
+        offline.query_objects.side_effect = ConnectionError("uplink down")
+        self.assertEqual(resolveNames(["M31"], offline)["M31"].simbadRA2000, "00 42 44.330")
+
+        simbad = FakeSimbad()
+        resolveNames(["M31"], simbad)
+        self.assertEqual(simbad.queries, [["M31"]])
+        self.assertTrue(SimbadName.objects.get(simbadNameKey="M31").simbadResolvedAt > datetime.now(pytz.UTC) - timedelta(minutes=1))
+
+    def test_seeded_catalogue_lookup(self):
+        self.assertEqual(seedCatalogue(), 116)
+        sirius = SimbadName.objects.get(simbadNameKey="SIRIUS")
+        self.assertEqual((sirius.simbadRA2000, sirius.simbadDec2000, sirius.simbadMagV), ("06 45 08.92", "-16 42 58.0", -1.44))
+        self.assertEqual([entry.simbadMainId for entry in lookupNames("sirius")], ["Sirius"])
+        self.assertIn("Aldebaran", [entry.simbadMainId for entry in lookupNames("alde")])
+        self.assertEqual(lookupNames("Siruis")[0].simbadMainId, "Sirius")
+        self.assertEqual(lookupNames("  "), [])
+
+    def test_close_spellings_read_a_bounded_range(self):
+        seedCatalogue()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(lookupNames("Betelgeize")[0].simbadMainId, "Betelgeuse")
+        fuzzy = [q['sql'] for q in queries.captured_queries if '>=' in q['sql']]
+        self.assertEqual(len(fuzzy), 1)
+        self.assertIn('LIMIT 2000', fuzzy[0])
+
+    def test_search_resolves_seeded_names_offline(self):
+        call_command('seed_names', stdout=io.StringIO())
+        self.client.force_login(get_user_model().objects.create_user(username="observer", password="secret"))
+        with mock.patch('targets.resolver.simbadClient', side_effect=AssertionError("SIMBAD used")), \
+             mock.patch('targets.tasks.fetchTargetThumbnail.delay'):
+            response = self.client.post(reverse('target_search'), {'search_term': 'vega'})
+            self.assertRedirects(response, reverse('target_all_list'))
+            vega = Target.objects.get(targetName="Vega")
+            self.assertEqual((vega.targetConst, vega.targetType), ("Lyra", "*"))
+
+            response = self.client.get(reverse('target_lookup'), {'q': 'veg'})
+            self.assertEqual(response.json()['results'][0]['mainId'], "Vega")
+
+class VisibilityTests(TestCase):
+    night = date(2024, 12, 1)
+
+    def setUp(self):
+        cache.clear()
+        self.target = Target(targetName="M42", targetRA2000="05 35 17.3", targetDec2000="-05 23 28")
+
+    def test_night_starts_at_local_noon(self):
+        self.assertEqual(nightOf(datetime(2024, 12, 2, 11, tzinfo=pytz.UTC)), date(2024, 12, 1))   # 05:00 local
+        self.assertEqual(nightOf(datetime(2024, 12, 2, 19, tzinfo=pytz.UTC)), date(2024, 12, 2))   # 13:00 local
+
+    def test_curve_matches_astropy_and_twilight(self):
+        from astropy.coordinates import AltAz, EarthLocation, SkyCoord
+        from astropy.time import Time
+        import astropy.units as u
+        curve = targetCurve(self.target, 49.9, -97.1, 250, self.night)
+        self.assertEqual(len(curve['altitude']), 24 * 60 + 1)
+
+        location = EarthLocation(lat=49.9 * u.deg, lon=-97.1 * u.deg, height=250 * u.m)
+        for i in (300, 700, 1100):
+            frame = AltAz(obstime=Time(curve['unix'][i], format='unix'), location=location)
+            expected = SkyCoord("05h35m17.3s", "-05d23m28s").transform_to(frame).alt.deg
+            self.assertAlmostEqual(curve['altitude'][i], expected, delta=0.01)
+
+        # Winnipeg sunset and the end of astronomical twilight on 1 December 2024
+        sunset, sunrise = curve['twilight']['sun']
+        darkStart, darkEnd = curve['twilight']['astronomical']
+        self.assertEqual(localTime(sunset).strftime('%H:%M'), "16:29")
+        self.assertEqual(localTime(darkStart).strftime('%H:%M'), "18:26")
+        self.assertTrue(sunset < darkStart < darkEnd < sunrise)
+        # New Moon
+        self.assertLess(curve['moonIllumination'], 0.05)
+
+    def test_curves_are_cached_per_night(self):
+        targetCurve(self.target, 49.9, -97.1, 250, self.night)
+        other = Target(targetName="M31", targetRA2000="00 42 44.3", targetDec2000="+41 16 09")
+        with mock.patch('targets.visibility.get_body', side_effect=AssertionError("sky recomputed")):
+            targetCurve(other, 49.9, -97.1, 250, self.night)
+            with mock.patch('targets.visibility.parseSexagesimal', side_effect=AssertionError("curve recomputed")):
+                targetCurve(self.target, 49.9, -97.1, 250, self.night)
+
+    def test_airmass(self):
+        np.testing.assert_allclose(airmass([90, 30]), [1.0, 1.995], atol=0.005)
+        self.assertTrue(np.isnan(airmass([-5])[0]))
+
+    def test_detail_view(self):
+        Target.objects.bulk_create([self.target])
+        self.client.force_login(get_user_model().objects.create_user(username="observer", password="secret"))
+        response = self.client.get(reverse('target_detail', args=[self.target.targetId]))
+        self.assertContains(response, "No altitude curve")
+
+        GeneralConfig.objects.create(latitude=49.9, longitude=-97.1, elevation=250)
+        response = self.client.get(reverse('target_detail', args=[self.target.targetId]))
+        self.assertContains(response, "Highest tonight")
+        self.assertContains(response, "plotly-div")
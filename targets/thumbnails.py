@@ -0,0 +1,204 @@
+############################################################################################################
+## T H U M B N A I L S                                                                                    ##
+############################################################################################################
+# Default target thumbnails from the STScI Digitized Sky Survey. Images are cached under MEDIA_ROOT with a
+# name made from the target's coordinates and field size, so a target whose position hasn't changed never
+# downloads again and targets at the same position share one file. Fetching is done by a background task,
+# never while a target is being saved. Backfills share one pooled session across a bounded number of
+# threads, and transient failures are retried with exponential backoff out of a retry budget shared by
+# the whole run, so an outage at STScI can't turn into thousands of slow retries.
+#
+from django.conf import settings
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from astropy.io import fits
+from PIL import Image
+import numpy as np
+import threading
+import requests
+import hashlib
+import time
+import io
+import os
+
+from targets.ephemeris import parseSexagesimal
+
+import logging
+logger = logging.getLogger(__name__)
+
+DSS_URL = 'https://archive.stsci.edu/cgi-bin/dss_search'
+THUMBNAIL_FOLDER = 'images/thumbnails/dss'
+FIELD_SIZE = 15             # Width and height of the field in arcmin
+THUMBNAIL_PIXELS = 150
+REQUEST_TIMEOUT = (5, 60)   # Connect and read timeouts in seconds
+DEFAULT_WORKERS = 8         # Requests in flight at once
+MAX_ATTEMPTS = 4            # Tries per thumbnail, the first one included
+DEFAULT_RETRY_BUDGET = 100  # Retries shared by every thumbnail of a backfill
+BACKOFF_BASE = 1.0          # Seconds before the first retry, doubled for each one after
+BACKOFF_MAX = 30.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+##################################################################################################
+## thumbnailName - The cache name of a thumbnail relative to MEDIA_ROOT, or None when the      ##
+##                 coordinates can't be parsed. Coordinates are rounded to an arcsecond so      ##
+##                 the same position in any format gives the same name                          ##
+##################################################################################################
+def thumbnailName(ra, dec, fieldSize=FIELD_SIZE):
+    raHours, decDegrees = parseSexagesimal([ra, dec])
+    if not np.isfinite(raHours) or not np.isfinite(decDegrees):
+        return None
+    key = f"{round(raHours * 54000) % 1296000}|{round(decDegrees * 3600)}|{fieldSize}"
+    return THUMBNAIL_FOLDER + '/' + hashlib.blake2b(key.encode('ascii'), digest_size=10).hexdigest() + '.jpg'
+
+##################################################################################################
+## thumbnailPath - The absolute path of a cached thumbnail                                     ##
+##################################################################################################
+def thumbnailPath(name):
+    return os.path.join(settings.MEDIA_ROOT, name)
+
+##################################################################################################
+## fitsToThumbnail - Scale a DSS FITS image to 0-255 and resize it to a thumbnail               ##
+##################################################################################################
+def fitsToThumbnail(content, pixels=THUMBNAIL_PIXELS):
+    with fits.open(io.BytesIO(content)) as hdul:
+        image_data = np.asarray(hdul[0].data, dtype=np.float32)
+    image_data = image_data - np.min(image_data)
+    peak = np.max(image_data)
+    if peak > 0:
+        image_data = image_data / peak
+    image = Image.fromarray((image_data * 255).astype(np.uint8))
+    return image.resize((pixels, pixels))
+
+##################################################################################################
+## fetchThumbnail - Return the cache name of the thumbnail for a position, downloading it from ##
+##                  DSS only when it isn't cached. Raises requests exceptions so the caller    ##
+##                  can retry                                                                  ##
+##################################################################################################
+def fetchThumbnail(ra, dec, fieldSize=FIELD_SIZE, session=None, url=None):
+    name = thumbnailName(ra, dec, fieldSize)
+    if name is None:
+        logger.error("Unable to parse coordinates "+str(ra)+" "+str(dec))
+        return None
+    path = thumbnailPath(name)
+    if os.path.exists(path):
+        return name
+
+    params = {'r': ra, 'd': dec, 'w': fieldSize, 'h': fieldSize, 'e': 'J2000'}
+    logger.debug("Requesting DSS image for "+str(ra)+" "+str(dec))
+    response = (session or requests).get(url or DSS_URL, params=params, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+
+    image = fitsToThumbnail(response.content)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tempPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    image.save(tempPath, format='JPEG')
+    os.replace(tempPath, path)
+    logger.debug("Thumbnail saved as "+path)
+    return name
+
+##################################################################################################
+## thumbnailSession - A requests session whose connection pool holds one connection per worker ##
+##################################################################################################
+def thumbnailSession(workers=DEFAULT_WORKERS):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, workers))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+##################################################################################################
+## RetryBudget - A count of retries shared by the threads of one backfill                      ##
+##################################################################################################
+class RetryBudget(object):
+    def __init__(self, retries=DEFAULT_RETRY_BUDGET):
+        self.remaining = retries
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+##################################################################################################
+## isRetryable - Whether a failed request could succeed if tried again                         ##
+##################################################################################################
+def isRetryable(error):
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code in RETRY_STATUS
+
+##################################################################################################
+## fetchWithRetry - fetchThumbnail, retrying transient failures with exponential backoff while ##
+##                  the budget lasts                                                           ##
+##################################################################################################
+def fetchWithRetry(ra, dec, fieldSize=FIELD_SIZE, session=None, url=None, budget=None):
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return fetchThumbnail(ra, dec, fieldSize, session, url)
+        except requests.RequestException as e:
+            if attempt == MAX_ATTEMPTS - 1 or not isRetryable(e) or (budget is not None and not budget.take()):
+                raise
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+            logger.warning("DSS request for "+str(ra)+" "+str(dec)+" failed with "+str(e)+", retrying in "+str(delay)+"s")
+            time.sleep(delay)
+
+##################################################################################################
+## fetchThumbnails - Fetch the thumbnails of many positions with a bounded pool of threads.     ##
+##                   Positions are (ra, dec) pairs, each cache name is fetched once. Returns a  ##
+##                   dict of cache name to None on success or the error that stopped it         ##
+##################################################################################################
+def fetchThumbnails(positions, fieldSize=FIELD_SIZE, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRY_BUDGET, url=None):
+    pending = {}
+    for ra, dec in positions:
+        name = thumbnailName(ra, dec, fieldSize)
+        if name is not None and name not in pending and not os.path.exists(thumbnailPath(name)):
+            pending[name] = (ra, dec)
+    if not pending:
+        return {}
+
+    budget = RetryBudget(retries)
+    session = thumbnailSession(workers)
+
+    def fetch(item):
+        name, (ra, dec) = item
+        try:
+            fetchWithRetry(ra, dec, fieldSize, session, url, budget)
+            return name, None
+        except Exception as e:
+            logger.error("Failed to retrieve thumbnail for "+str(ra)+" "+str(dec)+" with error "+str(e))
+            return name, e
+
+    with session, ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = dict(executor.map(fetch, pending.items()))
+    logger.info("Fetched "+str(sum(error is None for error in results.values()))+" of "+str(len(results))+" thumbnails")
+    return results
+
+##################################################################################################
+## backfillThumbnails - Fetch the missing thumbnails of targets, by default the whole          ##
+##                      catalogue, and point each target at its cached thumbnail with bulk     ##
+##                      updates. Returns the counts of targets, downloads, failures and        ##
+##                      targets updated                                                        ##
+##################################################################################################
+def backfillThumbnails(targets=None, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRY_BUDGET, url=None):
+    from targets.models import Target
+
+    if targets is None:
+        targets = Target.objects.all()
+    targets = list(targets.only('targetId', 'targetRA2000', 'targetDec2000', 'targetDefaultThumbnail'))
+    results = fetchThumbnails([(target.targetRA2000, target.targetDec2000) for target in targets],
+                              workers=workers, retries=retries, url=url)
+
+    changed = []
+    for target in targets:
+        name = thumbnailName(target.targetRA2000, target.targetDec2000)
+        if name is not None and target.targetDefaultThumbnail.name != name and os.path.exists(thumbnailPath(name)):
+            target.targetDefaultThumbnail = name
+            changed.append(target)
+    Target.objects.bulk_update(changed, ['targetDefaultThumbnail'], batch_size=1000)
+    return {'targets': len(targets),
+            'fetched': sum(error is None for error in results.values()),
+            'failed': sum(error is not None for error in results.values()),
+            'updated': len(changed)}
@@ -3,7 +3,7 @@ from django.conf.urls.static import static
 from django.conf import settings
 from django.urls import path,include
 from . import views
-from .views import target_all_list,target_query,target_detail_view, upload_targets_view
+from .views import target_all_list,target_query,target_detail_view, upload_targets_view, target_import_status, target_lookup
 from django.conf.urls.static import static
 urlpatterns = [
     path("", target_all_list, name="target_all_list"),
@@ -12,5 +12,7 @@ urlpatterns = [
     path("<uuid:pk>/edit/", views.target_update.as_view(), name="target_update"),
     path("<uuid:pk>/delete/", views.target_delete.as_view(), name="target_delete"),
     path("create/", views.target_query, name="target_search"),
+    path("lookup/", target_lookup, name="target_lookup"),
     path('upload/', upload_targets_view, name='upload_targets'),
+    path('upload/<uuid:pk>/', target_import_status, name='target_import_status'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,8 +1,14 @@
 # targets/views.py
 from django.views.generic import ListView, DetailView, DeleteView, UpdateView
 from django.shortcuts import render, redirect, get_object_or_404
+from django.http import JsonResponse
+from django.db import transaction
 from django.conf import settings
-from .models import Target
+from .models import Target, TargetImportJob, queueImport
+from .importer import parseObservingList, buildTargets
+from .resolver import resolveNames, queryWildcard, lookupNames, isWildcard
+from .ephemeris import observerLocation
+from .visibility import targetCurve, localTime
 from .forms import TargetUpdateForm,UploadFileForm
 from django.urls import reverse_lazy
 from django.contrib.auth.decorators import login_required
@@ -10,16 +16,13 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 
 import plotly.graph_objs as go
 import plotly.io as pio
-import pandas as pd
 from datetime import datetime
 import logging
 import uuid
-from astroquery.simbad import Simbad
 from astropy.coordinates import SkyCoord, get_constellation
 from astropy import units as u
 from datetime import datetime, timedelta
-import ephem
-import math
+import numpy as np
 import pytz
 import xml.etree.ElementTree as ET
 
@@ -27,98 +30,65 @@ import xml.etree.ElementTree as ET
 logger = logging.getLogger('targets.views')
 
 ##################################################################################################
-## targetDetailView - List Target detail with DetailView template                               ## 
+## targetDetailView - List Target detail with DetailView template, with tonight's altitude     ##
+##                    curve from the cached visibility service                                  ##
 ##################################################################################################
 @login_required
 def target_detail_view(request, pk):
     targetObj = get_object_or_404(Target, targetId=pk) 
-    
-    local_tz = pytz.timezone(settings.TIME_ZONE)
-    
-    # Define the location (replace with actual location)
-    logger.debug("Latitude: "+str(settings.LATITUDE)+" Longitude: "+str(settings.LONGITUDE)+" Elevation: "+str(settings.ELEVATION))
-    observer = ephem.Observer()
-    observer.lat = settings.LATITUDE  # Default latitude
-    observer.lon = settings.LONGITUDE  # Default longitude
-    observer.elevation = float(settings.ELEVATION)  # Default elevation
-    observer.date = datetime.now(pytz.UTC)  # Current date and time in UTC
 
-    # Set the horizon to 18 degrees below the horizon for astronomical twilight
-    observer.horizon = '-18'
-    logger.debug("Observer: "+str(observer)) 
-
-    # Calculate sunrise and sunset times
-    observer.horizon = '-18'
-    dawn_start = observer.previous_rising(ephem.Sun(), use_center=True).datetime()
-    dusk_end = observer.previous_setting(ephem.Sun(), use_center=True).datetime()
-    logger.info("Daylight starts at "+str(dawn_start.replace(tzinfo=pytz.UTC).astimezone(local_tz)) \
-                +" ends at "+str(dusk_end.replace(tzinfo=pytz.UTC).astimezone(local_tz)))
-    
-    # Convert RA and Dec to decimal degrees
-    raList=targetObj.targetRA2000.split(' ')
-    if len(raList) == 3:
-        ra_hrs, ra_min, ra_sec = raList
-    else:
-        ra_hrs, ra_min = raList
-        ra_sec = 0  
-    ra_decimal = (float(ra_hrs) + float(ra_min)/60 + float(ra_sec)/3600) * 15
-    
-    decList = targetObj.targetDec2000.split(' ')
-    if len(decList) == 3:
-        dec_deg, dec_min, dec_sec = decList
-    else:
-        dec_deg, dec_min = decList
-        dec_sec = 0       
-    dec_decimal = float(dec_deg) + float(dec_min)/60 + float(dec_sec)/3600
-    
-    if ra_decimal is not None and dec_decimal is not None:
-        logger.debug("RA: " + str(ra_decimal) + " Dec: " + str(dec_decimal))
-    else:
-        logger.error("Failed to convert RA/Dec to decimal degrees")
+    location = observerLocation()
+    if location is None:
+        logger.error("Unable to load settings, no altitude curve for "+targetObj.targetName)
+        return render(request, 'targets/target_detail.html', {'Target': targetObj})
+    curve = targetCurve(targetObj, *location)
+    if curve is None:
+        logger.error("Failed to convert RA/Dec to decimal degrees for "+targetObj.targetName)
         return render(request, 'targets/target_detail.html', {'Target': targetObj})
 
-    # Calculate altitude over time for the Target
-    logger.info("Calculating altitude over time for Target starting at "+str(dusk_end))
-    # Create a list of 100 times between dusk_start and dawn_end
-    nowTime=datetime.now(pytz.UTC)
-    times = pd.date_range(start=nowTime-timedelta(hours=12),end=nowTime+timedelta(hours=12), periods=24)
-    logger.debug("Times in UTC: "+str(times))
-
-    altitudes = []
-    for time in times:
-        observer.date = time
-        currTarget = ephem.FixedBody()
-        currTarget._ra = math.radians(ra_decimal)
-        currTarget._dec = math.radians(dec_decimal)
-        currTarget.compute(observer)
-        altitudes.append(math.degrees(currTarget.alt))
-
-    # Re-Express times in local time
-    times = [time.replace(tzinfo=pytz.UTC).astimezone(local_tz) for time in times]
-    logger.debug("Times in "+settings.TIME_ZONE+" :"+str(times))
-    df = pd.DataFrame({'local_time': times, 'altitude': altitudes})
-    logger.debug("Dataframe: "+str(df))
+    times = [localTime(unix) for unix in curve['unix']]
+    sunset, sunrise = curve['twilight']['sun']
+    darkStart, darkEnd = curve['twilight']['astronomical']
 
     # Create the plot
     fig = go.Figure()
 
-    # Plot the altitude over local time
-    fig.add_trace(go.Scatter(x=df['local_time'], y=df['altitude'], mode='lines', name='Altitude', line=dict(color='white')))
+    # Plot the altitude and the Moon over local time, with airmass and Moon separation on hover
+    fig.add_trace(go.Scatter(x=times, y=curve['altitude'], mode='lines', name='Altitude', line=dict(color='white'),
+                             customdata=np.stack([curve['airmass'], curve['moonSeparation']], axis=-1),
+                             hovertemplate='%{y:.1f}° airmass %{customdata[0]:.2f}, %{customdata[1]:.0f}° from the Moon<extra></extra>'))
+    fig.add_trace(go.Scatter(x=times, y=curve['moonAltitude'], mode='lines', name='Moon', line=dict(color='gray', dash='dot'),
+                             hovertemplate='Moon %{y:.1f}°<extra></extra>'))
+
+    # Shade the night, darker once astronomical twilight has ended
+    for (start, end), opacity in (((sunset, sunrise), 0.15), ((darkStart, darkEnd), 0.3)):
+        if start is not None and end is not None:
+            fig.add_vrect(x0=localTime(start), x1=localTime(end), fillcolor='steelblue', opacity=opacity, line_width=0, layer='below')
 
-    # Set the layout
+    # Set the layout, showing the night with an hour either side when the Sun sets
+    xRange = [localTime(sunset - 3600), localTime(sunrise + 3600)] if sunset is not None and sunrise is not None else None
     fig.update_layout(
         plot_bgcolor='black',
         paper_bgcolor='black',
         font=dict(color='white'),
-        xaxis=dict(title='Local Time', color='white'),
-        yaxis=dict(title='Altitude (degrees)', color='white'),
-        title=dict(text='Altitude Over Time', x=0.5, xanchor='center', font=dict(color='white'))
+        xaxis=dict(title='Local Time', color='white', range=xRange),
+        yaxis=dict(title='Altitude (degrees)', color='white', range=[0, 90]),
+        title=dict(text='Altitude Over Time', x=0.5, xanchor='center', font=dict(color='white')),
+        showlegend=False
     )
 
     # Convert the plot to JSON
     graph_json = pio.to_json(fig)
 
-    return render(request, 'targets/target_detail.html', {'Target': targetObj, 'graph_json': graph_json})
+    # Moon separation while it's dark, or over the whole night when it never gets dark
+    dark = (curve['unix'] >= darkStart) & (curve['unix'] <= darkEnd) if darkStart is not None and darkEnd is not None else slice(None)
+    visibility = {'night': curve['night'], 'maxAltitude': curve['maxAltitude'], 'maxAltitudeAt': localTime(curve['maxAltitudeAt']),
+                  'sunset': localTime(sunset), 'sunrise': localTime(sunrise),
+                  'darkStart': localTime(darkStart), 'darkEnd': localTime(darkEnd),
+                  'moonIllumination': round(100 * curve['moonIllumination']),
+                  'moonSeparation': float(np.min(curve['moonSeparation'][dark]))}
+
+    return render(request, 'targets/target_detail.html', {'Target': targetObj, 'graph_json': graph_json, 'visibility': visibility})
 
 ##################################################################################################
 ## targetAllList - List all targets                                                             ## 
@@ -168,57 +138,51 @@ def assignTargetClass(targetType):
         return "Unknown"
 
 ##################################################################################################
-## Target Query     -  Allow the user to search for objects using SimBad                        ##
+## Target Query     -  Allow the user to search for objects. Names come from the local cache    ##
+##                     when it has them, wildcard patterns always go to SimBad                  ##
 ##################################################################################################
 @login_required
 def target_query(request):
     error_message=""
+    suggestions=[]
     if request.method == 'POST':
-        Simbad.TIMEOUT = 10 # sets the timeout to 120s
-        error_message=""
-        search_term = request.POST.get('search_term')
+        search_term = (request.POST.get('search_term') or '').strip()
+        logger.info("Searching for "+search_term)
         try:
-            search_term = search_term.strip()
-            logger.info("Searching for "+search_term)
-            Simbad.add_votable_fields('flux(B)', 'flux(V)', 'flux(R)', 'flux(I)','otype(main)')
-            results_simbad = Simbad.query_object(search_term, wildcard=True)
+            if isWildcard(search_term):
+                found = queryWildcard(search_term)
+            else:
+                found = list(resolveNames([search_term]).values())
         except Exception as e:
-            logger.error("Error searching for "+search_term)
-            error_message="Error searching for "+search_term
-            results_simbad=None
-            
-        if (results_simbad is not None):
+            logger.error("Error searching for "+search_term+" with error "+str(e))
+            found = []
+
+        if found:
             logger.info("Search results found")
-            df=results_simbad.to_pandas()
-            results=df.to_dict('records')
-            # Add results to the targets database
-            logger.info("Adding "+str(len(df))+" targets to database")
-            for index, row in df.iterrows():
-                logger.info("Adding Target "+row["MAIN_ID"])
-                # Figure out the constellation
-                coords=row["RA"]+" "+row["DEC"]
-                c = SkyCoord(coords, unit=(u.hourangle, u.deg), frame='icrs')
-                
-                # Add the Target record
-                Target.objects.create(
-                    targetId = uuid.uuid4(),     
-                    targetName = row["MAIN_ID"].replace(' ',''),
-                    targetType  =row["OTYPE_main"],
-                    targetClass="DS",
-                    targetRA2000 = row["RA"],
-                    targetDec2000 = row["DEC"],
-                    targetConst = get_constellation(c),
-                    targetMag = row["FLUX_V"],
-                    targetDefaultThumbnail = 'images/thumbnails/'+row["MAIN_ID"].replace(' ','')+'.jpg'
-                    )
-                logger.info("Target added to database")
-        else: 
-            results=[]
-            return render(request, 'targets/target_search.html',{'error': error_message})
-        return redirect('target_all_list')
-        
-    else:
-        return render(request, 'targets/target_search.html',{'error': error_message})
+            targets = buildTargets(found)
+            logger.info("Adding "+str(len(targets))+" targets to database")
+            for targetObj in targets:
+                targetObj.save()
+                logger.info("Target "+targetObj.targetName+" added to database")
+            return redirect('target_all_list')
+
+        error_message="Error searching for "+search_term
+        suggestions=lookupNames(search_term)
+    return render(request, 'targets/target_search.html',{'error': error_message, 'suggestions': suggestions})
+
+##################################################################################################
+## Target Lookup    -  Cached names matching a search term as JSON, for search suggestions      ##
+##################################################################################################
+@login_required
+def target_lookup(request):
+    try:
+        limit = min(50, max(1, int(request.GET.get('limit', 10))))
+    except ValueError:
+        limit = 10
+    matches = lookupNames(request.GET.get('q', ''), limit=limit)
+    return JsonResponse({'results': [{'name': entry.simbadNameKey, 'mainId': entry.simbadMainId,
+                                      'ra': entry.simbadRA2000, 'dec': entry.simbadDec2000,
+                                      'type': entry.simbadType, 'magV': entry.simbadMagV} for entry in matches]})
 
 ##################################################################################################
 ## Target Update     -  Use the UpdateView class to edit Target records                         ##
@@ -259,7 +223,8 @@ def parse_xml(file):
     return targets
 
 ##################################################################################################
-## Upload Targets    -  Allow the user to upload a file with Target data from KStars            ##
+## Upload Targets    -  Allow the user to upload a file with Target data from KStars. The names ##
+##                      are imported by a background job, the user is sent to its progress page ##
 ##################################################################################################
 @login_required
 def upload_targets_view(request):
@@ -268,59 +233,31 @@ def upload_targets_view(request):
         if form.is_valid():
             file = request.FILES['file']
             logger.info("File uploaded: "+str(file))
-            tree = ET.parse(file)
-            root = tree.getroot()
-            for child in root:
-                for subChild in child:
-                    if subChild.tag == 'target':
-                        for nodes in subChild:
-                            if nodes.tag == 'name':
-                                logger.info("Name: "+str(nodes.text))
-                                Simbad.TIMEOUT = 10 # sets the timeout to 120s
-                                try:
-                                    search_term = str(nodes.text).strip()
-                                    logger.info("Searching for "+search_term)
-                                    Simbad.add_votable_fields('flux(B)', 'flux(V)', 'flux(R)', 'flux(I)','otype(main)')
-                                    results_simbad = Simbad.query_object(search_term, wildcard=True)
-                                except Exception as e:
-                                    logger.error("Error searching for "+search_term)
-                                    results_simbad=None
-            
-                                if (results_simbad is not None):
-                                    logger.info("Search results found")
-                                    df=results_simbad.to_pandas()
-                                    results=df.to_dict('records')
-                                    # Add results to the targets database
-                                    logger.info("Adding "+str(len(df))+" targets to database")
-                                    for index, row in df.iterrows():
-                                        logger.info("Adding Target "+row["MAIN_ID"])
-                                        try:
-                                            # Figure out the constellation
-                                            coords=row["RA"]+" "+row["DEC"]
-                                            c = SkyCoord(coords, unit=(u.hourangle, u.deg), frame='icrs')
-                                        except Exception as e:
-                                            logger.error("Error getting constellation")
-                                            continue
+            try:
+                names = parseObservingList(file)
+            except ET.ParseError as e:
+                logger.error("Unable to parse "+str(file)+": "+str(e))
+                form.add_error('file', "Unable to read the observing list: "+str(e))
+                return render(request, 'targets/upload_targets.html', {'form': form})
 
-                                        # Add the Target record
-                                        Target.objects.create(
-                                            targetId = uuid.uuid4(),     
-                                            targetName = row["MAIN_ID"].replace(' ',''),
-                                            targetType  =row["OTYPE_main"],
-                                            #targetClass=assignTargetClass(row["OTYPE_main"]),
-                                            targetRA2000 = row["RA"],
-                                            targetDec2000 = row["DEC"],
-                                            targetConst = get_constellation(c),
-                                            targetMag = row["FLUX_V"],
-                                            targetDefaultThumbnail = 'images/thumbnails/'+row["MAIN_ID"].replace(' ','')+'.jpg'
-                                            )
-                                        logger.info("Target added to database")
-                                else: 
-                                    logger.info("Unable to add Target to the database")
-
-            return redirect('target_all_list')
+            job = TargetImportJob.objects.create(importFileName=file.name, importNames=names, importTotal=len(names))
+            logger.info("Queueing import of "+str(len(names))+" names from "+file.name)
+            importId = job.importId
+            transaction.on_commit(lambda: queueImport(importId))
+            return redirect(job)
     else:
         form = UploadFileForm()
         
     return render(request, 'targets/upload_targets.html', {'form': form})
 
+##################################################################################################
+## Target Import Status - Progress of a background import, as a page or as JSON for polling     ##
+##################################################################################################
+@login_required
+def target_import_status(request, pk):
+    job = get_object_or_404(TargetImportJob, importId=pk)
+    if request.GET.get('format') == 'json':
+        return JsonResponse({'status': job.importStatus, 'finished': job.finished, 'percent': job.percent,
+                             'total': job.importTotal, 'resolved': job.importResolved, 'created': job.importCreated,
+                             'skipped': job.importSkipped, 'failed': job.importFailed, 'message': job.importMessage})
+    return render(request, 'targets/target_import.html', {'job': job})
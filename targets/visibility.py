@@ -0,0 +1,157 @@
+############################################################################################################
+## V I S I B I L I T Y                                                                                    ##
+############################################################################################################
+# Altitude, airmass and moon curves for a target over one night, at one minute resolution. A night runs
+# from local noon to the next local noon. The Sun and Moon are worked out once per night and observatory
+# for every minute in a single vectorised astropy call each, with twilight times found where the Sun's
+# altitude crosses each limit. A target's curve is then a few NumPy operations on those arrays. Both are
+# kept in Django's cache, so the detail page of a target seen before tonight costs a cache lookup.
+#
+from django.conf import settings
+from django.core.cache import cache
+from datetime import datetime, timedelta
+from astropy.time import Time
+from astropy import units as u
+from astropy.coordinates import SkyCoord, EarthLocation, TETE, get_body
+import numpy as np
+import pytz
+
+from targets.ephemeris import parseSexagesimal
+
+import logging
+logger = logging.getLogger(__name__)
+
+NIGHT_STEP_MINUTES = 1
+NIGHT_POINTS = 24 * 60 // NIGHT_STEP_MINUTES + 1
+CACHE_SECONDS = 36 * 3600
+# Sun altitudes of sunset/sunrise and the end/start of each twilight
+TWILIGHTS = [('sun', -0.833), ('civil', -6.0), ('nautical', -12.0), ('astronomical', -18.0)]
+
+##################################################################################################
+## nightOf - The date of the night a moment falls in, nights start at local noon                ##
+##################################################################################################
+def nightOf(moment=None):
+    local_tz = pytz.timezone(settings.TIME_ZONE)
+    local = (moment or datetime.now(pytz.UTC)).astimezone(local_tz)
+    return (local - timedelta(hours=12)).date()
+
+##################################################################################################
+## nightTimes - The UTC times of a night's grid, local noon to local noon                      ##
+##################################################################################################
+def nightTimes(night):
+    local_tz = pytz.timezone(settings.TIME_ZONE)
+    start = local_tz.localize(datetime(night.year, night.month, night.day, 12)).astimezone(pytz.UTC)
+    return Time(start) + np.arange(NIGHT_POINTS) * NIGHT_STEP_MINUTES * u.min
+
+##################################################################################################
+## altitude - Altitudes in degrees from apparent RA/Dec and local sidereal time in radians     ##
+##################################################################################################
+def altitude(ra, dec, lst, latitude):
+    lat = np.radians(latitude)
+    sinAlt = np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(lst - ra)
+    return np.degrees(np.arcsin(np.clip(sinAlt, -1, 1)))
+
+##################################################################################################
+## airmass - Kasten and Young airmass for altitudes in degrees, NaN below the horizon          ##
+##################################################################################################
+def airmass(altitudes):
+    altitudes = np.asarray(altitudes, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = 1.0 / (np.sin(np.radians(altitudes)) + 0.50572 * (altitudes + 6.07995) ** -1.6364)
+    return np.where(altitudes > 0, result, np.nan)
+
+##################################################################################################
+## separation - Angular separation in degrees between arrays of RA/Dec in radians              ##
+##################################################################################################
+def separation(ra1, dec1, ra2, dec2):
+    cosSep = np.sin(dec1) * np.sin(dec2) + np.cos(dec1) * np.cos(dec2) * np.cos(ra1 - ra2)
+    return np.degrees(np.arccos(np.clip(cosSep, -1, 1)))
+
+##################################################################################################
+## crossings - The times an altitude curve goes below (setting) and above (rising) a limit,    ##
+##             interpolated between grid points                                                ##
+##################################################################################################
+def crossings(times, altitudes, limit):
+    above = altitudes > limit
+    changes = np.flatnonzero(above[:-1] != above[1:])
+    setting, rising = [], []
+    for i in changes:
+        fraction = (limit - altitudes[i]) / (altitudes[i + 1] - altitudes[i])
+        moment = times[i] + fraction * (times[i + 1] - times[i])
+        (setting if above[i] else rising).append(moment)
+    return setting, rising
+
+##################################################################################################
+## nightSky - Sidereal time, Sun and Moon for every minute of a night at a site, and the       ##
+##            night's twilight times. Cached per night and site                                ##
+##################################################################################################
+def nightSky(night, latitude, longitude, elevation):
+    key = f"nightsky:{night.isoformat()}:{latitude:.4f}:{longitude:.4f}:{elevation:.0f}:{NIGHT_STEP_MINUTES}"
+    sky = cache.get(key)
+    if sky is not None:
+        return sky
+
+    times = nightTimes(night)
+    location = EarthLocation(lat=latitude * u.deg, lon=longitude * u.deg, height=elevation * u.m)
+    lst = times.sidereal_time('apparent', longitude=longitude * u.deg).radian
+    # True equator and equinox of date, the frame apparent sidereal time is measured in
+    frame = TETE(obstime=times, location=location)
+    sun = get_body('sun', times, location).transform_to(frame)
+    moon = get_body('moon', times, location).transform_to(frame)
+    sunAlt = altitude(sun.ra.radian, sun.dec.radian, lst, latitude)
+    moonRa, moonDec = moon.ra.radian, moon.dec.radian
+
+    # Fraction of the Moon lit, from its elongation at the middle of the night
+    middle = NIGHT_POINTS // 2
+    elongation = np.radians(separation(sun.ra.radian[middle], sun.dec.radian[middle], moonRa[middle], moonDec[middle]))
+
+    unix = times.unix
+    twilight = {}
+    for name, limit in TWILIGHTS:
+        setting, rising = crossings(unix, sunAlt, limit)
+        twilight[name] = (setting[0] if setting else None, rising[-1] if rising else None)
+
+    sky = {'unix': unix, 'lst': lst, 'sunAltitude': sunAlt, 'moonRa': moonRa, 'moonDec': moonDec,
+           'moonAltitude': altitude(moonRa, moonDec, lst, latitude),
+           'moonIllumination': float((1 - np.cos(elongation)) / 2), 'twilight': twilight}
+    cache.set(key, sky, CACHE_SECONDS)
+    return sky
+
+##################################################################################################
+## targetCurve - A target's altitude, airmass and Moon separation over a night. Returns None   ##
+##               when its coordinates can't be parsed. Cached per target, position and night   ##
+##################################################################################################
+def targetCurve(targetObj, latitude, longitude, elevation, night=None):
+    night = night or nightOf()
+    key = (f"targetcurve:{targetObj.targetId}:{targetObj.targetRA2000}:{targetObj.targetDec2000}:"
+           f"{night.isoformat()}:{latitude:.4f}:{longitude:.4f}:{NIGHT_STEP_MINUTES}").replace(' ', '_')
+    curve = cache.get(key)
+    if curve is not None:
+        return curve
+
+    raHours, decDegrees = parseSexagesimal([targetObj.targetRA2000, targetObj.targetDec2000])
+    if not np.isfinite(raHours) or not np.isfinite(decDegrees):
+        return None
+    sky = nightSky(night, latitude, longitude, elevation)
+
+    # Precess once to the middle of the night, the change over the night is far below a minute's motion
+    middle = Time(sky['unix'][NIGHT_POINTS // 2], format='unix')
+    apparent = SkyCoord(ra=raHours * 15 * u.deg, dec=decDegrees * u.deg, frame='icrs').transform_to(TETE(obstime=middle))
+    ra, dec = apparent.ra.radian, apparent.dec.radian
+    altitudes = altitude(ra, dec, sky['lst'], latitude)
+
+    highest = int(np.argmax(altitudes))
+    curve = {'night': night, 'unix': sky['unix'], 'altitude': altitudes, 'airmass': airmass(altitudes),
+             'moonAltitude': sky['moonAltitude'], 'moonSeparation': separation(ra, dec, sky['moonRa'], sky['moonDec']),
+             'moonIllumination': sky['moonIllumination'], 'sunAltitude': sky['sunAltitude'],
+             'twilight': sky['twilight'], 'maxAltitude': float(altitudes[highest]), 'maxAltitudeAt': float(sky['unix'][highest])}
+    cache.set(key, curve, CACHE_SECONDS)
+    return curve
+
+##################################################################################################
+## localTime - A unix time as a datetime in the observatory's time zone, None stays None       ##
+##################################################################################################
+def localTime(unix):
+    if unix is None:
+        return None
+    return datetime.fromtimestamp(unix, pytz.UTC).astimezone(pytz.timezone(settings.TIME_ZONE))